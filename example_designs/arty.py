@@ -21,6 +21,7 @@ from litesdcard.phy import SDPHY
 from litesdcard.clocker import SDClockerS7
 from litesdcard.core import SDCore
 from litesdcard.bist import BISTBlockGenerator, BISTBlockChecker
+from litesdcard.dma import SDBlock2MemDMA, SDMem2BlockDMA
 
 from litesdcard.emulator import SDEmulator, _sdemulator_pads
 
@@ -78,11 +79,23 @@ class SDSoC(SoCCore):
         "sdemulator":     24,
         "bist_generator": 25,
         "bist_checker":   26,
+        "sdblock2mem":    27,
+        "sdmem2block":    28,
         "analyzer":       30
     }
     csr_map.update(SoCCore.csr_map)
 
-    def __init__(self, with_cpu, with_emulator, with_analyzer):
+    interrupt_map = {
+        "sdcore": 3
+    }
+    interrupt_map.update(SoCCore.interrupt_map)
+
+    mem_map = {
+        "sdmailbox": 0x30000000
+    }
+    mem_map.update(SoCCore.mem_map)
+
+    def __init__(self, with_cpu, with_emulator, with_analyzer, with_dma):
         platform = arty.Platform()
         platform.add_extension(_sd_io)
         clk_freq = int(100e6)
@@ -115,16 +128,41 @@ class SDSoC(SoCCore):
         # sd
         self.submodules.sdclk = SDClockerS7()
         self.submodules.sdphy = SDPHY(sdcard_pads, platform.device)
-        self.submodules.sdcore = SDCore(self.sdphy)
+        self.submodules.sdcore = SDCore(self.sdphy, with_stats=True, with_trace=True)
+        self.register_mem("sdmailbox", self.mem_map["sdmailbox"], self.sdcore.mailbox.bus, 32)
         self.submodules.sdtimer = Timer()
 
         self.submodules.bist_generator = BISTBlockGenerator(random=True)
         self.submodules.bist_checker = BISTBlockChecker(random=True)
 
-        self.comb += [
-            self.sdcore.source.connect(self.bist_checker.sink),
-            self.bist_generator.source.connect(self.sdcore.sink)
-        ]
+        if with_dma:
+            # dmas next to the bist, the data path goes to the last started
+            # frontend (e.g. SCR read with the dma, then bist transfers)
+            self.submodules.sdblock2mem = SDBlock2MemDMA()
+            self.submodules.sdmem2block = SDMem2BlockDMA()
+            self.add_wb_master(self.sdblock2mem.bus)
+            self.add_wb_master(self.sdmem2block.bus)
+
+            bist = Signal()
+            self.sync += \
+                If(self.bist_generator.start.re | self.bist_checker.start.re,
+                    bist.eq(1)
+                ).Elif(self.sdblock2mem.start.re | self.sdmem2block.start.re,
+                    bist.eq(0)
+                )
+            self.comb += \
+                If(bist,
+                    self.sdcore.source.connect(self.bist_checker.sink),
+                    self.bist_generator.source.connect(self.sdcore.sink)
+                ).Else(
+                    self.sdcore.source.connect(self.sdblock2mem.sink),
+                    self.sdmem2block.source.connect(self.sdcore.sink)
+                )
+        else:
+            self.comb += [
+                self.sdcore.source.connect(self.bist_checker.sink),
+                self.bist_generator.source.connect(self.sdcore.sink)
+            ]
 
         self.platform.add_period_constraint(self.crg.cd_sys.clk, 1e9/clk_freq)
         self.platform.add_period_constraint(self.sdclk.cd_sd.clk, 1e9/sd_freq)
@@ -170,9 +208,10 @@ def main():
         with_cpu = "cpu" in args
         with_emulator = "emulator" in args
         with_analyzer = "analyzer" in args
-        print("[building]... cpu: {}, emulator: {}, analyzer: {}".format(
-            with_cpu, with_emulator, with_analyzer))
-        soc = SDSoC(with_cpu, with_emulator, with_analyzer)
+        with_dma = "dma" in args
+        print("[building]... cpu: {}, emulator: {}, analyzer: {}, dma: {}".format(
+            with_cpu, with_emulator, with_analyzer, with_dma))
+        soc = SDSoC(with_cpu, with_emulator, with_analyzer, with_dma)
         builder = Builder(soc, output_dir="build", csr_csv="../test/csr.csv")
         vns = builder.build()
         soc.do_exit(vns)
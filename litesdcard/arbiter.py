@@ -0,0 +1,270 @@
+"""Multi-port block request frontend serializing clients on SDCore."""
+
+from litex.gen import *
+
+from litex.soc.interconnect import stream
+from litex.soc.interconnect.csr import *
+
+from litesdcard.common import *
+
+
+class SDPort:
+    def __init__(self, data_width=32):
+        self.cmd = stream.Endpoint(sdport_cmd_layout)
+        self.status = stream.Endpoint(sdport_status_layout)
+        self.sink = stream.Endpoint([("data", data_width)])
+        self.source = stream.Endpoint([("data", data_width)])
+
+
+class SDArbiter(Module, AutoCSR):
+    """Serialize the block requests of several ports on SDCore
+
+    Each port receives requests on cmd ({write, lba, count}, count in blocks
+    of 512 bytes), takes the write data on sink, returns the read data on
+    source and reports each completion on status.
+
+    Requests are cut in transfers of at most weight blocks of the port (a
+    weight of 0 is served as 1). The
+    next transfer goes to the highest priority port with a pending request,
+    ports of the same priority are served in round robin: each one gets
+    weight blocks per round. A request of at most mergemax blocks
+    contiguous to the pending one of the same port (same direction) is
+    merged with it, its completion is reported with the merged one
+    (status.requests).
+
+    Transfers are sent on an SDCore port (get_port) with CMD17/CMD18 and
+    CMD24/CMD25 (block addressing), SDCore autocmd must be set for multiple
+    blocks transfers. When a transfer
+    fails, the remaining blocks of the request are dropped (the read or write
+    data left in SDCore is flushed and the write data still to come on the
+    sink of the port is drained) and the error is reported.
+    """
+    def __init__(self, core, nports):
+        sdcore = core.get_port()
+        data_width = len(sdcore.sink.data)
+        self.ports = [SDPort(data_width) for i in range(nports)]
+
+        self.mergemax = CSRStorage(16, reset=8)
+
+        # # #
+
+        n = Signal(32)
+        nblocks = Signal(32)
+        grant = Signal(max=max(nports, 2))
+        last = Signal(max=max(nports, 2))
+        lba = Signal(32)
+        write = Signal()
+        words = Signal(32)
+        port = Signal(max=max(nports, 2))
+        issue = Signal()
+        complete = Signal()
+        failed = Signal()
+        drop = Signal()
+        status_done = Signal()
+
+        cur_valid = Array(Signal() for i in range(nports))
+        cur_write = Array(Signal() for i in range(nports))
+        cur_lba = Array(Signal(32) for i in range(nports))
+        cur_remaining = Array(Signal(32) for i in range(nports))
+        cur_requests = Array(Signal(16) for i in range(nports))
+        cur_error = Array(Signal() for i in range(nports))
+        prios = Array(Signal(2) for i in range(nports))
+        weights = Array(Signal(16) for i in range(nports))
+
+        # Per port: pending request, merge of contiguous requests, priority
+        # and weight
+        eligible = Signal(nports)
+        for i, p in enumerate(self.ports):
+            prio = CSRStorage(2, name="prio{}".format(i))
+            weight = CSRStorage(16, reset=16, name="weight{}".format(i))
+            setattr(self, "prio{}".format(i), prio)
+            setattr(self, "weight{}".format(i), weight)
+            self.comb += [
+                prios[i].eq(prio.storage),
+                weights[i].eq(Mux(weight.storage != 0, weight.storage, 1))
+            ]
+
+            load = Signal()
+            merge = Signal()
+            issued = Signal()
+            dropped = Signal()
+            done = Signal()
+            self.comb += [
+                load.eq(~cur_valid[i] & p.cmd.valid),
+                merge.eq(cur_valid[i] & p.cmd.valid &
+                    (p.cmd.write == cur_write[i]) &
+                    (p.cmd.lba == (cur_lba[i] + cur_remaining[i])) &
+                    (p.cmd.count <= self.mergemax.storage) &
+                    (cur_remaining[i] != 0)),
+                p.cmd.ready.eq(load | merge),
+                issued.eq(issue & (port == i)),
+                dropped.eq(drop & (port == i)),
+                done.eq(complete & (port == i)),
+                eligible[i].eq(cur_valid[i] & (cur_remaining[i] != 0)),
+
+                p.status.valid.eq(done),
+                p.status.error.eq(cur_error[i]),
+                p.status.requests.eq(cur_requests[i])
+            ]
+            self.sync += [
+                If(load,
+                    cur_valid[i].eq(1),
+                    cur_write[i].eq(p.cmd.write),
+                    cur_lba[i].eq(p.cmd.lba),
+                    cur_remaining[i].eq(p.cmd.count),
+                    cur_requests[i].eq(1),
+                    cur_error[i].eq(0)
+                ).Elif(done & p.status.ready,
+                    cur_valid[i].eq(0)
+                ).Else(
+                    If(issued,
+                        cur_lba[i].eq(cur_lba[i] + nblocks)
+                    ),
+                    If(dropped,
+                        cur_remaining[i].eq(0),
+                        cur_error[i].eq(1)
+                    ).Else(
+                        cur_remaining[i].eq(cur_remaining[i] -
+                            Mux(issued, nblocks, 0) + Mux(merge, p.cmd.count, 0))
+                    ),
+                    If(merge,
+                        cur_requests[i].eq(cur_requests[i] + 1)
+                    )
+                )
+            ]
+
+        # Highest priority with a pending request, round robin inside it
+        maxprio = Signal(2)
+        maxprio_i = 0
+        for i in range(nports):
+            maxprio_i = Mux(eligible[i] & (prios[i] > maxprio_i), prios[i], maxprio_i)
+        candidates = Signal(nports)
+        self.comb += [
+            maxprio.eq(maxprio_i),
+            candidates.eq(Cat(*[eligible[i] & (prios[i] == maxprio) for i in range(nports)]))
+        ]
+        rr_cases = {}
+        for l in range(nports):
+            rr_cases[l] = []
+            for k in reversed(range(1, nports + 1)):
+                j = (l + k)%nports
+                rr_cases[l] = If(candidates[j], grant.eq(j)).Else(rr_cases[l])
+        self.comb += [
+            Case(last, rr_cases),
+            If(cur_remaining[grant] < weights[grant],
+                n.eq(cur_remaining[grant])
+            ).Else(
+                n.eq(weights[grant])
+            )
+        ]
+
+        # Data routing to the port of the current transfer (SDCore metadata
+        # is not forwarded)
+        cases = {}
+        dcases = {}
+        for i, p in enumerate(self.ports):
+            cases[i] = [
+                p.sink.connect(sdcore.sink),
+                sdcore.source.connect(p.source,
+                    omit={name for name, width in sdcore_metadata_layout})
+            ]
+            dcases[i] = p.sink.ready.eq(1)
+        route = Signal()
+        discard = Signal()
+        self.comb += [
+            If(route, Case(port, cases)),
+            If(discard, Case(port, dcases))
+        ]
+        sink_valid = Array(p.sink.valid for p in self.ports)
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        fsm.act("IDLE",
+            If(candidates != 0,
+                NextValue(port, grant),
+                NextValue(last, grant),
+                NextValue(nblocks, n),
+                NextValue(write, cur_write[grant]),
+                NextValue(lba, cur_lba[grant]),
+                NextState("ISSUE")
+            )
+        )
+        fsm.act("ISSUE",
+            sdcore.cmd_sink.valid.eq(1),
+            sdcore.cmd_sink.argument.eq(lba),
+            If(write,
+                If(nblocks > 1,
+                    sdcore.cmd_sink.command.eq((25 << 8) | SDCARD_CTRL_RESPONSE_SHORT |
+                        (SDCARD_CTRL_DATA_TRANSFER_WRITE << 5))
+                ).Else(
+                    sdcore.cmd_sink.command.eq((24 << 8) | SDCARD_CTRL_RESPONSE_SHORT |
+                        (SDCARD_CTRL_DATA_TRANSFER_WRITE << 5))
+                )
+            ).Else(
+                If(nblocks > 1,
+                    sdcore.cmd_sink.command.eq((18 << 8) | SDCARD_CTRL_RESPONSE_SHORT |
+                        (SDCARD_CTRL_DATA_TRANSFER_READ << 5))
+                ).Else(
+                    sdcore.cmd_sink.command.eq((17 << 8) | SDCARD_CTRL_RESPONSE_SHORT |
+                        (SDCARD_CTRL_DATA_TRANSFER_READ << 5))
+                )
+            ),
+            sdcore.cmd_sink.blocksize.eq(512),
+            sdcore.cmd_sink.blockcount.eq(nblocks),
+            If(sdcore.cmd_sink.ready,
+                issue.eq(1),
+                NextValue(words, nblocks << log2_int(4096//data_width)),
+                NextValue(failed, 0),
+                NextValue(status_done, 0),
+                NextState("WAIT")
+            )
+        )
+        fsm.act("WAIT",
+            route.eq(1),
+            sdcore.cmd_source.ready.eq(1),
+            If(sdcore.cmd_source.valid,
+                NextValue(status_done, 1),
+                NextValue(failed,
+                    (sdcore.cmd_source.cmdevt[2:6] != 0) |
+                    (sdcore.cmd_source.dataevt[1:5] != 0))
+            ),
+            If((write & sdcore.sink.valid & sdcore.sink.ready) |
+               (~write & sdcore.source.valid & sdcore.source.ready),
+                NextValue(words, words - 1)
+            ),
+            # Data of a failed transfer is not waited for: the read data left
+            # in SDCore is flushed, the write data of the port for the rest of
+            # the request is drained
+            If(status_done & failed,
+                drop.eq(1),
+                If(write,
+                    sdcore.flush.eq(1),
+                    NextValue(words, words - (sdcore.sink.valid & sdcore.sink.ready) +
+                        (cur_remaining[port] << log2_int(4096//data_width))),
+                    NextState("DRAIN")
+                ).Else(
+                    sdcore.source_flush.eq(1),
+                    NextState("COMPLETE")
+                )
+            ).Elif(status_done & (words == 0),
+                If(cur_remaining[port] == 0,
+                    NextState("COMPLETE")
+                ).Else(
+                    NextState("IDLE")
+                )
+            )
+        )
+        fsm.act("DRAIN",
+            discard.eq(1),
+            If(sink_valid[port],
+                NextValue(words, words - 1)
+            ),
+            If((words == 0) | ((words == 1) & sink_valid[port]),
+                NextState("COMPLETE")
+            )
+        )
+        fsm.act("COMPLETE",
+            complete.eq(1),
+            If(Array(p.status.ready for p in self.ports)[port],
+                NextState("IDLE")
+            )
+        )
@@ -1,10 +1,53 @@
+from fractions import Fraction
+
 from litex.gen import *
 from litex.gen.genlib.resetsync import AsyncResetSynchronizer
 from litex.soc.interconnect.csr import *
 
 
+def _clkgen_config(freq, sys_clk_freq):
+    # CLKFX = CLKIN*m/d, 2 <= m <= 256, 1 <= d <= 256
+    r = Fraction(int(freq), int(sys_clk_freq)).limit_denominator(256)
+    m, d = r.numerator, r.denominator
+    if m < 2:
+        m, d = 2*m, 2*d
+    assert m <= 256 and d <= 256, "{} Hz not reachable".format(freq)
+    return m, d
+
+
+def _mmcm_config(freq, sys_clk_freq):
+    # CLKOUT0 = CLKIN*m/(d*o), VCO in 600-1200MHz, PFD >= 10MHz
+    best = None
+    for d in range(1, 107):
+        if sys_clk_freq/d < 10e6:
+            break
+        for m in range(2, 65):
+            vco = sys_clk_freq*m/d
+            if vco < 600e6 or vco > 1200e6:
+                continue
+            o = min(max(int(round(vco/freq)), 2), 128)
+            diff = abs(vco/o - freq)
+            if best is None or diff < best[0]:
+                best = (diff, m, d, o)
+    assert best is not None, "{} Hz not reachable".format(freq)
+    return best[1:]
+
+
+def _mmcm_div(n, nocount=0x1000):
+    # high/low times of a divider DRP register
+    if n == 1:
+        return nocount
+    return (n//2 << 6) | (n//2 + n%2)
+
+
 class SDClockerS6(Module, AutoCSR):
-    def __init__(self, sys_clk_freq=50e6, max_sd_clk_freq=100e6):
+    """Programmable sd clock (DCM_CLKGEN)
+
+    The frequency is programmed through the CSRs. When freqs is given, the
+    clocker also programs freqs[sel] in hardware at reset and on each sel
+    change (e.g. sel driven by SDInitializer.clk_sel).
+    """
+    def __init__(self, sys_clk_freq=50e6, max_sd_clk_freq=100e6, freqs=None):
             self._cmd_data = CSRStorage(10)
             self._send_cmd_data = CSR()
             self._send_go = CSR()
@@ -53,14 +96,23 @@ class SDClockerS6(Module, AutoCSR):
                 o_PROGDONE=sd_progdone
             )
 
+            send_cmd_data = Signal()
+            cmd_data = Signal(10)
+            send_go = Signal()
+            self.comb += [
+                send_cmd_data.eq(self._send_cmd_data.re),
+                cmd_data.eq(self._cmd_data.storage),
+                send_go.eq(self._send_go.re)
+            ]
+
             remaining_bits = Signal(max=11)
             transmitting = Signal()
             self.comb += transmitting.eq(remaining_bits != 0)
             sr = Signal(10)
             self.sync += [
-                If(self._send_cmd_data.re,
+                If(send_cmd_data,
                     remaining_bits.eq(10),
-                    sr.eq(self._cmd_data.storage)
+                    sr.eq(cmd_data)
                 ).Elif(transmitting,
                     remaining_bits.eq(remaining_bits - 1),
                     sr.eq(sr[1:])
@@ -68,14 +120,14 @@ class SDClockerS6(Module, AutoCSR):
             ]
             self.comb += [
                 sd_progdata.eq(transmitting & sr[0]),
-                sd_progen.eq(transmitting | self._send_go.re)
+                sd_progen.eq(transmitting | send_go)
             ]
 
             # enforce gap between commands
             busy_counter = Signal(max=14)
             busy = Signal()
             self.comb += busy.eq(busy_counter != 0)
-            self.sync += If(self._send_cmd_data.re,
+            self.sync += If(send_cmd_data,
                     busy_counter.eq(13)
                 ).Elif(busy,
                     busy_counter.eq(busy_counter - 1)
@@ -83,6 +135,59 @@ class SDClockerS6(Module, AutoCSR):
 
             self.comb += self._status.status.eq(Cat(busy, sd_progdone, sd_locked))
 
+            # hardware programming of the preset frequencies: D, M, then GO
+            if freqs is not None:
+                self.sel = Signal(max=max(len(freqs), 2))
+                configs = [_clkgen_config(f, sys_clk_freq) for f in freqs]
+                ms = Array(C(m - 1, 8) for m, d in configs)
+                ds = Array(C(d - 1, 8) for m, d in configs)
+                current = Signal(max=max(len(freqs), 2))
+                programmed = Signal()
+
+                self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+                fsm.act("IDLE",
+                    If(~programmed | (self.sel != current),
+                        NextValue(programmed, 0),
+                        NextValue(current, self.sel),
+                        NextState("SEND_D")
+                    )
+                )
+                fsm.act("SEND_D",
+                    send_cmd_data.eq(1),
+                    cmd_data.eq(Cat(C(0x1, 2), ds[current])),
+                    NextState("WAIT_D")
+                )
+                fsm.act("WAIT_D",
+                    If(~busy,
+                        NextState("SEND_M")
+                    )
+                )
+                fsm.act("SEND_M",
+                    send_cmd_data.eq(1),
+                    cmd_data.eq(Cat(C(0x3, 2), ms[current])),
+                    NextState("WAIT_M")
+                )
+                fsm.act("WAIT_M",
+                    If(~busy,
+                        NextState("GO")
+                    )
+                )
+                fsm.act("GO",
+                    send_go.eq(1),
+                    NextState("WAIT_START")
+                )
+                fsm.act("WAIT_START",
+                    If(~sd_progdone,
+                        NextState("WAIT_DONE")
+                    )
+                )
+                fsm.act("WAIT_DONE",
+                    If(sd_progdone & sd_locked,
+                        NextValue(programmed, 1),
+                        NextState("IDLE")
+                    )
+                )
+
             self.specials += [
                 Instance("BUFG", i_I=clk_sd_unbuffered, o_O=self.cd_sd.clk),
                 AsyncResetSynchronizer(self.cd_sd, ~sd_locked)
@@ -90,7 +195,14 @@ class SDClockerS6(Module, AutoCSR):
 
 
 class SDClockerS7(Module, AutoCSR):
-    def __init__(self, sys_clk_freq=100e6):
+    """Programmable sd clock (MMCME2_ADV)
+
+    The frequency is programmed through the DRP CSRs. When freqs is given,
+    the clocker also programs freqs[sel] in hardware (CLKFBOUT_MULT,
+    DIVCLK_DIVIDE and CLKOUT0_DIVIDE, MMCM held in reset) at reset and on
+    each sel change (e.g. sel driven by SDInitializer.clk_sel).
+    """
+    def __init__(self, sys_clk_freq=100e6, freqs=None):
         self.clock_domains.cd_sd = ClockDomain()
         self.clock_domains.cd_sd_fb = ClockDomain()
 
@@ -109,10 +221,23 @@ class SDClockerS7(Module, AutoCSR):
         mmcm_clk0 = Signal()
         mmcm_drdy = Signal()
 
+        mmcm_reset = Signal()
+        mmcm_read = Signal()
+        mmcm_write = Signal()
+        mmcm_adr = Signal(7)
+        mmcm_dat_w = Signal(16)
+        self.comb += [
+            mmcm_reset.eq(self._mmcm_reset.storage),
+            mmcm_read.eq(self._mmcm_read.re),
+            mmcm_write.eq(self._mmcm_write.re),
+            mmcm_adr.eq(self._mmcm_adr.storage),
+            mmcm_dat_w.eq(self._mmcm_dat_w.storage)
+        ]
+
         self.specials += [
             Instance("MMCME2_ADV",
                 p_BANDWIDTH="OPTIMIZED",
-                i_RST=self._mmcm_reset.storage, o_LOCKED=mmcm_locked,
+                i_RST=mmcm_reset, o_LOCKED=mmcm_locked,
 
                 # VCO
                 p_REF_JITTER1=0.01, p_CLKIN1_PERIOD=1e9/sys_clk_freq,
@@ -124,11 +249,11 @@ class SDClockerS7(Module, AutoCSR):
 
                 # DRP
                 i_DCLK=ClockSignal(),
-                i_DWE=self._mmcm_write.re,
-                i_DEN=self._mmcm_read.re | self._mmcm_write.re,
+                i_DWE=mmcm_write,
+                i_DEN=mmcm_read | mmcm_write,
                 o_DRDY=mmcm_drdy,
-                i_DADDR=self._mmcm_adr.storage,
-                i_DI=self._mmcm_dat_w.storage,
+                i_DADDR=mmcm_adr,
+                i_DI=mmcm_dat_w,
                 o_DO=self._mmcm_dat_r.status
             ),
             Instance("BUFG", i_I=mmcm_clk0, o_O=self.cd_sd.clk),
@@ -141,3 +266,53 @@ class SDClockerS7(Module, AutoCSR):
             )
         ]
         self.comb += self.cd_sd.rst.eq(~mmcm_locked)
+
+        # hardware programming of the preset frequencies (same registers
+        # and encoding as the firmware)
+        if freqs is not None:
+            self.sel = Signal(max=max(len(freqs), 2))
+            configs = [_mmcm_config(f, sys_clk_freq) for f in freqs]
+            writes = [
+                (0x14, Array(C(0x1000 | _mmcm_div(m), 16) for m, d, o in configs)),
+                (0x16, Array(C(_mmcm_div(d), 16) for m, d, o in configs)),
+                (0x08, Array(C(0x1000 | _mmcm_div(o), 16) for m, d, o in configs))
+            ]
+            current = Signal(max=max(len(freqs), 2))
+            programmed = Signal()
+            index = Signal(max=len(writes))
+
+            self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+            fsm.act("IDLE",
+                If(~programmed | (self.sel != current),
+                    NextValue(programmed, 0),
+                    NextValue(current, self.sel),
+                    NextValue(index, 0),
+                    NextState("WRITE")
+                )
+            )
+            fsm.act("WRITE",
+                mmcm_reset.eq(1),
+                mmcm_write.eq(1),
+                Case(index, {i: [
+                    mmcm_adr.eq(adr),
+                    mmcm_dat_w.eq(values[current])
+                ] for i, (adr, values) in enumerate(writes)}),
+                NextState("WAIT")
+            )
+            fsm.act("WAIT",
+                mmcm_reset.eq(1),
+                If(mmcm_drdy,
+                    NextValue(index, index + 1),
+                    If(index == (len(writes) - 1),
+                        NextState("LOCK")
+                    ).Else(
+                        NextState("WRITE")
+                    )
+                )
+            )
+            fsm.act("LOCK",
+                If(mmcm_locked,
+                    NextValue(programmed, 1),
+                    NextState("IDLE")
+                )
+            )
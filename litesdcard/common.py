@@ -2,6 +2,8 @@ SD_OK         = 0
 SD_CRCERROR   = 1
 SD_TIMEOUT    = 2
 SD_WRITEERROR = 3
+SD_BUSWIDTHERROR = 4
+SD_SWITCHERROR   = 5
 
 SD_SWITCH_CHECK  = 0
 SD_SWITCH_SWITCH = 1
@@ -36,9 +38,99 @@ SDCARD_CTRL_RESPONSE_NONE  = 0
 SDCARD_CTRL_RESPONSE_SHORT = 1
 SDCARD_CTRL_RESPONSE_LONG  = 2
 
+SDCARD_EV_CMDDONE    = (1 << 0)
+SDCARD_EV_DATADONE   = (1 << 1)
+SDCARD_EV_CRCERROR   = (1 << 2)
+SDCARD_EV_TIMEOUT    = (1 << 3)
+SDCARD_EV_WRITEERROR = (1 << 4)
+SDCARD_EV_CARDREADY  = (1 << 5)
+SDCARD_EV_CMDQOVERFLOW = (1 << 6)
+
+SDCARD_CMDEVT_CARDERROR  = (1 << 4)
+SDCARD_CMDEVT_CHECKERROR = (1 << 5)
+
+SDCARD_CARDSTATUS_ERRORS      = 0x00001fbf
+SDCARD_CARDSTATUS_LOCKED      = (1 << 6)
+SDCARD_CARDSTATUS_STATE_SHIFT = 13
+SDCARD_CARDSTATUS_READY       = (1 << 17)
+SDCARD_CARDSTATUS_APPCMD      = (1 << 18)
+SDCARD_CARDSTATUS_ECHO_SHIFT  = 20
+
+SDCARD_TRACE_CMD         = (1 << 0)
+SDCARD_TRACE_RESPONSE    = (1 << 1)
+SDCARD_TRACE_BLOCKSTART  = (1 << 2)
+SDCARD_TRACE_BLOCKEND    = (1 << 3)
+SDCARD_TRACE_CRCVALID    = (1 << 4)
+SDCARD_TRACE_CRCERROR    = (1 << 5)
+SDCARD_TRACE_BUSYRELEASE = (1 << 6)
+SDCARD_TRACE_DONE        = (1 << 7)
+
+SDCARD_CTRL_AUTOCMD_NONE  = 0b00
+SDCARD_CTRL_AUTOCMD_CMD23 = 0b01
+SDCARD_CTRL_AUTOCMD_CMD12 = 0b10
+
 SDCARD_TUNING_BLOCK = [
     0xff0fff00, 0xffccc3cc, 0xc33cccff, 0xfefffeef,
     0xffdfffdd, 0xfffbfffb, 0xbfff7fff, 0x77f7bdef,
     0xfff0fff0, 0x0ffccc3c, 0xcc33cccf, 0xffefffee,
     0xfffdfffd, 0xdfffbfff, 0xbbfff7ff, 0xf77f7bde,
-]
\ No newline at end of file
+]
+
+SDCARD_TUNING_BLOCK_8BIT = [
+    0xffff00ff, 0xffff0000, 0xffffcccc, 0xcc33cccc,
+    0xcc3333cc, 0xccccffff, 0xffeeffff, 0xffeeeeff,
+    0xffffddff, 0xffffdddd, 0xffffffbb, 0xffffffbb,
+    0xbbffffff, 0x77ffffff, 0x7777ff77, 0xbbddeeff,
+    0xffffff00, 0xffffff00, 0x00ffffcc, 0xcccc33cc,
+    0xcccc3333, 0xccccccff, 0xffffeeff, 0xffffeeee,
+    0xffffffdd, 0xffffffdd, 0xddffffff, 0xbbffffff,
+    0xbbbbffff, 0xff77ffff, 0xff7777ff, 0x77bbddee,
+]
+
+EMMC_EXT_CSD_BUS_WIDTH   = 183
+EMMC_EXT_CSD_HS_TIMING   = 185
+EMMC_EXT_CSD_DEVICE_TYPE = 196
+
+EMMC_BUS_WIDTH_1 = 0
+EMMC_BUS_WIDTH_4 = 1
+EMMC_BUS_WIDTH_8 = 2
+
+# card status bit of a rejected SWITCH (R1 of the next CMD13)
+EMMC_STATUS_SWITCH_ERROR = (1 << 7)
+
+EMMC_HS_TIMING_LEGACY = 0
+EMMC_HS_TIMING_HS     = 1
+EMMC_HS_TIMING_HS200  = 2
+
+EMMC_DEVICE_TYPE_HS_26       = (1 << 0)
+EMMC_DEVICE_TYPE_HS_52       = (1 << 1)
+EMMC_DEVICE_TYPE_HS200_1_8V  = (1 << 4)
+
+sdcore_cmd_layout = [
+    ("argument",   32),
+    ("command",    32),
+    ("blocksize",  16),
+    ("blockcount", 32)
+]
+
+sdcore_status_layout = [
+    ("cmdevt",    32),
+    ("dataevt",   32),
+    ("response", 120)
+]
+
+sdcore_metadata_layout = [
+    ("block", 32),
+    ("error",  1)
+]
+
+sdport_cmd_layout = [
+    ("write",  1),
+    ("lba",   32),
+    ("count", 32)
+]
+
+sdport_status_layout = [
+    ("error",     1),
+    ("requests", 16)
+]
@@ -1,21 +1,368 @@
+from functools import reduce
+from operator import or_
+
 from litex.gen import *
 from litex.gen.genlib.cdc import MultiReg, BusSynchronizer, PulseSynchronizer
 from litex.soc.interconnect import stream
+from litex.soc.interconnect import wishbone
 from litex.soc.interconnect.csr import *
+from litex.soc.interconnect.csr_eventmanager import *
 
 from litesdcard.common import *
 from litesdcard.crc import CRC, CRCChecker
 from litesdcard.crc import CRCDownstreamChecker, CRCUpstreamInserter
 
 
+class SDMailbox(Module):
+    """Status mailbox written from the sd domain and read over Wishbone
+
+    The mailbox is 8 words:
+        0: sequence
+        1: cmdevt[0:16] | dataevt[0:16] << 16
+        2-5: response[0:32], response[32:64], response[64:96], response[96:120]
+        6: blocks transferred by the current command
+        7: sequence (copy)
+
+    A snapshot is written on each update, word 7 first and word 0 last: a
+    burst read of the 8 words is consistent when words 0 and 7 are equal.
+    """
+    def __init__(self):
+        self.bus = bus = wishbone.Interface()
+        self.update = Signal()
+        self.cmdevt = Signal(32)
+        self.dataevt = Signal(32)
+        self.response = Signal(120)
+        self.blocks = Signal(32)
+
+        # # #
+
+        mem = Memory(32, 8)
+        wrport = mem.get_port(write_capable=True, clock_domain="sd")
+        rdport = mem.get_port()
+        self.specials += mem, wrport, rdport
+
+        # sd domain writer
+        seq = Signal(32)
+        evt = Signal(32)
+        response = Signal(120)
+        blocks = Signal(32)
+        pending = Signal()
+        busy = Signal()
+        cnt = Signal(3)
+
+        order = Array([7, 1, 2, 3, 4, 5, 6, 0])
+        words = Array([
+            seq,
+            evt,
+            response[0:32],
+            response[32:64],
+            response[64:96],
+            response[96:120],
+            blocks,
+            seq])
+
+        self.sync.sd += [
+            If(self.update,
+                pending.eq(1)
+            ),
+            If(~busy,
+                If(pending | self.update,
+                    pending.eq(0),
+                    busy.eq(1),
+                    cnt.eq(0),
+                    seq.eq(seq + 1),
+                    evt.eq(Cat(self.cmdevt[0:16], self.dataevt[0:16])),
+                    response.eq(self.response),
+                    blocks.eq(self.blocks)
+                )
+            ).Else(
+                cnt.eq(cnt + 1),
+                If(cnt == 7,
+                    busy.eq(0)
+                )
+            )
+        ]
+        self.comb += [
+            wrport.we.eq(busy),
+            wrport.adr.eq(order[cnt]),
+            wrport.dat_w.eq(words[cnt])
+        ]
+
+        # sys domain Wishbone reads (writes are acked and ignored)
+        self.comb += [
+            rdport.adr.eq(bus.adr[:3]),
+            bus.dat_r.eq(rdport.dat_r)
+        ]
+        self.sync += [
+            bus.ack.eq(0),
+            If(bus.cyc & bus.stb & ~bus.ack,
+                bus.ack.eq(1)
+            )
+        ]
+
+
+class SDCoreStats(Module, AutoCSR):
+    """Performance counters of SDCore
+
+    Counters run in the sd domain. Writing clear resets them, writing
+    snapshot latches all of them in the status CSRs. Both are done after a
+    few sd clock cycles, done is cleared by the request and set back once
+    it is done (to be waited for before the next request or reading the
+    latched counters).
+    """
+    def __init__(self):
+        # Events (sd domain)
+        self.cmd = Signal()
+        self.dataxfer = Signal(2)
+        self.blockread = Signal()
+        self.blockwrite = Signal()
+        self.blocksize = Signal(16)
+        self.crcerror = Signal()
+        self.timeout = Signal()
+        self.busy = Signal()
+        self.sinkstall = Signal()
+        self.sourcestall = Signal()
+
+        self.clear = CSR()
+        self.snapshot = CSR()
+        self.done = CSRStatus()
+
+        # # #
+
+        done = Signal(reset=1)
+        clear = PulseSynchronizer("sys", "sd")
+        snapshot = PulseSynchronizer("sys", "sd")
+        ack = PulseSynchronizer("sd", "sys")
+        self.submodules += clear, snapshot, ack
+        self.comb += [
+            clear.i.eq(self.clear.re),
+            snapshot.i.eq(self.snapshot.re),
+            ack.i.eq(clear.o | snapshot.o),
+            self.done.status.eq(done)
+        ]
+        self.sync += \
+            If(self.clear.re | self.snapshot.re,
+                done.eq(0)
+            ).Elif(ack.o,
+                done.eq(1)
+            )
+
+        counters = [
+            # name, width, increment
+            ("cmdsnone",      32, self.cmd & (self.dataxfer == SDCARD_CTRL_DATA_TRANSFER_NONE)),
+            ("cmdsread",      32, self.cmd & (self.dataxfer == SDCARD_CTRL_DATA_TRANSFER_READ)),
+            ("cmdswrite",     32, self.cmd & (self.dataxfer == SDCARD_CTRL_DATA_TRANSFER_WRITE)),
+            ("blocksread",    32, self.blockread),
+            ("blockswritten", 32, self.blockwrite),
+            ("bytesread",     64, Mux(self.blockread, self.blocksize, 0)),
+            ("byteswritten",  64, Mux(self.blockwrite, self.blocksize, 0)),
+            ("crcerrors",     32, self.crcerror),
+            ("timeouts",      32, self.timeout),
+            ("busycycles",    64, self.busy),
+            ("idlecycles",    64, self.busy == 0),
+            ("sinkstalls",    64, self.sinkstall),
+            ("sourcestalls",  64, self.sourcestall)
+        ]
+        for name, width, increment in counters:
+            counter = Signal(width)
+            latch = Signal(width)
+            csr = CSRStatus(width, name=name)
+            setattr(self, name, csr)
+            self.sync.sd += [
+                If(clear.o,
+                    counter.eq(0)
+                ).Else(
+                    counter.eq(counter + increment)
+                ),
+                If(snapshot.o,
+                    latch.eq(counter)
+                )
+            ]
+            self.comb += csr.status.eq(latch)
+
+
+class SDTrace(Module, AutoCSR):
+    """Timestamped trace of SDCore/SDPHY events
+
+    Each record is 64 bits:
+        [0:32]  timestamp (sd clock cycles)
+        [32:40] events (see SDCARD_TRACE_*)
+        [40:46] command index
+        [46:48] data transfer type
+        [48:64] block number
+
+    Records are written (when enable is set) on the cycles with at least one
+    event and are read through the record/next CSRs. Records lost because
+    the FIFO is full are counted in dropped.
+    """
+    def __init__(self, depth=512):
+        # Events (sd domain)
+        self.events = Signal(8)
+        self.cmdindex = Signal(6)
+        self.dataxfer = Signal(2)
+        self.block = Signal(16)
+
+        self.enable = CSRStorage()
+        self.valid = CSRStatus()
+        self.record = CSRStatus(64)
+        self.next = CSR()
+        self.dropped = CSRStatus(32)
+
+        # # #
+
+        enable = Signal()
+        timestamp = Signal(32)
+        dropped = Signal(32)
+        self.specials += MultiReg(self.enable.storage, enable, "sd")
+
+        self.submodules.fifo = fifo = ClockDomainsRenamer({"write": "sd", "read": "sys"})(
+            stream.AsyncFIFO([("data", 64)], depth))
+        dropped_cdc = BusSynchronizer(32, "sd", "sys")
+        self.submodules += dropped_cdc
+
+        self.sync.sd += [
+            timestamp.eq(timestamp + 1),
+            If(fifo.sink.valid & ~fifo.sink.ready,
+                dropped.eq(dropped + 1)
+            )
+        ]
+        self.comb += [
+            fifo.sink.valid.eq(enable & (self.events != 0)),
+            fifo.sink.data.eq(Cat(
+                timestamp,
+                self.events,
+                self.cmdindex,
+                self.dataxfer,
+                self.block)),
+
+            self.valid.status.eq(fifo.source.valid),
+            self.record.status.eq(fifo.source.data),
+            fifo.source.ready.eq(self.next.re),
+            dropped_cdc.i.eq(dropped),
+            self.dropped.status.eq(dropped_cdc.o)
+        ]
+
+
+class SDBlockBuffer(Module):
+    """Store-and-forward buffer of blocks
+
+    The words of a block are only visible on source once the last word of
+    the block is written with commit set, the block is dropped otherwise.
+    depth (words, power of 2) must hold at least one block.
+    """
+    def __init__(self, description, depth=256):
+        self.sink = sink = stream.Endpoint(description)
+        self.source = source = stream.Endpoint(description)
+        self.commit = Signal()
+
+        # # #
+
+        aw = log2_int(depth)
+        wr = Signal(aw + 1)
+        wrc = Signal(aw + 1)
+        wrc_d = Signal(aw + 1)
+        rd = Signal(aw + 1)
+        rd_next = Signal(aw + 1)
+        level = Signal(aw + 1)
+
+        mem = Memory(len(sink.payload) + 2, depth)
+        wrport = mem.get_port(write_capable=True)
+        rdport = mem.get_port()
+        self.specials += mem, wrport, rdport
+
+        self.comb += [
+            level.eq(wr - rd),
+            sink.ready.eq(level != depth),
+            wrport.adr.eq(wr[:aw]),
+            wrport.dat_w.eq(Cat(sink.payload.raw_bits(), sink.first, sink.last)),
+            wrport.we.eq(sink.valid & sink.ready),
+
+            # Committed words are read one cycle after their commit
+            source.valid.eq(rd != wrc_d),
+            rd_next.eq(rd + (source.valid & source.ready)),
+            rdport.adr.eq(rd_next[:aw]),
+            Cat(source.payload.raw_bits(), source.first, source.last).eq(rdport.dat_r)
+        ]
+        self.sync += [
+            rd.eq(rd_next),
+            wrc_d.eq(wrc),
+            If(sink.valid & sink.ready,
+                If(sink.last,
+                    If(self.commit,
+                        wr.eq(wr + 1),
+                        wrc.eq(wr + 1)
+                    ).Else(
+                        wr.eq(wrc)
+                    )
+                ).Else(
+                    wr.eq(wr + 1)
+                )
+            )
+        ]
+
+
+class SDCorePort:
+    """Command/data port of a hardware frontend on SDCore (see SDCore.get_port)
+
+    Same endpoints and flushes as SDCore, lock keeps the commands grant on
+    the port between its commands (command sequences).
+    """
+    def __init__(self, sink_description, source_description):
+        self.cmd_sink = stream.Endpoint(sdcore_cmd_layout)
+        self.cmd_source = stream.Endpoint(sdcore_status_layout)
+        self.sink = stream.Endpoint(sink_description)
+        self.source = stream.Endpoint(source_description)
+        self.flush = Signal()
+        self.source_flush = Signal()
+        self.lock = Signal()
+
+
 class SDCore(Module, AutoCSR):
-    def __init__(self, phy):
-        self.sink = stream.Endpoint([("data", 32)])
-        self.source = stream.Endpoint([("data", 32)])
+    def __init__(self, phy, cmd_queue_depth=4, result_queue_depth=4,
+                 upstream_fifo_depth=0, downstream_fifo_depth=0, with_stats=False,
+                 with_trace=False, trace_depth=512, with_metadata=False,
+                 with_store_and_forward=False, store_and_forward_depth=256,
+                 data_width=32):
+        assert data_width in [32, 64, 128]
+        # Streams of data_width bits (converted to the 8 bits of the PHY in
+        # the sd domain, the sys domain only sees full width words). The
+        # DMAs, BIST and descriptor frontends are 32 bits.
+        self.sink = stream.Endpoint([("data", data_width)])
+        # Optional per-block metadata on source: first set on the first beat
+        # of the block, block (LBA with block addressing) and CRC error on
+        # the last beat
+        self.source = stream.Endpoint([("data", data_width)] +
+            (sdcore_metadata_layout if with_metadata else []))
+
+        # Command port, alternative to the CSRs for hardware frontends
+        self.cmd_sink = stream.Endpoint(sdcore_cmd_layout)
+        self.cmd_source = stream.Endpoint(sdcore_status_layout)
+        # Flush (sys pulse, hardware frontends): the write data buffered in
+        # the upstream path (sink FIFO, CDC, converter and CRC inserter) is
+        # dropped, sink is not ready until the flush is done. To be used with
+        # the reset of the producer after a failed write.
+        self.flush = Signal()
+        # Source flush (sys pulse, hardware frontends): the read data left in
+        # the downstream path (converter, block buffer, CDC and source FIFO)
+        # is dropped, source is not valid and no new command is started until
+        # the flush is done. To be used after a failed read.
+        self.source_flush = Signal()
+
+        # Frontend ports (get_port) muxed with the endpoints above on the
+        # internal ones in do_finalize
+        self._ports = []
+        self._cmd_sink = stream.Endpoint(sdcore_cmd_layout)
+        self._cmd_source = stream.Endpoint(sdcore_status_layout)
+        self._sink = stream.Endpoint(self.sink.description)
+        self._source = stream.Endpoint(self.source.description)
+        self._flush = Signal()
+        self._source_flush = Signal()
 
         self.argument = CSRStorage(32)
         self.command = CSRStorage(32)
         self.response = CSRStatus(120)
+        self.cardstatus = CSRStatus(32)
+        self.rca = CSRStatus(16)
 
         self.cmdevt = CSRStatus(32)
         self.dataevt = CSRStatus(32)
@@ -26,49 +373,156 @@ class SDCore(Module, AutoCSR):
         self.datatimeout = CSRStorage(32, reset=2**16)
         self.cmdtimeout = CSRStorage(32, reset=2**16)
 
+        self.autocmd = CSRStorage(2)
+
+        self.autopoll = CSRStorage()
+        self.pollinterval = CSRStorage(32, reset=2**12)
+        self.pollmax = CSRStorage(32, reset=2**16)
+
+        self.maxretry = CSRStorage(8)
+        self.retrycount = CSRStatus(32)
+
+        # eMMC device: CMD3 response is R1 (RCA set from the argument), CMD1
+        # response (R3) is not decoded
+        self.emmc = CSRStorage()
+
+        self.abort = CSR()
+        self.blocks = CSRStatus(32)
+
         self.datawcrcclear = CSRStorage()
         self.datawcrcvalids = CSRStatus(32)
         self.datawcrcerrors = CSRStatus(32)
 
+        self.fifolevelclear = CSR()
+        self.upstreamlevelmax = CSRStatus(16)
+        self.downstreamlevelmax = CSRStatus(16)
+
+        # Queued commands (result pushed to the result queue), command is
+        # written as with the command CSR
+        self.qcommand = CSRStorage(32)
+        self.cmdqready = CSRStatus()
+        self.resultvalid = CSRStatus()
+        self.resultevt = CSRStatus(32)
+        self.resultresponse = CSRStatus(32)
+        self.resultnext = CSR()
+
+        self.submodules.ev = EventManager()
+        self.ev.cmddone = EventSourcePulse()
+        self.ev.datadone = EventSourcePulse()
+        self.ev.crcerror = EventSourcePulse()
+        self.ev.timeout = EventSourcePulse()
+        self.ev.writeerror = EventSourcePulse()
+        self.ev.cardready = EventSourcePulse()
+        self.ev.cmdqoverflow = EventSourcePulse()
+        self.ev.finalize()
+
         # # #
 
         argument = Signal(32)
         command = Signal(32)
         response = Signal(120)
+        cardstatus = Signal(32)
+        rca = Signal(16)
         cmdevt = Signal(32)
         dataevt = Signal(32)
         blocksize = Signal(16)
         blockcount = Signal(32)
         datatimeout = Signal(32)
         cmdtimeout = Signal(32)
+        autocmd = Signal(2)
+        autopoll = Signal()
+        pollinterval = Signal(32)
+        pollmax = Signal(32)
+        maxretry = Signal(8)
+        retrycount = Signal(32)
+        emmc = Signal()
+        blocks = Signal(32)
 
         # sys to sd cdc
         self.specials += [
-            MultiReg(self.argument.storage, argument, "sd"),
-            MultiReg(self.command.storage, command, "sd"),
-            MultiReg(self.blocksize.storage, blocksize, "sd"),
-            MultiReg(self.blockcount.storage, blockcount, "sd"),
             MultiReg(self.datatimeout.storage, datatimeout, "sd"),
-            MultiReg(self.cmdtimeout.storage, cmdtimeout, "sd")
+            MultiReg(self.cmdtimeout.storage, cmdtimeout, "sd"),
+            MultiReg(self.autocmd.storage, autocmd, "sd"),
+            MultiReg(self.autopoll.storage, autopoll, "sd"),
+            MultiReg(self.pollinterval.storage, pollinterval, "sd"),
+            MultiReg(self.pollmax.storage, pollmax, "sd"),
+            MultiReg(self.maxretry.storage, maxretry, "sd"),
+            MultiReg(self.emmc.storage, emmc, "sd")
         ]
 
-        # sd to sys cdc
+        # Command queue, filled through the CSRs or from cmd_sink and drained
+        # back-to-back by the FSM. Status of commands received on cmd_sink is
+        # returned on cmd_source, the one of commands written through qcommand
+        # goes to the result queue (commands written through command are only
+        # reported in the status CSRs). A command written while the queue is
+        # full (cmdqready cleared) is dropped and raises cmdqoverflow.
+        self.submodules.cmd_cdc = ClockDomainsRenamer({"write": "sys", "read": "sd"})(
+            stream.AsyncFIFO(sdcore_cmd_layout + [("notify", 1), ("result", 1)], cmd_queue_depth))
+        self.submodules.status_cdc = ClockDomainsRenamer({"write": "sd", "read": "sys"})(
+            stream.AsyncFIFO(sdcore_status_layout, 4))
+        self.submodules.result_cdc = ClockDomainsRenamer({"write": "sd", "read": "sys"})(
+            stream.AsyncFIFO(sdcore_status_layout, result_queue_depth))
+        self.comb += [
+            If(self.command.re | self.qcommand.re,
+                self.cmd_cdc.sink.valid.eq(1),
+                self.cmd_cdc.sink.argument.eq(self.argument.storage),
+                If(self.qcommand.re,
+                    self.cmd_cdc.sink.command.eq(self.qcommand.storage)
+                ).Else(
+                    self.cmd_cdc.sink.command.eq(self.command.storage)
+                ),
+                self.cmd_cdc.sink.blocksize.eq(self.blocksize.storage),
+                self.cmd_cdc.sink.blockcount.eq(self.blockcount.storage),
+                self.cmd_cdc.sink.notify.eq(0),
+                self.cmd_cdc.sink.result.eq(self.qcommand.re)
+            ).Else(
+                self._cmd_sink.connect(self.cmd_cdc.sink),
+                self.cmd_cdc.sink.notify.eq(1),
+                self.cmd_cdc.sink.result.eq(0)
+            ),
+            self.ev.cmdqoverflow.trigger.eq((self.command.re | self.qcommand.re) &
+                ~self.cmd_cdc.sink.ready),
+            self.status_cdc.source.connect(self._cmd_source),
+
+            self.cmdqready.status.eq(self.cmd_cdc.sink.ready),
+            self.resultvalid.status.eq(self.result_cdc.source.valid),
+            self.resultevt.status.eq(Cat(
+                self.result_cdc.source.cmdevt[0:16],
+                self.result_cdc.source.dataevt[0:16])),
+            self.resultresponse.status.eq(self.result_cdc.source.response[0:32]),
+            self.result_cdc.source.ready.eq(self.resultnext.re)
+        ]
+
+        # sd to sys cdc (the mailbox provides a consistent snapshot of the
+        # command status in a single burst read)
+        self.submodules.mailbox = SDMailbox()
+
         response_cdc = BusSynchronizer(120, "sd", "sys")
         cmdevt_cdc = BusSynchronizer(32, "sd", "sys")
         dataevt_cdc = BusSynchronizer(32, "sd", "sys")
-        self.submodules += response_cdc, cmdevt_cdc, dataevt_cdc
+        retrycount_cdc = BusSynchronizer(32, "sd", "sys")
+        blocks_cdc = BusSynchronizer(32, "sd", "sys")
+        cardstatus_cdc = BusSynchronizer(32, "sd", "sys")
+        rca_cdc = BusSynchronizer(16, "sd", "sys")
+        self.submodules += response_cdc, cmdevt_cdc, dataevt_cdc, retrycount_cdc
+        self.submodules += cardstatus_cdc, rca_cdc, blocks_cdc
         self.comb += [
             response_cdc.i.eq(response),
             self.response.status.eq(response_cdc.o),
             cmdevt_cdc.i.eq(cmdevt),
             self.cmdevt.status.eq(cmdevt_cdc.o),
             dataevt_cdc.i.eq(dataevt),
-            self.dataevt.status.eq(dataevt_cdc.o)
+            self.dataevt.status.eq(dataevt_cdc.o),
+            retrycount_cdc.i.eq(retrycount),
+            self.retrycount.status.eq(retrycount_cdc.o),
+            cardstatus_cdc.i.eq(cardstatus),
+            self.cardstatus.status.eq(cardstatus_cdc.o),
+            rca_cdc.i.eq(rca),
+            self.rca.status.eq(rca_cdc.o),
+            blocks_cdc.i.eq(blocks),
+            self.blocks.status.eq(blocks_cdc.o)
         ]
 
-        self.submodules.new_command = PulseSynchronizer("sys", "sd")
-        self.comb += self.new_command.i.eq(self.command.re)
-
         self.comb += [
             phy.cfg.blocksize.eq(blocksize),
             phy.cfg.datatimeout.eq(datatimeout),
@@ -80,27 +534,167 @@ class SDCore(Module, AutoCSR):
 
         self.submodules.crc7inserter = ClockDomainsRenamer("sd")(CRC(9, 7, 40))
         self.submodules.crc7checker = ClockDomainsRenamer("sd")(CRCChecker(9, 7, 120))
-        self.submodules.crc16inserter = ClockDomainsRenamer("sd")(CRCUpstreamInserter())
-        self.submodules.crc16checker = ClockDomainsRenamer("sd")(CRCDownstreamChecker())
+        self.submodules.crc16inserter = ResetInserter()(ClockDomainsRenamer("sd")(
+            CRCUpstreamInserter(phy.data_width)))
+        self.submodules.crc16checker = ClockDomainsRenamer("sd")(CRCDownstreamChecker(phy.data_width))
+        self.comb += [
+            self.crc16inserter.ddr.eq(phy.cfg.ddr),
+            self.crc16checker.ddr.eq(phy.cfg.ddr)
+        ]
 
         self.submodules.upstream_cdc = ClockDomainsRenamer({"write": "sys", "read": "sd"})(
             stream.AsyncFIFO(self.sink.description, 4))
         self.submodules.downstream_cdc = ClockDomainsRenamer({"write": "sd", "read": "sys"})(
             stream.AsyncFIFO(self.source.description, 4))
 
-        self.submodules.upstream_converter = ClockDomainsRenamer("sd")(
-            stream.StrideConverter([('data', 32)], [('data', 8)], reverse=True))
-        self.submodules.downstream_converter = ClockDomainsRenamer("sd")(
-            stream.StrideConverter([('data', 8)], [('data', 32)], reverse=True))
+        self.submodules.upstream_converter = ResetInserter()(ClockDomainsRenamer("sd")(
+            stream.StrideConverter([('data', data_width)], [('data', 8)], reverse=True)))
+        self.submodules.downstream_converter = ResetInserter()(ClockDomainsRenamer("sd")(
+            stream.StrideConverter([('data', 8)], [('data', data_width)], reverse=True)))
+
+        # Optional elastic buffers on the sys side absorbing the latency of
+        # the sink producer / source consumer (depths in data_width words, no
+        # buffer with 0).
+        upstream = self._sink
+        upstream_level = Signal(16)
+        if upstream_fifo_depth:
+            self.submodules.upstream_fifo = ResetInserter()(stream.SyncFIFO(
+                self.sink.description, upstream_fifo_depth, buffered=True))
+            self.comb += [
+                self._sink.connect(self.upstream_fifo.sink),
+                upstream_level.eq(self.upstream_fifo.fifo.level)
+            ]
+            upstream = self.upstream_fifo.source
+        downstream = self._source
+        downstream_level = Signal(16)
+        if downstream_fifo_depth:
+            self.submodules.downstream_fifo = ResetInserter()(stream.SyncFIFO(
+                self.source.description, downstream_fifo_depth, buffered=True))
+            self.comb += [
+                self.downstream_fifo.source.connect(self._source),
+                downstream_level.eq(self.downstream_fifo.fifo.level)
+            ]
+            downstream = self.downstream_fifo.sink
 
         self.comb += [
-            self.sink.connect(self.upstream_cdc.sink),
+            upstream.connect(self.upstream_cdc.sink),
             self.upstream_cdc.source.connect(self.upstream_converter.sink),
             self.upstream_converter.source.connect(self.crc16inserter.sink),
 
             self.crc16checker.source.connect(self.downstream_converter.sink),
-            self.downstream_converter.source.connect(self.downstream_cdc.sink),
-            self.downstream_cdc.source.connect(self.source)
+            self.downstream_cdc.source.connect(downstream)
+        ]
+        if not (with_metadata or with_store_and_forward):
+            self.comb += self.downstream_converter.source.connect(self.downstream_cdc.sink)
+
+        # Upstream flush: the sys FIFO is reset, the CDC is drained in the sd
+        # domain (until empty for 16 cycles) with the converter and the CRC
+        # inserter held in reset
+        upstream_flush = Signal()
+        flushing = Signal()
+        flushidle = Signal(4)
+        flush_start = PulseSynchronizer("sys", "sd")
+        flush_done = PulseSynchronizer("sd", "sys")
+        self.submodules += flush_start, flush_done
+        self.comb += [
+            flush_start.i.eq(self._flush),
+            flush_done.i.eq(flushing & (flushidle == 15)),
+            If(upstream_flush,
+                self._sink.ready.eq(0),
+                self.upstream_cdc.sink.valid.eq(0)
+            ),
+            self.upstream_converter.reset.eq(flushing),
+            self.crc16inserter.reset.eq(flushing),
+            If(flushing,
+                self.upstream_cdc.source.ready.eq(1),
+                self.upstream_converter.sink.valid.eq(0)
+            )
+        ]
+        self.sync += \
+            If(self._flush,
+                upstream_flush.eq(1)
+            ).Elif(flush_done.o,
+                upstream_flush.eq(0)
+            )
+        self.sync.sd += \
+            If(flush_start.o,
+                flushing.eq(1),
+                flushidle.eq(0)
+            ).Elif(flushing,
+                If(self.upstream_cdc.source.valid,
+                    flushidle.eq(0)
+                ).Else(
+                    flushidle.eq(flushidle + 1)
+                ),
+                If(flushidle == 15,
+                    flushing.eq(0)
+                )
+            )
+
+        # Source flush: the converter (and block buffer) are held in reset in
+        # the sd domain until no read data comes from the CRC checker for 16
+        # cycles, the CDC is drained and the FIFO reset in the sys domain
+        source_flushing = Signal()
+        dflushing = Signal()
+        dflushidle = Signal(4)
+        dflush_start = PulseSynchronizer("sys", "sd")
+        dflush_done = PulseSynchronizer("sd", "sys")
+        self.submodules += dflush_start, dflush_done
+        self.comb += [
+            dflush_start.i.eq(self._source_flush),
+            dflush_done.i.eq(dflushing & (dflushidle == 15)),
+            If(self._source_flush | source_flushing,
+                self.downstream_cdc.source.ready.eq(1),
+                downstream.valid.eq(0),
+                self._source.valid.eq(0)
+            ),
+            self.downstream_converter.reset.eq(dflushing)
+        ]
+        self.sync += \
+            If(self._source_flush,
+                source_flushing.eq(1)
+            ).Elif(dflush_done.o,
+                source_flushing.eq(0)
+            )
+        self.sync.sd += \
+            If(dflush_start.o,
+                dflushing.eq(1),
+                dflushidle.eq(0)
+            ).Elif(dflushing,
+                If(self.crc16checker.source.valid,
+                    dflushidle.eq(0)
+                ).Else(
+                    dflushidle.eq(dflushidle + 1)
+                ),
+                If(dflushidle == 15,
+                    dflushing.eq(0)
+                )
+            )
+
+        if upstream_fifo_depth:
+            self.comb += self.upstream_fifo.reset.eq(self._flush | upstream_flush)
+        if downstream_fifo_depth:
+            self.comb += self.downstream_fifo.reset.eq(self._source_flush | source_flushing)
+
+        # High-water marks
+        upstreamlevelmax = Signal(16)
+        downstreamlevelmax = Signal(16)
+        self.sync += [
+            If(self.fifolevelclear.re,
+                upstreamlevelmax.eq(0),
+                downstreamlevelmax.eq(0)
+            ).Else(
+                If(upstream_level > upstreamlevelmax,
+                    upstreamlevelmax.eq(upstream_level)
+                ),
+                If(downstream_level > downstreamlevelmax,
+                    downstreamlevelmax.eq(downstream_level)
+                )
+            )
+        ]
+        self.comb += [
+            self.upstreamlevelmax.status.eq(upstreamlevelmax),
+            self.downstreamlevelmax.status.eq(downstreamlevelmax)
         ]
 
         self.submodules.fsm = fsm = ClockDomainsRenamer("sd")(FSM())
@@ -112,42 +706,243 @@ class SDCore(Module, AutoCSR):
         datadone = Signal(reset=1)
         blkcnt = Signal(32)
         pos = Signal(2)
+        notify = Signal()
+        result = Signal()
+        pending = Signal()
+
+        # Auto CMD23/CMD12: multiple block transfers can be preceded by a
+        # SET_BLOCK_COUNT or followed by a STOP_TRANSMISSION sent by the FSM
+        cmdindex = Signal(6)
+        cmdargument = Signal(32)
+        multiblock = Signal()
+        autocmd23 = Signal()
+        autocmd12 = Signal()
+        stage = Signal(2)
+        STAGE_CMD, STAGE_CMD23, STAGE_CMD12, STAGE_CMD13 = range(4)
+        cmdok = Signal()
+
+        # Auto polling: after a write ending in the tran state (CMD24, CMD25
+        # with SET_BLOCK_COUNT or STOP_TRANSMISSION), SEND_STATUS is sent
+        # every pollinterval cycles until the card is back in the tran state
+        # and ready for data, then cardready is raised. The card still busy
+        # after pollmax SEND_STATUS is reported as a data timeout.
+        pollstart = Signal()
+        pollready = Signal()
+        pollcnt = Signal(32)
+        polls = Signal(32)
+
+        blockdone = Signal()
+
+        # Retries: commands failing with a response timeout (or a response
+        # CRC error when no data is transferred) are sent again, but for the
+        # application commands (the CMD55 is not sent again) and the eMMC CMD1
+        # (R3 response, no CRC). With the store and forward buffer, CMD17/CMD18
+        # reads are restarted from the block with a CRC error when the card
+        # uses block addressing (CCS in the OCR of the ACMD41/CMD1 response).
+        # Retries are limited to maxretry per command.
+        retries = Signal(8)
+        cmdretry = Signal()
+        appcmd = Signal()
+        blockaddr = Signal()
+        readblock = Signal()
+        restart = Signal()
+
+        # Abort: a multiple blocks transfer is stopped at the next block
+        # boundary, pending write data is flushed and STOP_TRANSMISSION is
+        # sent. The number of completed blocks is reported in blocks.
+        abort = PulseSynchronizer("sys", "sd")
+        self.submodules += abort
+        self.comb += abort.i.eq(self.abort.re)
+        abortreq = Signal()
+        abortblk = Signal()
+        aborted = Signal()
+
+        # Write data accepted by the CRC inserter for the current command
+        # (bytes of the current block and complete blocks): the data left of
+        # an aborted write is drained from the upstream path until all the
+        # blocks of the command are consumed (or no data is received for
+        # datatimeout cycles).
+        wrbytes = Signal(16)
+        wrblocks = Signal(32)
+        drainidle = Signal(32)
+
+        # Short responses decoding: R1/R1b card status (R6 status bits are
+        # remapped to their card status position) and R7 echo. R3 (ACMD41,
+        # eMMC CMD1) is not decoded.
+        r1 = Signal(32)
+        r1valid = Signal()
+        r7valid = Signal()
+        cerrcard = Signal()
+        cerrcheck = Signal()
 
         cerrtimeout = Signal()
         cerrcrc_en = Signal()
         derrtimeout = Signal()
         derrwrite = Signal()
-        derrread_en = Signal()
+        derrread = Signal()
+
+        # Interrupts: cmddone is raised when the response of the command is
+        # received, the other events when the command (with its data phase
+        # and auto commands) is reported.
+        cmddone_d = Signal()
+        report = Signal()
+        ev_cmddone = PulseSynchronizer("sd", "sys")
+        ev_datadone = PulseSynchronizer("sd", "sys")
+        ev_crcerror = PulseSynchronizer("sd", "sys")
+        ev_timeout = PulseSynchronizer("sd", "sys")
+        ev_writeerror = PulseSynchronizer("sd", "sys")
+        ev_cardready = PulseSynchronizer("sd", "sys")
+        self.submodules += ev_cmddone, ev_datadone, ev_crcerror, ev_timeout, ev_writeerror
+        self.submodules += ev_cardready
+        self.sync.sd += cmddone_d.eq(cmddone)
+        self.comb += [
+            ev_cmddone.i.eq(cmddone & ~cmddone_d & (stage == STAGE_CMD)),
+            ev_datadone.i.eq(report),
+            ev_crcerror.i.eq(report & (cmdevt[3] | dataevt[3])),
+            ev_timeout.i.eq(report & (cmdevt[2] | dataevt[2])),
+            ev_writeerror.i.eq(report & dataevt[1]),
+            ev_cardready.i.eq(report & (stage == STAGE_CMD13) & cmdok & pollready),
+            self.ev.cmddone.trigger.eq(ev_cmddone.o),
+            self.ev.datadone.trigger.eq(ev_datadone.o),
+            self.ev.crcerror.trigger.eq(ev_crcerror.o),
+            self.ev.timeout.trigger.eq(ev_timeout.o),
+            self.ev.writeerror.trigger.eq(ev_writeerror.o),
+            self.ev.cardready.trigger.eq(ev_cardready.o)
+        ]
+
+        self.sync.sd += \
+            If(abort.o,
+                abortreq.eq(1)
+            ).Elif(report | ~pending,
+                abortreq.eq(0)
+            )
+        self.comb += abortblk.eq(abortreq & (blkcnt < (blockcount - 1)) &
+            ((command[8:14] == 18) | (command[8:14] == 25)))
+
+        self.sync.sd += \
+            If(self.cmd_cdc.source.valid & self.cmd_cdc.source.ready,
+                wrbytes.eq(0),
+                wrblocks.eq(0)
+            ).Elif(self.upstream_converter.source.valid & self.upstream_converter.source.ready,
+                If(wrbytes == (blocksize - 1),
+                    wrbytes.eq(0),
+                    wrblocks.eq(wrblocks + 1)
+                ).Else(
+                    wrbytes.eq(wrbytes + 1)
+                )
+            )
 
         self.comb += [
-            waitresp.eq(command[0:2]),
-            dataxfer.eq(command[5:7]),
+            self.mailbox.update.eq((cmddone & ~cmddone_d) | blockdone | report),
+            self.mailbox.cmdevt.eq(cmdevt),
+            self.mailbox.dataevt.eq(dataevt),
+            self.mailbox.response.eq(response),
+            self.mailbox.blocks.eq(blocks + blockdone)
+        ]
+
+        self.comb += [
+            If(stage == STAGE_CMD23,
+                cmdindex.eq(23),
+                cmdargument.eq(blockcount),
+                waitresp.eq(SDCARD_CTRL_RESPONSE_SHORT),
+                dataxfer.eq(SDCARD_CTRL_DATA_TRANSFER_NONE)
+            ).Elif(stage == STAGE_CMD12,
+                cmdindex.eq(12),
+                cmdargument.eq(0),
+                waitresp.eq(SDCARD_CTRL_RESPONSE_SHORT),
+                dataxfer.eq(SDCARD_CTRL_DATA_TRANSFER_NONE)
+            ).Elif(stage == STAGE_CMD13,
+                cmdindex.eq(13),
+                cmdargument.eq(Cat(Replicate(0, 16), rca)),
+                waitresp.eq(SDCARD_CTRL_RESPONSE_SHORT),
+                dataxfer.eq(SDCARD_CTRL_DATA_TRANSFER_NONE)
+            ).Else(
+                cmdindex.eq(command[8:14]),
+                cmdargument.eq(argument),
+                waitresp.eq(command[0:2]),
+                dataxfer.eq(command[5:7])
+            ),
+            multiblock.eq(
+                (self.cmd_cdc.source.command[8:14] == 18) |
+                (self.cmd_cdc.source.command[8:14] == 25)),
+            cmdok.eq(~cmdevt[2] & ~cmdevt[3]),
+            cmdretry.eq(~(appcmd & (stage == STAGE_CMD)) &
+                ((cmdindex != 1) | ~emmc) &
+                (cmdevt[2] |
+                (cmdevt[3] & (dataxfer == SDCARD_CTRL_DATA_TRANSFER_NONE)))),
+            pollstart.eq(autopoll & cmdok &
+                (command[5:7] == SDCARD_CTRL_DATA_TRANSFER_WRITE) &
+                ((stage == STAGE_CMD12) |
+                 ((stage == STAGE_CMD) & ((command[8:14] == 24) | autocmd23)))),
+            pollready.eq((r1[9:13] == 4) & r1[8]), # tran and READY_FOR_DATA
+            If((cmdindex == 3) & ~emmc,
+                r1.eq(Cat(
+                    response[0:13],
+                    Replicate(0, 6),
+                    response[13],
+                    Replicate(0, 2),
+                    response[14],
+                    response[15],
+                    Replicate(0, 8)))
+            ).Else(
+                r1.eq(response[0:32])
+            ),
+            r1valid.eq(cmddone & ~cerrtimeout &
+                (waitresp == SDCARD_CTRL_RESPONSE_SHORT) &
+                ((cmdindex != 8) | (dataxfer != SDCARD_CTRL_DATA_TRANSFER_NONE)) &
+                (cmdindex != 41) &
+                ((cmdindex != 1) | ~emmc)),
+            r7valid.eq(cmddone & ~cerrtimeout &
+                (waitresp == SDCARD_CTRL_RESPONSE_SHORT) &
+                (cmdindex == 8) & (dataxfer == SDCARD_CTRL_DATA_TRANSFER_NONE)),
+            If(r1valid,
+                cardstatus.eq(Cat(
+                    r1[19:32], # OUT_OF_RANGE to ERROR
+                    r1[9:13],  # CURRENT_STATE
+                    r1[8],     # READY_FOR_DATA
+                    r1[5]))    # APP_CMD
+            ).Elif(r7valid,
+                cardstatus[20:32].eq(response[0:12]) # VHS and check pattern
+            ),
+            # All error bits but CARD_IS_LOCKED
+            cerrcard.eq(Cat(cardstatus[0:6], cardstatus[7:13]) != 0),
+            cerrcheck.eq(r7valid & (response[0:12] != cmdargument[0:12])),
             cmdevt.eq(Cat(
                 cmddone,
                 C(0, 1),
                 cerrtimeout,
-                cerrcrc_en & ~self.crc7checker.valid)),
+                cerrcrc_en & ~self.crc7checker.valid,
+                cerrcard,
+                cerrcheck)),
             dataevt.eq(Cat(
                 datadone,
                 derrwrite,
                 derrtimeout,
-                derrread_en & ~self.crc16checker.valid)),
+                derrread,
+                aborted)),
 
             self.crc7inserter.val.eq(Cat(
-                argument,
-                command[8:14],
+                cmdargument,
+                cmdindex,
                 1,
                 0)),
             self.crc7inserter.clr.eq(1),
             self.crc7inserter.enable.eq(1),
 
-            self.crc7checker.val.eq(response)
+            self.crc7checker.val.eq(response),
+
+            self.status_cdc.sink.cmdevt.eq(cmdevt),
+            self.status_cdc.sink.dataevt.eq(dataevt),
+            self.status_cdc.sink.response.eq(response),
+            self.result_cdc.sink.cmdevt.eq(cmdevt),
+            self.result_cdc.sink.dataevt.eq(dataevt),
+            self.result_cdc.sink.response.eq(response)
         ]
 
         ccases = {} # To send command and CRC
-        ccases[0] = phy.sink.data.eq(Cat(command[8:14], 1, 0))
+        ccases[0] = phy.sink.data.eq(Cat(cmdindex, 1, 0))
         for i in range(4):
-            ccases[i+1] = phy.sink.data.eq(argument[24-8*i:32-8*i])
+            ccases[i+1] = phy.sink.data.eq(cmdargument[24-8*i:32-8*i])
         ccases[5] = [
             phy.sink.data.eq(Cat(1, self.crc7inserter.crc)),
             phy.sink.last.eq(waitresp == SDCARD_CTRL_RESPONSE_NONE)
@@ -155,16 +950,101 @@ class SDCore(Module, AutoCSR):
 
         fsm.act("IDLE",
             NextValue(pos, 0),
-            If(self.new_command.o,
+            If(pending & restart,
+                # Restart the read from the failed block
+                NextValue(restart, 0),
+                If(autocmd23,
+                    NextValue(stage, STAGE_CMD23)
+                ).Else(
+                    NextValue(stage, STAGE_CMD)
+                ),
                 NextValue(cmddone, 0),
                 NextValue(cerrtimeout, 0),
                 NextValue(cerrcrc_en, 0),
                 NextValue(datadone, 0),
                 NextValue(derrtimeout, 0),
-                NextValue(derrwrite, 0),
-                NextValue(derrread_en, 0),
+                NextValue(derrread, 0),
+                NextValue(response, 0),
+                NextState("SEND_CMD")
+            ).Elif(pending & cmdretry & (retries < maxretry),
+                # Send the failed command again
+                NextValue(retries, retries + 1),
+                NextValue(retrycount, retrycount + 1),
+                NextValue(cmddone, 0),
+                NextValue(cerrtimeout, 0),
+                NextValue(cerrcrc_en, 0),
+                If((stage != STAGE_CMD12) & (stage != STAGE_CMD13),
+                    NextValue(datadone, 0)
+                ),
                 NextValue(response, 0),
                 NextState("SEND_CMD")
+            ).Elif(pending & (stage == STAGE_CMD23) & cmdok,
+                # SET_BLOCK_COUNT accepted, send the transfer command
+                NextValue(stage, STAGE_CMD),
+                NextValue(cmddone, 0),
+                NextValue(cerrtimeout, 0),
+                NextValue(cerrcrc_en, 0),
+                NextValue(datadone, 0),
+                NextValue(response, 0),
+                NextState("SEND_CMD")
+            ).Elif(pending & (stage == STAGE_CMD) & autocmd12 & cmdok,
+                # Transfer done, send STOP_TRANSMISSION (data status is kept)
+                NextValue(stage, STAGE_CMD12),
+                NextValue(cmddone, 0),
+                NextValue(cerrtimeout, 0),
+                NextValue(cerrcrc_en, 0),
+                NextValue(response, 0),
+                NextState("SEND_CMD")
+            ).Elif(pending & (stage == STAGE_CMD13) & cmdok & ~pollready & (polls < pollmax),
+                # Card still busy, poll again
+                NextValue(pollcnt, 0),
+                NextState("POLL_WAIT")
+            ).Elif(pending & (stage == STAGE_CMD13) & cmdok & ~pollready & ~derrtimeout,
+                # Card still busy after pollmax polls
+                NextValue(derrtimeout, 1)
+            ).Elif(pending & (stage != STAGE_CMD13) & pollstart,
+                # Write done, poll the card until it is ready
+                NextValue(stage, STAGE_CMD13),
+                NextValue(pollcnt, 0),
+                NextValue(polls, 0),
+                NextState("POLL_WAIT")
+            ).Else(
+                # Report status of the previous command
+                report.eq(pending),
+                self.status_cdc.sink.valid.eq(pending & notify),
+                self.result_cdc.sink.valid.eq(pending & result),
+                NextValue(pending, 0),
+                If(self.cmd_cdc.source.valid & ~flushing & ~dflushing,
+                    self.cmd_cdc.source.ready.eq(1),
+                    NextValue(argument, self.cmd_cdc.source.argument),
+                    NextValue(command, self.cmd_cdc.source.command),
+                    NextValue(blocksize, self.cmd_cdc.source.blocksize),
+                    NextValue(blockcount, self.cmd_cdc.source.blockcount),
+                    NextValue(notify, self.cmd_cdc.source.notify),
+                    NextValue(result, self.cmd_cdc.source.result),
+                    NextValue(appcmd, command[8:14] == 55),
+                    NextValue(pending, 1),
+                    If(multiblock & autocmd[0],
+                        NextValue(stage, STAGE_CMD23)
+                    ).Else(
+                        NextValue(stage, STAGE_CMD)
+                    ),
+                    NextValue(autocmd23, multiblock & autocmd[0]),
+                    NextValue(autocmd12, multiblock & ~autocmd[0] & autocmd[1]),
+                    NextValue(retries, 0),
+                    NextValue(restart, 0),
+                    NextValue(blocks, 0),
+                    NextValue(cmddone, 0),
+                    NextValue(cerrtimeout, 0),
+                    NextValue(cerrcrc_en, 0),
+                    NextValue(datadone, 0),
+                    NextValue(derrtimeout, 0),
+                    NextValue(derrwrite, 0),
+                    NextValue(derrread, 0),
+                    NextValue(aborted, 0),
+                    NextValue(response, 0),
+                    NextState("SEND_CMD")
+                )
             )
         )
 
@@ -211,8 +1091,18 @@ class SDCore(Module, AutoCSR):
                     # Check response CRC
                     NextValue(self.crc7checker.check, phy.source.data[1:8]),
                     NextValue(cmddone, 1),
+                    If(cmdindex == 3,
+                        If(emmc,
+                            NextValue(rca, cmdargument[16:32])
+                        ).Else(
+                            NextValue(rca, response[16:32])
+                        )
+                    ),
+                    # Addressing mode from the OCR once the card is ready
+                    If(((cmdindex == 41) | ((cmdindex == 1) & emmc)) & response[31],
+                        NextValue(blockaddr, response[30])
+                    ),
                     If(dataxfer == SDCARD_CTRL_DATA_TRANSFER_READ,
-                        NextValue(derrread_en, 1),
                         NextState("RECV_DATA")
                     ).Elif(dataxfer == SDCARD_CTRL_DATA_TRANSFER_WRITE,
                         NextState("SEND_DATA")
@@ -243,14 +1133,7 @@ class SDCore(Module, AutoCSR):
                     phy.source.ready.eq(self.crc16checker.sink.ready),
 
                     If(phy.source.last & phy.source.ready, # End of block
-                        If(blkcnt < (blockcount - 1),
-                            NextValue(blkcnt, blkcnt + 1),
-                            NextState("RECV_DATA")
-                        ).Else(
-                            NextValue(blkcnt, 0),
-                            NextValue(datadone, 1),
-                            NextState("IDLE")
-                        )
+                        NextState("RECV_DATA_CHECK")
                     )
                 ).Elif(phy.source.status == SDCARD_STREAM_STATUS_TIMEOUT,
                     NextValue(derrtimeout, 1),
@@ -262,6 +1145,52 @@ class SDCore(Module, AutoCSR):
             )
         )
 
+        fsm.act("RECV_DATA_CHECK",
+            If(~self.crc16checker.valid & readblock & (retries < maxretry) & ~abortreq,
+                NextValue(retries, retries + 1),
+                NextValue(retrycount, retrycount + 1),
+                NextValue(argument, argument + blkcnt),
+                NextValue(blockcount, blockcount - blkcnt),
+                NextValue(blkcnt, 0),
+                NextValue(restart, 1),
+                # Stop the transfer (if still running) before restarting it
+                If((command[8:14] == 18) & ~(autocmd23 & (blkcnt == (blockcount - 1))),
+                    NextValue(stage, STAGE_CMD12),
+                    NextValue(cmddone, 0),
+                    NextValue(cerrtimeout, 0),
+                    NextValue(cerrcrc_en, 0),
+                    NextValue(response, 0),
+                    NextState("SEND_CMD")
+                ).Else(
+                    NextState("IDLE")
+                )
+            ).Else(
+                blockdone.eq(1),
+                NextValue(blocks, blocks + 1),
+                If(~self.crc16checker.valid,
+                    NextValue(derrread, 1)
+                ),
+                If(abortblk,
+                    NextValue(aborted, 1),
+                    NextValue(blkcnt, 0),
+                    NextValue(datadone, 1),
+                    NextValue(stage, STAGE_CMD12),
+                    NextValue(cmddone, 0),
+                    NextValue(cerrtimeout, 0),
+                    NextValue(cerrcrc_en, 0),
+                    NextValue(response, 0),
+                    NextState("SEND_CMD")
+                ).Elif(blkcnt < (blockcount - 1),
+                    NextValue(blkcnt, blkcnt + 1),
+                    NextState("RECV_DATA")
+                ).Else(
+                    NextValue(blkcnt, 0),
+                    NextValue(datadone, 1),
+                    NextState("IDLE")
+                )
+            )
+        )
+
         fsm.act("SEND_DATA",
             phy.sink.valid.eq(self.crc16inserter.source.valid),
             phy.sink.cmd_data_n.eq(0),
@@ -273,7 +1202,15 @@ class SDCore(Module, AutoCSR):
             If(self.crc16inserter.source.valid &
                self.crc16inserter.source.last &
                self.crc16inserter.source.ready,
-                If(blkcnt < (blockcount - 1),
+                blockdone.eq(1),
+                NextValue(blocks, blocks + 1),
+                If(abortblk,
+                    NextValue(aborted, 1),
+                    NextValue(blkcnt, 0),
+                    NextValue(datadone, 1),
+                    NextValue(drainidle, 0),
+                    NextState("ABORT_FLUSH")
+                ).Elif(blkcnt < (blockcount - 1),
                     NextValue(blkcnt, blkcnt + 1)
                 ).Else(
                     NextValue(blkcnt, 0),
@@ -289,3 +1226,228 @@ class SDCore(Module, AutoCSR):
                 )
             )
         )
+
+        fsm.act("POLL_WAIT",
+            NextValue(pollcnt, pollcnt + 1),
+            If(pollcnt >= pollinterval,
+                NextValue(polls, polls + 1),
+                NextValue(cmddone, 0),
+                NextValue(cerrtimeout, 0),
+                NextValue(cerrcrc_en, 0),
+                NextValue(response, 0),
+                NextState("SEND_CMD")
+            )
+        )
+
+        fsm.act("ABORT_FLUSH",
+            # Drop the write data of the next blocks (buffered or still to be
+            # received from the producer)
+            self.crc16inserter.reset.eq(1),
+            self.upstream_converter.source.ready.eq(1),
+            If(self.upstream_converter.source.valid,
+                NextValue(drainidle, 0)
+            ).Else(
+                NextValue(drainidle, drainidle + 1)
+            ),
+            If((wrblocks >= blockcount) | (drainidle >= datatimeout),
+                NextValue(stage, STAGE_CMD12),
+                NextValue(cmddone, 0),
+                NextValue(cerrtimeout, 0),
+                NextValue(cerrcrc_en, 0),
+                NextValue(response, 0),
+                NextState("SEND_CMD")
+            )
+        )
+
+        if with_store_and_forward:
+            self.comb += readblock.eq(blockaddr &
+                ((command[8:14] == 17) | (command[8:14] == 18)))
+
+        if with_metadata or with_store_and_forward:
+            # The last beat of a block is held until the CRC of the block is
+            # checked
+            conv = self.downstream_converter.source
+            block = stream.Endpoint(self.source.description)
+            first = Signal(reset=1)
+            checked = Signal()
+            checked_block = Signal(32)
+            checked_error = Signal()
+            self.comb += [
+                conv.connect(block),
+                If(conv.last & ~checked & ~dflushing,
+                    block.valid.eq(0),
+                    conv.ready.eq(0)
+                )
+            ]
+            self.sync.sd += [
+                If(conv.valid & conv.ready,
+                    first.eq(conv.last)
+                ),
+                If(fsm.ongoing("RECV_DATA_CHECK"),
+                    checked.eq(1),
+                    checked_block.eq(argument + blkcnt),
+                    checked_error.eq(~self.crc16checker.valid)
+                ).Elif(conv.valid & conv.ready & conv.last,
+                    checked.eq(0)
+                ),
+                If(dflushing,
+                    first.eq(1),
+                    checked.eq(0)
+                )
+            ]
+            if with_metadata:
+                self.comb += [
+                    block.first.eq(first),
+                    If(conv.last,
+                        block.block.eq(checked_block),
+                        block.error.eq(checked_error)
+                    ).Else(
+                        block.block.eq(argument + blkcnt)
+                    )
+                ]
+            if with_store_and_forward:
+                # Blocks are released once checked, blocks with a CRC error
+                # are dropped (and read again when retries are enabled)
+                self.submodules.blockbuffer = ResetInserter()(ClockDomainsRenamer("sd")(
+                    SDBlockBuffer(self.source.description, store_and_forward_depth)))
+                self.comb += [
+                    self.blockbuffer.reset.eq(dflushing),
+                    block.connect(self.blockbuffer.sink),
+                    self.blockbuffer.commit.eq(~checked_error),
+                    self.blockbuffer.source.connect(self.downstream_cdc.sink)
+                ]
+            else:
+                self.comb += block.connect(self.downstream_cdc.sink)
+
+        if with_stats:
+            self.submodules.stats = SDCoreStats()
+            self.comb += [
+                self.stats.cmd.eq(fsm.ongoing("SEND_CMD") &
+                    phy.sink.valid & phy.sink.ready & (csel == 5)),
+                self.stats.dataxfer.eq(dataxfer),
+                self.stats.blockread.eq(fsm.ongoing("RECV_DATA") &
+                    phy.source.valid & phy.source.ready & phy.source.last &
+                    (phy.source.status == SDCARD_STREAM_STATUS_OK)),
+                self.stats.blockwrite.eq(fsm.ongoing("SEND_DATA") &
+                    self.crc16inserter.source.valid &
+                    self.crc16inserter.source.last &
+                    self.crc16inserter.source.ready),
+                self.stats.blocksize.eq(blocksize),
+                self.stats.crcerror.eq(
+                    (cmddone & ~cmddone_d & ~cerrtimeout & cmdevt[3]) |
+                    (fsm.ongoing("RECV_DATA_CHECK") & ~self.crc16checker.valid) |
+                    phy.dataw.crcfb.error),
+                self.stats.timeout.eq(
+                    (fsm.ongoing("RECV_RESP") | fsm.ongoing("RECV_DATA")) &
+                    phy.source.valid &
+                    (phy.source.status == SDCARD_STREAM_STATUS_TIMEOUT)),
+                self.stats.busy.eq(~fsm.ongoing("IDLE")),
+                self.stats.sinkstall.eq(fsm.ongoing("SEND_DATA") &
+                    ~self.crc16inserter.source.valid),
+                self.stats.sourcestall.eq(fsm.ongoing("RECV_DATA") &
+                    phy.source.valid & ~self.crc16checker.sink.ready)
+            ]
+
+        if with_trace:
+            self.submodules.trace = SDTrace(trace_depth)
+            inblock = Signal()
+            beat = Signal()
+            beatlast = Signal()
+            self.comb += [
+                If(fsm.ongoing("RECV_DATA"),
+                    beat.eq(phy.source.valid & phy.source.ready &
+                        (phy.source.status == SDCARD_STREAM_STATUS_OK)),
+                    beatlast.eq(phy.source.last)
+                ).Elif(fsm.ongoing("SEND_DATA"),
+                    beat.eq(self.crc16inserter.source.valid &
+                        self.crc16inserter.source.ready),
+                    beatlast.eq(self.crc16inserter.source.last)
+                )
+            ]
+            self.sync.sd += \
+                If(fsm.ongoing("IDLE"),
+                    inblock.eq(0)
+                ).Elif(beat,
+                    inblock.eq(~beatlast)
+                )
+            self.comb += [
+                self.trace.events.eq(Cat(
+                    fsm.ongoing("SEND_CMD") & phy.sink.valid & phy.sink.ready & (csel == 5),
+                    cmddone & ~cmddone_d,
+                    beat & ~inblock,
+                    beat & beatlast,
+                    phy.dataw.crcfb.valid,
+                    phy.dataw.crcfb.error,
+                    phy.dataw.busy_release,
+                    report)),
+                self.trace.cmdindex.eq(cmdindex),
+                self.trace.dataxfer.eq(dataxfer),
+                self.trace.block.eq(blkcnt)
+            ]
+
+    def get_port(self):
+        """Return a new command/data port for a hardware frontend
+
+        Commands are taken from one port at a time (SDCore endpoints
+        included), the grant moves in round robin to another requesting
+        port once the commands of the granted one are reported and it is
+        not locked. Data goes to the port of the last accepted command, the
+        SDCore endpoints get the data of the commands written through the
+        CSRs.
+        """
+        port = SDCorePort(self.sink.description, self.source.description)
+        self._ports.append(port)
+        return port
+
+    def do_finalize(self):
+        ports = [self] + self._ports
+        n = len(ports)
+        grant = Signal(max=max(n, 2))
+        owner = Signal(max=max(n, 2))
+        cmd_cases = {}
+        data_cases = {}
+        for i, p in enumerate(ports):
+            cmd_cases[i] = [
+                p.cmd_sink.connect(self._cmd_sink),
+                self._cmd_source.connect(p.cmd_source)
+            ]
+            data_cases[i] = [
+                p.sink.connect(self._sink),
+                self._source.connect(p.source)
+            ]
+        self.comb += [
+            Case(grant, cmd_cases),
+            Case(owner, data_cases),
+            self._flush.eq(reduce(or_, [p.flush for p in ports])),
+            self._source_flush.eq(reduce(or_, [p.source_flush for p in ports]))
+        ]
+        if n == 1:
+            return
+
+        self.sync += \
+            If(self.command.re | self.qcommand.re,
+                owner.eq(0)
+            ).Elif(self._cmd_sink.valid & self._cmd_sink.ready,
+                owner.eq(grant)
+            )
+
+        # Commands grant
+        outstanding = Signal(8)
+        request = Array(Signal() for i in range(n))
+        self.comb += request[0].eq(self.cmd_sink.valid)
+        for i, p in enumerate(self._ports):
+            self.comb += request[i + 1].eq(p.cmd_sink.valid | p.lock)
+        rr_cases = {}
+        for g in range(n):
+            rr_cases[g] = []
+            for k in reversed(range(1, n + 1)):
+                j = (g + k)%n
+                rr_cases[g] = If(request[j], grant.eq(j)).Else(rr_cases[g])
+        self.sync += [
+            outstanding.eq(outstanding +
+                (self._cmd_sink.valid & self._cmd_sink.ready) -
+                (self._cmd_source.valid & self._cmd_source.ready)),
+            If((outstanding == 0) & ~request[grant],
+                Case(grant, rr_cases)
+            )
+        ]
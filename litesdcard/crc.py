@@ -1,3 +1,6 @@
+from functools import reduce
+from operator import and_
+
 from litex.gen import *
 from litex.gen.fhdl import verilog
 from litex.soc.interconnect import stream
@@ -47,113 +50,180 @@ class CRCChecker(Module):
 
 
 class CRCDownstreamChecker(Module):
-    def __init__(self):
-        self.sink = sink = stream.Endpoint([("data", 8)])
-        self.source = source = stream.Endpoint([("data", 8)])
+    """CRC16 checker of the data blocks received on data_width (1/4/8) lines
+
+    In DDR (4 lines only), each line carries two CRC16, one of the bits of
+    the rising edges (upper nibble of the bytes) and one of the bits of the
+    falling edges (lower nibble).
+    """
+    def __init__(self, data_width=4):
+        assert data_width in [1, 4, 8]
+        self.sink = stream.Endpoint([("data", 8)])
+        self.source = stream.Endpoint([("data", 8)])
+        self.valid = Signal()
+        self.ddr = Signal()
 
         # # #
 
-        val = Signal(8)
-        cnt = Signal(4)
-        tmpcnt = Signal(10)
-        crcs = [CRC(poly=0x1021, size=16, dw=2, init=0) for i in range(4)]
-        crctmp = [Signal(16) for i in range(4)]
-        self.valid = Signal()
+        self.submodules.sdrchecker = sdrchecker = CRCDownstreamCheckerLanes(data_width)
+        if data_width == 4:
+            # DDR blocks
+            self.submodules.ddrchecker = ddrchecker = CRCDownstreamCheckerLanes(8)
 
-        for i in range(4):
-            self.submodules += crcs[i]
-            self.sync += [
-                If(sink.ready & sink.valid,
-                    crctmp[i].eq(crcs[i].crc)
+            self.comb += \
+                If(self.ddr,
+                    self.sink.connect(ddrchecker.sink),
+                    ddrchecker.source.connect(self.source),
+                    self.valid.eq(ddrchecker.valid)
+                ).Else(
+                    self.sink.connect(sdrchecker.sink),
+                    sdrchecker.source.connect(self.source),
+                    self.valid.eq(sdrchecker.valid)
                 )
+        else:
+            self.comb += [
+                self.sink.connect(sdrchecker.sink),
+                sdrchecker.source.connect(self.source),
+                self.valid.eq(sdrchecker.valid)
             ]
 
-        fifo = [Signal(16) for i in range(4)]
-        self.comb += If((fifo[0] == crctmp[0]) &
-                        (fifo[1] == crctmp[1]) & 
-                        (fifo[2] == crctmp[2]) & 
-                        (fifo[3] == crctmp[3]),
-            self.valid.eq(1)
-        )
 
-        for i in range(4):
-            self.sync += [
-                If(sink.valid & sink.ready,
-                    fifo[i].eq(Cat(sink.data[3-i], sink.data[7-i], fifo[i][0:14])),
-                    val[7-i].eq(fifo[i][13]),
-                    val[3-i].eq(fifo[i][12])
-                )
-            ]
-            self.comb += [
-                crcs[i].val.eq(Cat(val[3-i], val[7-i])),
-                crcs[i].enable.eq(sink.valid & sink.ready),
-                If(cnt == 7,
-                    crcs[i].clr.eq(1),
-                ).Else(
-                    crcs[i].clr.eq(0)
-                )
-            ]
+class CRCDownstreamCheckerLanes(Module):
+    """CRC16 checker of blocks sent on nlanes lines
 
-        self.sync += [
-            If(sink.valid & sink.ready,
-               If(sink.last,
-                   cnt.eq(0)
-               ).Elif(cnt != 10,
-                   cnt.eq(cnt + 1)
-               )
-            )
-        ]
+    Each line carries 8//nlanes bits of each byte (bit i + nlanes*k of the
+    bytes on line i, highest k first) and its CRC16, sent in the 2*nlanes
+    last bytes of the block. The block is forwarded without its CRC, valid
+    is set after the last byte when all the CRC16 match.
+    """
+    def __init__(self, nlanes):
+        self.sink = sink = stream.Endpoint([("data", 8)])
+        self.source = source = stream.Endpoint([("data", 8)])
+        self.valid = Signal()
+
+        # # #
 
+        nbits = 8//nlanes
+        ncrcbytes = 2*nlanes
+        cnt = Signal(max=ncrcbytes+1)
+        fifo = [Signal(16) for i in range(nlanes)] # last 16 bits of each line
+        crcs = [CRC(poly=0x1021, size=16, dw=nbits, init=0) for i in range(nlanes)]
+        crctmp = [Signal(16) for i in range(nlanes)]
+
+        out = Signal()
+        data = Signal(8)
+        for i in range(nlanes):
+            for k in range(nbits):
+                self.comb += data[i + nlanes*k].eq(fifo[i][16-nbits+k])
         self.comb += [
-            source.data.eq(val),
-            If(sink.valid & (cnt > 7),
-                source.valid.eq(1)
-            ),
-            If(cnt < 8,
+            source.data.eq(data),
+            source.valid.eq(sink.valid & (cnt == ncrcbytes)),
+            source.last.eq(sink.last),
+            If(cnt < ncrcbytes,
                 sink.ready.eq(1)
             ).Else(
                 sink.ready.eq(source.ready)
             ),
-            source.last.eq(sink.last)
+            out.eq(source.valid & source.ready)
         ]
 
+        for i in range(nlanes):
+            self.submodules += crcs[i]
+            self.comb += [
+                crcs[i].val.eq(fifo[i][16-nbits:16]),
+                crcs[i].clr.eq(cnt < ncrcbytes),
+                crcs[i].enable.eq(out)
+            ]
+            self.sync += [
+                If(sink.valid & sink.ready,
+                    fifo[i].eq(Cat(*([sink.data[i + nlanes*k] for k in range(nbits)] +
+                        [fifo[i][0:16-nbits]])))
+                ),
+                If(out,
+                    crctmp[i].eq(crcs[i].crc)
+                )
+            ]
+        self.comb += self.valid.eq(reduce(and_, [fifo[i] == crctmp[i] for i in range(nlanes)]))
+
+        self.sync += \
+            If(sink.valid & sink.ready,
+                If(sink.last,
+                    cnt.eq(0)
+                ).Elif(cnt != ncrcbytes,
+                    cnt.eq(cnt + 1)
+                )
+            )
+
 
 class CRCUpstreamInserter(Module):
-    def __init__(self):
+    """CRC16 inserter of the data blocks sent on data_width (1/4/8) lines
+    (see CRCDownstreamChecker)"""
+    def __init__(self, data_width=4):
+        assert data_width in [1, 4, 8]
+        self.sink = stream.Endpoint([("data", 8)])
+        self.source = stream.Endpoint([("data", 8)])
+        self.ddr = Signal()
+
+        # # #
+
+        self.submodules.sdrinserter = sdrinserter = CRCUpstreamInserterLanes(data_width)
+        if data_width == 4:
+            # DDR blocks
+            self.submodules.ddrinserter = ddrinserter = CRCUpstreamInserterLanes(8)
+
+            self.comb += \
+                If(self.ddr,
+                    self.sink.connect(ddrinserter.sink),
+                    ddrinserter.source.connect(self.source)
+                ).Else(
+                    self.sink.connect(sdrinserter.sink),
+                    sdrinserter.source.connect(self.source)
+                )
+        else:
+            self.comb += [
+                self.sink.connect(sdrinserter.sink),
+                sdrinserter.source.connect(self.source)
+            ]
+
+
+class CRCUpstreamInserterLanes(Module):
+    """CRC16 inserter of blocks sent on nlanes lines (see
+    CRCDownstreamCheckerLanes)"""
+    def __init__(self, nlanes):
         self.sink = sink = stream.Endpoint([("data", 8)])
         self.source = source = stream.Endpoint([("data", 8)])
 
-        crc = Signal(8)
-        cnt = Signal(3)
-        crcs = [CRC(poly=0x1021, size=16, dw=2, init=0) for i in range(4)]
+        # # #
 
-        crctmp = [Signal(16) for i in range(4)]
-        for i in range(4):
+        nbits = 8//nlanes
+        ncrcbytes = 2*nlanes
+        cnt = Signal(max=ncrcbytes)
+        crcs = [CRC(poly=0x1021, size=16, dw=nbits, init=0) for i in range(nlanes)]
+        crctmp = [Signal(16) for i in range(nlanes)]
+        for i in range(nlanes):
             self.submodules += crcs[i]
             self.comb += [
-                crcs[i].val.eq(Cat(sink.data[i], sink.data[i+4])),
+                crcs[i].val.eq(Cat(*[sink.data[i + nlanes*k] for k in range(nbits)])),
                 crcs[i].clr.eq(sink.last & sink.valid & sink.ready),
                 crcs[i].enable.eq(sink.valid & sink.ready)
             ]
 
+        # CRC bytes: nbits clocks of the lines per byte, MSB of the CRC16 first
         cases = {}
-        for i in range(8):
-            crclist = []
-            for j in range(2):
-                for k in range(4):
-                    crclist.append(crctmp[k][2*(7-i) +j])
-
-            cases[i] = source.data.eq(Cat(*crclist))
+        for j in range(ncrcbytes):
+            data = [None]*8
+            for i in range(nlanes):
+                for k in range(nbits):
+                    data[i + nlanes*k] = crctmp[i][15 - (j*nbits + nbits-1-k)]
+            cases[j] = source.data.eq(Cat(*data))
 
-        fsm = FSM()
-        self.submodules.fsm = fsm
-        crctmpsync = [NextValue(crctmp[i], crcs[i].crc) for i in range(4)]
+        self.submodules.fsm = fsm = FSM()
+        crctmpsync = [NextValue(crctmp[i], crcs[i].crc) for i in range(nlanes)]
 
         fsm.act("IDLE",
             source.data.eq(sink.data),
             source.valid.eq(sink.valid),
             sink.ready.eq(source.ready),
-            source.last.eq(0),
             *crctmpsync,
             If(sink.valid & sink.last & sink.ready,
                 NextState("SENDCRC"),
@@ -162,14 +232,13 @@ class CRCUpstreamInserter(Module):
         )
 
         fsm.act("SENDCRC",
-            sink.ready.eq(0),
             source.valid.eq(1),
-            If(cnt == 7,
+            If(cnt == (ncrcbytes - 1),
                 source.last.eq(1),
             ),
             Case(cnt, cases),
             If(source.ready,
-                If(cnt == 7,
+                If(cnt == (ncrcbytes - 1),
                     NextState("IDLE")
                 ).Else(
                     NextValue(cnt, cnt+1)
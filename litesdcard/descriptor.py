@@ -0,0 +1,172 @@
+"""Descriptor ring engine running commands against SDCore from memory."""
+
+from litex.gen import *
+
+from litex.soc.interconnect import wishbone
+from litex.soc.interconnect.csr import *
+
+from litesdcard.common import *
+from litesdcard.dma import _SDBlock2MemDMA, _SDMem2BlockDMA
+
+
+class SDDescriptorEngine(Module, AutoCSR):
+    """Fetch command descriptors from a ring in memory and execute them on SDCore
+
+    Each descriptor is 4 words:
+        0: command (same encoding as the SDCore command CSR)
+        1: argument
+        2: blockcount (blocks of 512 bytes)
+        3: buffer address
+
+    For each executed descriptor, 2 words are written to the completion ring
+    at the same index:
+        0: cmdevt[0:8] | dataevt[0:8] << 8 | index << 16
+        1: response[0:32] (card status for short responses)
+
+    Software fills descriptors and advances head, the engine advances tail.
+    Commands and data go through an SDCore port.
+    """
+    def __init__(self, core, burst_length=16, fifo_depth=256):
+        sdcore = core.get_port()
+        assert len(sdcore.sink.data) == 32
+        self.bus = bus = wishbone.Interface()
+
+        self.enable = CSRStorage()
+        self.base = CSRStorage(32)
+        self.cpl_base = CSRStorage(32)
+        self.size = CSRStorage(16)
+        self.head = CSRStorage(16)
+        self.tail = CSRStatus(16)
+
+        # # #
+
+        # Data movers
+        block2mem = _SDBlock2MemDMA(burst_length, fifo_depth)
+        mem2block = _SDMem2BlockDMA(burst_length, fifo_depth)
+        self.submodules += block2mem, mem2block
+        self.comb += [
+            sdcore.source.connect(block2mem.sink,
+                omit={name for name, width in sdcore_metadata_layout}),
+            mem2block.source.connect(sdcore.sink)
+        ]
+
+        # Descriptors fetch / completions write
+        desc_bus = wishbone.Interface()
+        self.submodules.arbiter = wishbone.Arbiter(
+            [desc_bus, block2mem.bus, mem2block.bus], bus)
+
+        desc = Array(Signal(32) for i in range(4))
+        command = desc[0]
+        argument = desc[1]
+        blockcount = desc[2]
+        buffer = desc[3]
+        length = Signal(32)
+        dataxfer = Signal(2)
+
+        cmdevt = Signal(8)
+        dataevt = Signal(8)
+        response = Signal(32)
+        error = Signal()
+        status_done = Signal()
+
+        tail = Signal(16)
+        cnt = Signal(2)
+
+        self.comb += [
+            self.tail.status.eq(tail),
+            length.eq(Cat(Replicate(0, 9), blockcount)),
+            dataxfer.eq(command[5:7]),
+            error.eq((cmdevt[2:6] != 0) | (dataevt[1:5] != 0))
+        ]
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        fsm.act("IDLE",
+            If(self.enable.storage & (self.head.storage != tail),
+                NextValue(cnt, 0),
+                NextState("FETCH")
+            )
+        )
+        fsm.act("FETCH",
+            desc_bus.cyc.eq(1),
+            desc_bus.stb.eq(1),
+            desc_bus.we.eq(0),
+            desc_bus.sel.eq(0xf),
+            desc_bus.adr.eq(self.base.storage[2:] + Cat(cnt, tail)),
+            If(cnt == 3,
+                desc_bus.cti.eq(0b111) # end of burst
+            ).Else(
+                desc_bus.cti.eq(0b010) # incrementing burst
+            ),
+            If(desc_bus.ack,
+                NextValue(desc[cnt], desc_bus.dat_r),
+                NextValue(cnt, cnt + 1),
+                If(cnt == 3,
+                    NextState("ISSUE")
+                )
+            )
+        )
+        fsm.act("ISSUE",
+            sdcore.cmd_sink.valid.eq(1),
+            sdcore.cmd_sink.command.eq(command),
+            sdcore.cmd_sink.argument.eq(argument),
+            sdcore.cmd_sink.blocksize.eq(512),
+            sdcore.cmd_sink.blockcount.eq(blockcount),
+            If(sdcore.cmd_sink.ready,
+                block2mem.base.eq(buffer),
+                block2mem.length.eq(length),
+                block2mem.start.eq(dataxfer == SDCARD_CTRL_DATA_TRANSFER_READ),
+                mem2block.base.eq(buffer),
+                mem2block.length.eq(length),
+                mem2block.start.eq(dataxfer == SDCARD_CTRL_DATA_TRANSFER_WRITE),
+                NextValue(status_done, 0),
+                NextState("WAIT")
+            )
+        )
+        fsm.act("WAIT",
+            sdcore.cmd_source.ready.eq(1),
+            If(sdcore.cmd_source.valid,
+                NextValue(cmdevt, sdcore.cmd_source.cmdevt),
+                NextValue(dataevt, sdcore.cmd_source.dataevt),
+                NextValue(response, sdcore.cmd_source.response),
+                NextValue(status_done, 1)
+            ),
+            If(status_done,
+                If(error,
+                    # Drop the data of the failed command
+                    block2mem.reset.eq(1),
+                    mem2block.reset.eq(1),
+                    sdcore.flush.eq(1),
+                    sdcore.source_flush.eq(1),
+                    NextValue(cnt, 0),
+                    NextState("COMPLETE")
+                ).Elif(block2mem.done & mem2block.done,
+                    NextValue(cnt, 0),
+                    NextState("COMPLETE")
+                )
+            )
+        )
+        fsm.act("COMPLETE",
+            desc_bus.cyc.eq(1),
+            desc_bus.stb.eq(1),
+            desc_bus.we.eq(1),
+            desc_bus.sel.eq(0xf),
+            desc_bus.adr.eq(self.cpl_base.storage[2:] + Cat(cnt[0], tail)),
+            If(cnt[0],
+                desc_bus.cti.eq(0b111), # end of burst
+                desc_bus.dat_w.eq(response)
+            ).Else(
+                desc_bus.cti.eq(0b010), # incrementing burst
+                desc_bus.dat_w.eq(Cat(cmdevt, dataevt, tail))
+            ),
+            If(desc_bus.ack,
+                NextValue(cnt, cnt + 1),
+                If(cnt[0],
+                    If(tail == (self.size.storage - 1),
+                        NextValue(tail, 0)
+                    ).Else(
+                        NextValue(tail, tail + 1)
+                    ),
+                    NextState("IDLE")
+                )
+            )
+        )
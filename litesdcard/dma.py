@@ -0,0 +1,234 @@
+"""Wishbone DMA modules for moving blocks between liteSDCard and memory."""
+
+from litex.gen import *
+
+from litex.soc.interconnect import stream
+from litex.soc.interconnect import wishbone
+from litex.soc.interconnect.csr import *
+
+
+@ResetInserter()
+class _SDBlock2MemDMA(Module):
+    def __init__(self, burst_length, fifo_depth):
+        assert fifo_depth >= burst_length
+        self.bus = bus = wishbone.Interface()
+        self.sink = sink = stream.Endpoint([("data", 32)])
+        self.base = Signal(32)
+        self.length = Signal(32)
+        self.start = Signal()
+        self.done = Signal()
+        self.cycles = Signal(32)
+
+        # # #
+
+        fifo = stream.SyncFIFO([("data", 32)], fifo_depth, buffered=True)
+        self.submodules += fifo
+
+        adr = Signal(30)
+        remaining = Signal(30)
+        burst = Signal(max=burst_length+1)
+        burst_next = Signal(max=burst_length+1)
+        beat = Signal(max=burst_length)
+        cycles = Signal(32)
+
+        self.comb += [
+            If(remaining < burst_length,
+                burst_next.eq(remaining)
+            ).Else(
+                burst_next.eq(burst_length)
+            ),
+            self.cycles.eq(cycles)
+        ]
+
+        fsm = FSM(reset_state="IDLE")
+        self.submodules.fsm = fsm
+        fsm.act("IDLE",
+            self.done.eq(1),
+            If(self.start,
+                NextValue(adr, self.base[2:]),
+                NextValue(remaining, self.length[2:]),
+                NextValue(cycles, 0),
+                NextState("WAIT")
+            )
+        )
+        fsm.act("WAIT",
+            sink.connect(fifo.sink),
+            NextValue(cycles, cycles + 1),
+            If(remaining == 0,
+                NextState("IDLE")
+            ).Elif(fifo.fifo.level >= burst_next,
+                NextValue(burst, burst_next),
+                NextValue(beat, 0),
+                NextState("WRITE")
+            )
+        )
+        fsm.act("WRITE",
+            sink.connect(fifo.sink),
+            NextValue(cycles, cycles + 1),
+            bus.cyc.eq(1),
+            bus.stb.eq(1),
+            bus.we.eq(1),
+            bus.sel.eq(0xf),
+            bus.adr.eq(adr),
+            bus.dat_w.eq(fifo.source.data),
+            If(beat == (burst - 1),
+                bus.cti.eq(0b111) # end of burst
+            ).Else(
+                bus.cti.eq(0b010) # incrementing burst
+            ),
+            If(bus.ack,
+                fifo.source.ready.eq(1),
+                NextValue(adr, adr + 1),
+                NextValue(remaining, remaining - 1),
+                NextValue(beat, beat + 1),
+                If(beat == (burst - 1),
+                    NextState("WAIT")
+                )
+            )
+        )
+
+
+class SDBlock2MemDMA(Module, AutoCSR):
+    """Write the blocks received from SDCore.source to memory with Wishbone bursts"""
+    def __init__(self, burst_length=16, fifo_depth=256):
+        self.sink = sink = stream.Endpoint([("data", 32)])
+        self.base = CSRStorage(32)
+        self.length = CSRStorage(32)
+        self.start = CSR()
+        self.done = CSRStatus()
+        self.cycles = CSRStatus(32)
+
+        # # #
+
+        core = _SDBlock2MemDMA(burst_length, fifo_depth)
+        self.submodules += core
+        self.bus = core.bus
+
+        self.comb += [
+            sink.connect(core.sink),
+            core.base.eq(self.base.storage),
+            core.length.eq(self.length.storage),
+            core.start.eq(self.start.re),
+            self.done.status.eq(core.done),
+            self.cycles.status.eq(core.cycles)
+        ]
+
+
+@ResetInserter()
+class _SDMem2BlockDMA(Module):
+    def __init__(self, burst_length, fifo_depth):
+        assert fifo_depth >= burst_length
+        self.bus = bus = wishbone.Interface()
+        self.source = source = stream.Endpoint([("data", 32)])
+        self.base = Signal(32)
+        self.length = Signal(32)
+        self.start = Signal()
+        self.done = Signal()
+        self.cycles = Signal(32)
+
+        # # #
+
+        fifo = stream.SyncFIFO([("data", 32)], fifo_depth, buffered=True)
+        self.submodules += fifo
+
+        adr = Signal(30)
+        remaining = Signal(30)
+        burst = Signal(max=burst_length+1)
+        burst_next = Signal(max=burst_length+1)
+        beat = Signal(max=burst_length)
+        datcnt = Signal(7)
+        cycles = Signal(32)
+
+        self.comb += [
+            If(remaining < burst_length,
+                burst_next.eq(remaining)
+            ).Else(
+                burst_next.eq(burst_length)
+            ),
+            fifo.source.connect(source),
+            source.last.eq(datcnt == (512//4 - 1)),
+            self.cycles.eq(cycles)
+        ]
+        self.sync += \
+            If(self.start,
+                datcnt.eq(0)
+            ).Elif(source.valid & source.ready,
+                datcnt.eq(datcnt + 1)
+            )
+
+        fsm = FSM(reset_state="IDLE")
+        self.submodules.fsm = fsm
+        fsm.act("IDLE",
+            self.done.eq(1),
+            If(self.start,
+                NextValue(adr, self.base[2:]),
+                NextValue(remaining, self.length[2:]),
+                NextValue(cycles, 0),
+                NextState("WAIT")
+            )
+        )
+        fsm.act("WAIT",
+            NextValue(cycles, cycles + 1),
+            If(remaining == 0,
+                NextState("FLUSH")
+            ).Elif((fifo_depth - fifo.fifo.level) >= burst_next,
+                NextValue(burst, burst_next),
+                NextValue(beat, 0),
+                NextState("READ")
+            )
+        )
+        fsm.act("READ",
+            NextValue(cycles, cycles + 1),
+            bus.cyc.eq(1),
+            bus.stb.eq(1),
+            bus.we.eq(0),
+            bus.sel.eq(0xf),
+            bus.adr.eq(adr),
+            If(beat == (burst - 1),
+                bus.cti.eq(0b111) # end of burst
+            ).Else(
+                bus.cti.eq(0b010) # incrementing burst
+            ),
+            fifo.sink.data.eq(bus.dat_r),
+            If(bus.ack,
+                fifo.sink.valid.eq(1),
+                NextValue(adr, adr + 1),
+                NextValue(remaining, remaining - 1),
+                NextValue(beat, beat + 1),
+                If(beat == (burst - 1),
+                    NextState("WAIT")
+                )
+            )
+        )
+        fsm.act("FLUSH",
+            NextValue(cycles, cycles + 1),
+            If(~fifo.source.valid,
+                NextState("IDLE")
+            )
+        )
+
+
+class SDMem2BlockDMA(Module, AutoCSR):
+    """Read memory with Wishbone bursts and send it as 512 bytes blocks to SDCore.sink"""
+    def __init__(self, burst_length=16, fifo_depth=256):
+        self.source = source = stream.Endpoint([("data", 32)])
+        self.base = CSRStorage(32)
+        self.length = CSRStorage(32)
+        self.start = CSR()
+        self.done = CSRStatus()
+        self.cycles = CSRStatus(32)
+
+        # # #
+
+        core = _SDMem2BlockDMA(burst_length, fifo_depth)
+        self.submodules += core
+        self.bus = core.bus
+
+        self.comb += [
+            core.source.connect(source),
+            core.base.eq(self.base.storage),
+            core.length.eq(self.length.storage),
+            core.start.eq(self.start.re),
+            self.done.status.eq(core.done),
+            self.cycles.status.eq(core.cycles)
+        ]
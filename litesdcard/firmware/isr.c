@@ -2,6 +2,8 @@
 #include <irq.h>
 #include <uart.h>
 
+#include "sdcard.h"
+
 extern void periodic_isr(void);
 
 void isr(void);
@@ -14,4 +16,9 @@ void isr(void)
 	if(irqs & (1 << UART_INTERRUPT))
 		uart_isr();
 
+#ifdef SDCORE_INTERRUPT
+	if(irqs & (1 << SDCORE_INTERRUPT))
+		sdcard_isr();
+#endif
+
 }
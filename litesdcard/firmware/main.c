@@ -74,6 +74,7 @@ static void help(void)
 	puts("reboot         - reboot CPU");
 	puts("sdclk <freq>   - SDCard set clk frequency (Mhz)");
 	puts("sdinit         - SDCard initialization");
+	puts("emmcinit       - eMMC initialization");
 	puts("sdtest <loops> - SDCard test");
 
 }
@@ -101,10 +102,14 @@ static void console_service(void)
 	}
 	else if(strcmp(token, "sdinit") == 0)
 		sdcard_init();
+	else if(strcmp(token, "emmcinit") == 0)
+		sdcard_emmc_init();
+#ifdef CSR_BIST_CHECKER_BASE
 	else if(strcmp(token, "sdtest") == 0) {
 		token = get_token(&str);
 		sdcard_test(atoi(token));
 	}
+#endif
 	prompt();
 }
 
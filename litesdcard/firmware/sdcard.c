@@ -6,6 +6,7 @@
 #include <generated/mem.h>
 #include <hw/flags.h>
 #include <system.h>
+#include <irq.h>
 
 #include "sdcard.h"
 
@@ -215,6 +216,207 @@ int sdcard_wait_response(void) {
 	return status;
 }
 
+unsigned int sdcard_card_status(void) {
+	return sdcore_cardstatus_read();
+}
+
+unsigned int sdcard_card_rca(void) {
+	return sdcore_rca_read();
+}
+
+/* mailbox */
+
+#ifdef SDMAILBOX_BASE
+unsigned int sdcard_mailbox_read(unsigned int *mailbox) {
+	int i;
+	volatile unsigned int *buffer = (unsigned int *)SDMAILBOX_BASE;
+
+	/* retry until the sequence numbers match (consistent snapshot) */
+	do {
+		for(i=0; i<8; i++)
+			mailbox[i] = buffer[i];
+	} while(mailbox[0] != mailbox[7]);
+
+	return mailbox[0];
+}
+#endif
+
+/* stats */
+
+#ifdef CSR_SDCORE_STATS_CLEAR_ADDR
+void sdcard_stats_clear(void) {
+	sdcore_stats_clear_write(1);
+	while(!(sdcore_stats_done_read() & 0x1));
+}
+
+void sdcard_stats_print(void) {
+	sdcore_stats_snapshot_write(1);
+	while(!(sdcore_stats_done_read() & 0x1));
+	printf("cmds:    %u none / %u read / %u write\n",
+		sdcore_stats_cmdsnone_read(),
+		sdcore_stats_cmdsread_read(),
+		sdcore_stats_cmdswrite_read());
+	printf("blocks:  %u read / %u written\n",
+		sdcore_stats_blocksread_read(),
+		sdcore_stats_blockswritten_read());
+	printf("bytes:   %llu read / %llu written\n",
+		sdcore_stats_bytesread_read(),
+		sdcore_stats_byteswritten_read());
+	printf("errors:  %u crc / %u timeouts\n",
+		sdcore_stats_crcerrors_read(),
+		sdcore_stats_timeouts_read());
+	printf("cycles:  %llu busy / %llu idle\n",
+		sdcore_stats_busycycles_read(),
+		sdcore_stats_idlecycles_read());
+	printf("stalls:  %llu sink / %llu source\n",
+		sdcore_stats_sinkstalls_read(),
+		sdcore_stats_sourcestalls_read());
+}
+#endif
+
+/* interrupts */
+
+#ifdef SDCORE_INTERRUPT
+static volatile unsigned int sdcard_events;
+
+void sdcard_isr(void) {
+	unsigned int pending;
+
+	pending = sdcore_ev_pending_read();
+	sdcard_events |= pending;
+	sdcore_ev_pending_write(pending);
+}
+
+void sdcard_irq_init(unsigned int events) {
+	sdcard_events = 0;
+	sdcore_ev_pending_write(sdcore_ev_pending_read());
+	sdcore_ev_enable_write(events);
+	irq_setmask(irq_getmask() | (1 << SDCORE_INTERRUPT));
+}
+
+unsigned int sdcard_wait_event(unsigned int events) {
+	unsigned int r;
+
+	while(!(sdcard_events & events));
+	irq_setie(0);
+	r = sdcard_events;
+	sdcard_events &= ~events;
+	irq_setie(1);
+	return r;
+}
+#endif
+
+/* auto commands */
+
+/* SET_BLOCK_COUNT support of the card (SCR.CMD_SUPPORT, always for eMMC) */
+static int sdcard_sbc;
+
+void sdcard_set_autocmd(int cmd_support_sbc) {
+	/* prefer SET_BLOCK_COUNT when supported by the card (SCR.CMD_SUPPORT) */
+	if(cmd_support_sbc)
+		sdcore_autocmd_write(SDCARD_CTRL_AUTOCMD_CMD23);
+	else
+		sdcore_autocmd_write(SDCARD_CTRL_AUTOCMD_CMD12);
+}
+
+/* retries */
+
+void sdcard_set_retry(unsigned int maxretry) {
+	sdcore_maxretry_write(maxretry);
+}
+
+unsigned int sdcard_retry_count(void) {
+	return sdcore_retrycount_read();
+}
+
+/* auto polling */
+
+void sdcard_set_autopoll(int enable, unsigned int interval) {
+	sdcore_pollinterval_write(interval);
+	sdcore_autopoll_write(enable);
+}
+
+int sdcard_wait_card_ready(void) {
+	unsigned int events;
+#ifdef SDCORE_INTERRUPT
+	/* the events may have been collected by the isr */
+	do {
+		events = sdcore_ev_pending_read() | sdcard_events;
+	} while(!(events & (SDCARD_EV_CARDREADY | SDCARD_EV_TIMEOUT)));
+	irq_setie(0);
+	sdcard_events &= ~(SDCARD_EV_CARDREADY | SDCARD_EV_TIMEOUT);
+	irq_setie(1);
+#else
+	do {
+		events = sdcore_ev_pending_read();
+	} while(!(events & (SDCARD_EV_CARDREADY | SDCARD_EV_TIMEOUT)));
+#endif
+	sdcore_ev_pending_write(SDCARD_EV_CARDREADY | SDCARD_EV_TIMEOUT);
+	/* card still busy after the maximum number of polls */
+	if(!(events & SDCARD_EV_CARDREADY))
+		return SD_TIMEOUT;
+	return SD_OK;
+}
+
+/* abort */
+
+void sdcard_abort(void) {
+	sdcore_abort_write(1);
+}
+
+unsigned int sdcard_blocks(void) {
+	return sdcore_blocks_read();
+}
+
+/* phy */
+
+void sdcard_set_ddr(int enable) {
+#ifdef CSR_SDPHY_DDR_ADDR
+	sdphy_ddr_write(enable);
+#endif
+}
+
+/* tuner */
+
+#ifdef CSR_SDTUNER_BASE
+int sdcard_tune(void) {
+	sdtuner_start_write(1);
+	while(!(sdtuner_done_read() & 0x1)) {
+		if(sdtuner_error_read() & 0x1) {
+#ifdef SDCARD_DEBUG
+			printf("sdtuner: no passing tap\n");
+#endif
+			return SD_CRCERROR;
+		}
+	}
+#ifdef SDCARD_DEBUG
+	printf("sdtuner: passes %08x, delay %d\n", sdtuner_passes_read(), sdtuner_delay_read());
+#endif
+	return SD_OK;
+}
+#endif
+
+/* command queue */
+
+void sdcard_queue_command(unsigned int cmd, unsigned int arg, unsigned int response,
+	unsigned int transfer, unsigned int blocksize, unsigned int blockcnt) {
+	while(!(sdcore_cmdqready_read() & 0x1));
+	sdcore_argument_write(arg);
+	sdcore_blocksize_write(blocksize);
+	sdcore_blockcount_write(blockcnt);
+	sdcore_qcommand_write((cmd << 8) | response | (transfer << 5));
+}
+
+unsigned int sdcard_queue_result(unsigned int *response) {
+	unsigned int evt;
+	while(!(sdcore_resultvalid_read() & 0x1));
+	evt = sdcore_resultevt_read();
+	if(response)
+		*response = sdcore_resultresponse_read();
+	sdcore_resultnext_write(1);
+	return evt;
+}
+
 /* commands */
 
 void sdcard_go_idle(void) {
@@ -301,6 +503,28 @@ int sdcard_send_csd(unsigned int rca) {
 	return sdcard_wait_response();
 }
 
+#ifdef CSR_SDPHY_VSWITCH_START_ADDR
+int sdcard_voltage_switch(void) {
+	int status;
+#ifdef SDCARD_DEBUG
+	printf("CMD11: VOLTAGE_SWITCH\n");
+#endif
+	/* the switch sequence runs at the end of the CMD11 response */
+	sdphy_vswitch_start_write(1);
+	sdcore_argument_write(0x00000000);
+	sdcore_command_write((11 << 8) | SDCARD_CTRL_RESPONSE_SHORT);
+	busy_wait(1);
+	status = sdcard_wait_response();
+	if(status != SD_OK)
+		return status;
+	while(!(sdphy_vswitch_done_read() & 0x1)) {
+		if(sdphy_vswitch_error_read() & 0x1)
+			return SD_TIMEOUT;
+	}
+	return SD_OK;
+}
+#endif
+
 int sdcard_select_card(unsigned int rca) {
 #ifdef SDCARD_DEBUG
 	printf("CMD7: SELECT_CARD\n");
@@ -312,10 +536,20 @@ int sdcard_select_card(unsigned int rca) {
 }
 
 int sdcard_app_set_bus_width(void) {
+	unsigned int buswidth;
+
 #ifdef SDCARD_DEBUG
 	printf("ACMD6: SET_BUS_WIDTH\n");
 #endif
-	sdcore_argument_write(0x00000002);
+	/* SD cards have 4 data lines: 4-bit bus, 1-bit on a single data line
+	   phy, the lines 4-7 of an 8 data lines phy (eMMC) would not be driven */
+	buswidth = sdphy_buswidth_read();
+	if (buswidth > 4)
+		return SD_BUSWIDTHERROR;
+	if (buswidth == 1)
+		sdcore_argument_write(0x00000000);
+	else
+		sdcore_argument_write(0x00000002);
 	sdcore_command_write((6 << 8) | SDCARD_CTRL_RESPONSE_SHORT);
 	busy_wait(1);
 	return sdcard_wait_response();
@@ -462,6 +696,68 @@ int sdcard_set_block_count(unsigned int blockcnt) {
 	return sdcard_wait_response();
 }
 
+/* emmc commands */
+
+int sdcard_emmc_send_op_cond(void) {
+#ifdef SDCARD_DEBUG
+	printf("CMD1: SEND_OP_COND\n");
+#endif
+	/* sector mode, 1.70-1.95V and 2.7-3.6V */
+	sdcore_argument_write(0x40ff8080);
+	sdcore_command_write((1 << 8) | SDCARD_CTRL_RESPONSE_SHORT);
+	busy_wait(1);
+	return sdcard_wait_response();
+}
+
+int sdcard_emmc_set_relative_address(unsigned int rca) {
+#ifdef SDCARD_DEBUG
+	printf("CMD3: SET_RELATIVE_ADDR\n");
+#endif
+	sdcore_argument_write(rca << 16);
+	sdcore_command_write((3 << 8) | SDCARD_CTRL_RESPONSE_SHORT);
+	busy_wait(1);
+	return sdcard_wait_response();
+}
+
+int sdcard_emmc_switch(unsigned int rca, unsigned int index, unsigned int value) {
+	int status;
+#ifdef SDCARD_DEBUG
+	printf("CMD6: SWITCH\n");
+#endif
+	/* write byte index of the EXT_CSD */
+	sdcore_argument_write((3 << 24) | (index << 16) | (value << 8));
+	sdcore_command_write((6 << 8) | SDCARD_CTRL_RESPONSE_SHORT);
+	busy_wait(1);
+	status = sdcard_wait_response();
+	if(status != SD_OK)
+		return status;
+	/* wait end of busy */
+	do {
+		status = sdcard_send_status(rca);
+		if(status != SD_OK)
+			return status;
+	} while(!(sdcard_card_status() & SDCARD_CARDSTATUS_READY));
+	/* switch result */
+	if(sdcard_response[3] & EMMC_STATUS_SWITCH_ERROR)
+		return SD_SWITCHERROR;
+	return SD_OK;
+}
+
+int sdcard_emmc_send_ext_csd(void) {
+#ifdef SDCARD_DEBUG
+	printf("CMD8: SEND_EXT_CSD\n");
+#endif
+	sdcore_argument_write(0x00000000);
+	sdcore_blocksize_write(512);
+	sdcore_blockcount_write(1);
+	sdcore_command_write((8 << 8) | SDCARD_CTRL_RESPONSE_SHORT |
+						 (SDCARD_CTRL_DATA_TRANSFER_READ << 5));
+	busy_wait(1);
+	sdcard_wait_response();
+	busy_wait(1);
+	return sdcard_wait_data_done();
+}
+
 void sdcard_decode_cid(void) {
 	printf(
 		"CID Register: 0x%08x%08x%08x%08x\n"
@@ -507,6 +803,7 @@ void sdcard_decode_csd(void) {
 
 /* bist */
 
+#ifdef CSR_BIST_GENERATOR_BASE
 void sdcard_bist_generator_start(unsigned int blockcnt) {
 	bist_generator_reset_write(1);
 	bist_generator_count_write(blockcnt);
@@ -516,8 +813,10 @@ void sdcard_bist_generator_start(unsigned int blockcnt) {
 void sdcard_bist_generator_wait(void) {
 	while((bist_generator_done_read() & 0x1) == 0);
 }
+#endif
 
 
+#ifdef CSR_BIST_CHECKER_BASE
 void sdcard_bist_checker_start(unsigned int blockcnt) {
 	bist_checker_reset_write(1);
 	bist_checker_count_write(blockcnt);
@@ -527,26 +826,331 @@ void sdcard_bist_checker_start(unsigned int blockcnt) {
 void sdcard_bist_checker_wait(void) {
 	while((bist_checker_done_read() & 0x1) == 0);
 }
+#endif
+
+/* dma */
+
+#ifdef CSR_SDBLOCK2MEM_BASE
+void sdcard_block2mem_start(unsigned int base, unsigned int length) {
+	sdblock2mem_base_write(base);
+	sdblock2mem_length_write(length);
+	sdblock2mem_start_write(1);
+}
+
+unsigned int sdcard_block2mem_wait(void) {
+	while((sdblock2mem_done_read() & 0x1) == 0);
+	return sdblock2mem_cycles_read();
+}
+#endif
+
+#ifdef CSR_SDMEM2BLOCK_BASE
+void sdcard_mem2block_start(unsigned int base, unsigned int length) {
+	sdmem2block_base_write(base);
+	sdmem2block_length_write(length);
+	sdmem2block_start_write(1);
+}
+
+unsigned int sdcard_mem2block_wait(void) {
+	while((sdmem2block_done_read() & 0x1) == 0);
+	return sdmem2block_cycles_read();
+}
+#endif
+
+/* speed negotiation */
+
+#ifdef CSR_SDBLOCK2MEM_BASE
+/* card clock (MHz) of the access modes, a mode is only used above the
+   clock of the slower one */
+static const unsigned int sdcard_speed_freqs[5]    = {25, 50, 100, 208, 50};
+static const unsigned int sdcard_speed_minfreqs[5] = { 0, 25,  50, 100, 25};
+
+/* access modes from the fastest to the slowest */
+static const unsigned int sdcard_speed_order[5] = {
+	SD_SPEED_SDR104,
+	SD_SPEED_SDR50,
+	SD_SPEED_DDR50,
+	SD_SPEED_SDR25,
+	SD_SPEED_SDR12
+};
+
+static unsigned int sdcard_buffer[512/4];
+static int sdcard_uhs;
+
+static void sdcard_buffer_start(unsigned int length) {
+	sdcard_block2mem_start((unsigned int)sdcard_buffer, length);
+}
+
+static int sdcard_buffer_wait(int status) {
+	if(status != SD_OK)
+		return status;
+	sdcard_block2mem_wait();
+	flush_cpu_dcache();
+#ifdef L2_SIZE
+	flush_l2_cache();
+#endif
+	return SD_OK;
+}
+
+/* first byte of the blocks in the upper bits of the words */
+static unsigned int sdcard_buffer_byte(unsigned int n) {
+	return (sdcard_buffer[n/4] >> (24 - 8*(n%4))) & 0xff;
+}
+
+static int sdcard_speed_check(void) {
+#ifdef SDCARD_DEBUG
+	printf("CMD17: READ_SINGLE_BLOCK (speed check)\n");
+#endif
+	int status;
+	sdcard_buffer_start(512);
+	sdcore_argument_write(0);
+	sdcore_blocksize_write(512);
+	sdcore_blockcount_write(1);
+	sdcore_command_write((17 << 8) | SDCARD_CTRL_RESPONSE_SHORT |
+						 (SDCARD_CTRL_DATA_TRANSFER_READ << 5));
+	busy_wait(1);
+	status = sdcard_wait_response();
+	if(status != SD_OK)
+		return status;
+	busy_wait(1);
+	return sdcard_buffer_wait(sdcard_wait_data_done());
+}
+
+int sdcard_negotiate_speed(unsigned int maxfreq) {
+	int i;
+	unsigned int speed;
+	unsigned int mode;
+	unsigned int freq;
+	unsigned int support;
+
+	/* scr: CMD6 is supported from version 1.10 of the specification */
+	sdcard_app_cmd(rca);
+	sdcard_buffer_start(8);
+	if(sdcard_buffer_wait(sdcard_app_send_scr()) != SD_OK)
+		return -1;
+	sdcard_sbc = (sdcard_buffer_byte(3) >> 1) & 0x1;
+	support = 1 << SD_SPEED_SDR12;
+	if((sdcard_buffer_byte(0) & 0xf) != 0) {
+		/* check mode: access modes supported by the card (bits 415:400) */
+		sdcard_buffer_start(64);
+		if(sdcard_buffer_wait(sdcard_switch(SD_SWITCH_CHECK, SD_GROUP_ACCESSMODE, 0xf, 0)) != SD_OK)
+			return -1;
+		support |= (sdcard_buffer_byte(12) << 8) | sdcard_buffer_byte(13);
+	}
+
+	/* UHS-I modes need 1.8v signaling */
+	if(!sdcard_uhs)
+		support &= (1 << SD_SPEED_SDR12) | (1 << SD_SPEED_SDR25);
+#ifndef CSR_SDPHY_DDR_ADDR
+	/* DDR50 needs the phase shifted data clock of the phy */
+	support &= ~(1 << SD_SPEED_DDR50);
+#endif
+#ifdef SDCARD_DEBUG
+	printf("speed: scr %02x%02x, access modes %04x\n",
+		sdcard_buffer_byte(0), sdcard_buffer_byte(1), support);
+#endif
+
+	/* fastest mode first, fall back to the next one when the switch or
+	   the test read fails */
+	mode = SD_SPEED_SDR12;
+	for(i=0; i<5; i++) {
+		speed = sdcard_speed_order[i];
+		if(!(support & (1 << speed)) || (maxfreq <= sdcard_speed_minfreqs[speed]))
+			continue;
+
+		/* switch at a clock supported by all the modes */
+		sdclk_set_clk(sdcard_speed_freqs[SD_SPEED_SDR12]);
+		sdcard_set_ddr(mode == SD_SPEED_DDR50);
+		sdcard_buffer_start(64);
+		if(sdcard_buffer_wait(sdcard_switch(SD_SWITCH_SWITCH, SD_GROUP_ACCESSMODE, speed, 0)) != SD_OK)
+			continue;
+		/* function selected in the access mode group (bits 379:376) */
+		if((sdcard_buffer_byte(16) & 0xf) != speed)
+			continue;
+		mode = speed;
+
+		freq = sdcard_speed_freqs[speed];
+		if(freq > maxfreq)
+			freq = maxfreq;
+		sdclk_set_clk(freq);
+		sdcard_set_ddr(speed == SD_SPEED_DDR50);
+#ifdef CSR_SDTUNER_BASE
+		if((speed == SD_SPEED_SDR50) || (speed == SD_SPEED_SDR104))
+			if(sdcard_tune() != SD_OK)
+				continue;
+#endif
+		if(sdcard_speed_check() == SD_OK) {
+#ifdef SDCARD_DEBUG
+			printf("speed: access mode %d at %dMHz\n", speed, freq);
+#endif
+			return speed;
+		}
+	}
+	return -1;
+}
+
+/* emmc timings: card clock (MHz) and EXT_CSD device type needed */
+static const unsigned int sdcard_emmc_timing_freqs[3] = {26, 52, 200};
+static const unsigned int sdcard_emmc_timing_types[3] = {
+	0,
+	EMMC_DEVICE_TYPE_HS_52,
+	EMMC_DEVICE_TYPE_HS200_1_8V
+};
+
+int sdcard_emmc_negotiate_timing(unsigned int maxfreq) {
+	int timing;
+	unsigned int type;
+	unsigned int freq;
+
+	/* device types supported by the device */
+	sdcard_buffer_start(512);
+	if(sdcard_buffer_wait(sdcard_emmc_send_ext_csd()) != SD_OK)
+		return -1;
+	type = sdcard_buffer_byte(EMMC_EXT_CSD_DEVICE_TYPE);
+#ifdef SDCARD_DEBUG
+	printf("timing: device type %02x\n", type);
+#endif
+
+	/* fastest timing first (HS200 needs 1.8V I/Os and 4/8 data lines),
+	   fall back to the next one when the switch or the test read fails */
+	for(timing=EMMC_HS_TIMING_HS200; timing>=EMMC_HS_TIMING_LEGACY; timing--) {
+		if((type & sdcard_emmc_timing_types[timing]) != sdcard_emmc_timing_types[timing])
+			continue;
+		if((timing == EMMC_HS_TIMING_HS200) &&
+		   ((maxfreq <= sdcard_emmc_timing_freqs[EMMC_HS_TIMING_HS]) || (sdphy_buswidth_read() == 1)))
+			continue;
+
+		/* switch at a clock supported by all the timings */
+		sdclk_set_clk(sdcard_emmc_timing_freqs[EMMC_HS_TIMING_LEGACY]);
+		if(sdcard_emmc_switch(rca, EMMC_EXT_CSD_HS_TIMING, timing) != SD_OK)
+			continue;
+
+		freq = sdcard_emmc_timing_freqs[timing];
+		if(freq > maxfreq)
+			freq = maxfreq;
+		sdclk_set_clk(freq);
+#ifdef CSR_SDTUNER_BASE
+		if(timing == EMMC_HS_TIMING_HS200)
+			if(sdcard_tune() != SD_OK)
+				continue;
+#endif
+		if(sdcard_speed_check() == SD_OK) {
+#ifdef SDCARD_DEBUG
+			printf("timing: %d at %dMHz\n", timing, freq);
+#endif
+			return timing;
+		}
+	}
+	return -1;
+}
+#endif
+
+/* initializer */
+
+#ifdef CSR_SDINIT_BASE
+int sdcard_hw_init(void) {
+	sdinit_start_write(1);
+	while(!(sdinit_done_read() & 0x1)) {
+		if(sdinit_error_read() & 0x1) {
+#ifdef SDCARD_DEBUG
+			printf("sdinit: error at step %d\n", sdinit_step_read());
+#endif
+			return SD_TIMEOUT;
+		}
+	}
+	rca = sdinit_rca_read();
+	return SD_OK;
+}
+#endif
+
+/* recorder */
+
+#ifdef CSR_SDRECORDER_BASE
+void sdcard_recorder_start(unsigned int base, unsigned int size, unsigned int chunk, int erase) {
+	sdrecorder_enable_write(0);
+	sdrecorder_base_write(base);
+	sdrecorder_size_write(size);
+	sdrecorder_chunk_write(chunk);
+	sdrecorder_erase_write(erase);
+	sdrecorder_enable_write(1);
+}
+
+void sdcard_recorder_stop(void) {
+	sdrecorder_enable_write(0);
+}
+
+unsigned int sdcard_recorder_wp(void) {
+	return sdrecorder_wp_read();
+}
+#endif
+
+/* player */
+
+#ifdef CSR_SDPLAYER_BASE
+void sdcard_player_start(unsigned int base, unsigned int size, unsigned int chunk, int loop) {
+	sdplayer_enable_write(0);
+	sdplayer_base_write(base);
+	sdplayer_size_write(size);
+	sdplayer_chunk_write(chunk);
+	sdplayer_loop_write(loop);
+	sdplayer_enable_write(1);
+}
+
+void sdcard_player_stop(void) {
+	sdplayer_enable_write(0);
+}
+
+unsigned int sdcard_player_rp(void) {
+	return sdplayer_rp_read();
+}
+#endif
 
 /* user */
 
 int sdcard_init(void) {
+	/* R6 response to CMD3 */
+	sdcore_emmc_write(0);
+	sdcard_sbc = 0;
+#ifdef CSR_SDBLOCK2MEM_BASE
+	sdcard_uhs = 0;
+#endif
+
+#if defined(CSR_SDINIT_BASE) && !defined(CSR_SDPHY_VSWITCH_START_ADDR)
+	/* identification, selection, bus width and block length done by the
+	   hardware sequencer (1.8v signaling is not requested, the software
+	   identification is used when the phy can switch) */
+	if (sdcard_hw_init() != SD_OK)
+		return SD_TIMEOUT;
+#else
 	/* reset card */
 	sdcard_go_idle();
 	busy_wait(1);
 	sdcard_send_ext_csd();
 
 	/* wait for card to be ready */
-	/* FIXME: 1.8v support */
 	for(;;) {
 		sdcard_app_cmd(0);
+#ifdef CSR_SDPHY_VSWITCH_START_ADDR
+		sdcard_app_send_op_cond(1, 1);
+#else
 		sdcard_app_send_op_cond(1, 0);
+#endif
 		if (sdcard_response[3] & 0x80000000) {
 			break;
 		}
 		busy_wait(1);
 	}
 
+#ifdef CSR_SDPHY_VSWITCH_START_ADDR
+	/* switch to 1.8v signaling when accepted by the card (S18A) */
+	if (sdcard_response[3] & 0x01000000) {
+		if (sdcard_voltage_switch() != SD_OK)
+			return SD_TIMEOUT;
+#ifdef CSR_SDBLOCK2MEM_BASE
+		sdcard_uhs = 1;
+#endif
+	}
+#endif
+
 	/* send identification */
 	sdcard_all_send_cid();
 #ifdef SDCARD_DEBUG
@@ -555,7 +1159,7 @@ int sdcard_init(void) {
 
 	/* set relative card address */
 	sdcard_set_relative_address();
-	rca = (sdcard_response[3] >> 16) & 0xffff;
+	rca = sdcard_card_rca();
 
 	/* set cid */
 	sdcard_send_cid(rca);
@@ -574,25 +1178,88 @@ int sdcard_init(void) {
 
 	/* set bus width */
 	sdcard_app_cmd(rca);
-	sdcard_app_set_bus_width();
+	if (sdcard_app_set_bus_width() != SD_OK)
+		return SD_BUSWIDTHERROR;
 
-	/* switch speed */
-	sdcard_switch(SD_SWITCH_SWITCH, SD_GROUP_ACCESSMODE, SD_SPEED_SDR104, SRAM_BASE);
+	/* set block length */
+	sdcard_app_set_blocklen(512);
+#endif
 
-	/* switch driver strength */
-	sdcard_switch(SD_SWITCH_SWITCH, SD_GROUP_DRIVERSTRENGTH, SD_DRIVER_STRENGTH_D, SRAM_BASE);
+	/* switch to the fastest access mode supported by the card */
+#ifdef CSR_SDBLOCK2MEM_BASE
+	if (sdcard_negotiate_speed(SDCARD_MAX_FREQ) < 0)
+		return SD_CRCERROR;
+#else
+	/* no status can be read back, high speed is supported by all the
+	   CMD6 capable cards */
+	sdcard_switch(SD_SWITCH_SWITCH, SD_GROUP_ACCESSMODE, SD_SPEED_SDR25, SRAM_BASE);
+#endif
 
-	/* send scr */
-	/* FIXME: add scr decoding (optional) */
-	sdcard_app_cmd(rca);
-	sdcard_app_send_scr();
+	return 0;
+}
+
+int sdcard_emmc_init(void) {
+	unsigned int buswidth;
+
+	/* R1 response to CMD3, CMD1 not decoded */
+	sdcore_emmc_write(1);
+	sdcard_sbc = 1;
+
+	/* reset device */
+	sdcard_go_idle();
+	busy_wait(1);
+
+	/* wait for device to be ready */
+	for(;;) {
+		sdcard_emmc_send_op_cond();
+		if (sdcard_response[3] & 0x80000000) {
+			break;
+		}
+		busy_wait(1);
+	}
+
+	/* send identification */
+	sdcard_all_send_cid();
+#ifdef SDCARD_DEBUG
+	sdcard_decode_cid();
+#endif
+
+	/* set relative device address */
+	rca = EMMC_RCA;
+	sdcard_emmc_set_relative_address(rca);
+
+	/* set csd */
+	sdcard_send_csd(rca);
+#ifdef SDCARD_DEBUG
+	sdcard_decode_csd();
+#endif
+
+	/* select device */
+	sdcard_select_card(rca);
+
+	/* set bus width (data lines of the phy) */
+	buswidth = sdphy_buswidth_read();
+	if (buswidth == 8) {
+		if (sdcard_emmc_switch(rca, EMMC_EXT_CSD_BUS_WIDTH, EMMC_BUS_WIDTH_8) != SD_OK)
+			return SD_SWITCHERROR;
+	} else if (buswidth == 4) {
+		if (sdcard_emmc_switch(rca, EMMC_EXT_CSD_BUS_WIDTH, EMMC_BUS_WIDTH_4) != SD_OK)
+			return SD_SWITCHERROR;
+	}
 
 	/* set block length */
 	sdcard_app_set_blocklen(512);
 
+	/* switch to the fastest timing supported by the device */
+#ifdef CSR_SDBLOCK2MEM_BASE
+	if (sdcard_emmc_negotiate_timing(SDCARD_MAX_FREQ) < 0)
+		return SD_CRCERROR;
+#endif
+
 	return 0;
 }
 
+#ifdef CSR_BIST_CHECKER_BASE
 int sdcard_test(unsigned int loops) {
 	unsigned int i;
 	unsigned int length;
@@ -607,26 +1274,28 @@ int sdcard_test(unsigned int loops) {
 
 	sdtimer_init();
 
+	sdcard_set_autocmd(sdcard_sbc);
+	sdcard_set_autopoll(1, 1<<12);
+	sdcore_ev_pending_write(SDCARD_EV_CARDREADY);
+
 	length = 4*1024*1024;
 	blocks = length/512;
 
 	for(i=0; i<loops; i++) {
 		/* write */
 		start = sdtimer_get();
-		sdcard_set_block_count(blocks);
 		sdcard_bist_generator_start(blocks);
 		sdcard_write_multiple_block(i, blocks);
 		sdcard_bist_generator_wait();
-		sdcard_stop_transmission();
 		end = sdtimer_get();
 		write_speed = length*(SYSTEM_CLOCK_FREQUENCY/100000)/((start - end)/100000);
 
-		/* delay FIXME */
-		busy_wait(200);
+		/* wait end of programming */
+		if(sdcard_wait_card_ready() != SD_OK)
+			printf("card still busy after the write\n");
 
 		/* read */
 		start = sdtimer_get();
-		sdcard_set_block_count(blocks);
 		sdcard_bist_checker_start(blocks);
 		sdcard_read_multiple_block(i, blocks);
 		sdcard_bist_checker_wait();
@@ -649,3 +1318,4 @@ int sdcard_test(unsigned int loops) {
 
 	return 0;
 }
+#endif
@@ -2,11 +2,14 @@
 #define __SDCARD_H
 
 #include <generated/csr.h>
+#include <generated/mem.h>
 
 #define SD_OK         0
 #define SD_CRCERROR   1
 #define SD_TIMEOUT    2
 #define SD_WRITEERROR 3
+#define SD_BUSWIDTHERROR 4
+#define SD_SWITCHERROR   5
 
 #define SD_SWITCH_CHECK  0
 #define SD_SWITCH_SWITCH 1
@@ -41,6 +44,58 @@
 #define SDCARD_CTRL_RESPONSE_SHORT 1
 #define SDCARD_CTRL_RESPONSE_LONG  2
 
+#define SDCARD_EV_CMDDONE    (1 << 0)
+#define SDCARD_EV_DATADONE   (1 << 1)
+#define SDCARD_EV_CRCERROR   (1 << 2)
+#define SDCARD_EV_TIMEOUT    (1 << 3)
+#define SDCARD_EV_WRITEERROR (1 << 4)
+#define SDCARD_EV_CARDREADY  (1 << 5)
+#define SDCARD_EV_CMDQOVERFLOW (1 << 6)
+
+#define SDCARD_CMDEVT_CARDERROR  (1 << 4)
+#define SDCARD_CMDEVT_CHECKERROR (1 << 5)
+
+#define SDCARD_CARDSTATUS_ERRORS      0x00001fbf
+#define SDCARD_CARDSTATUS_LOCKED      (1 << 6)
+#define SDCARD_CARDSTATUS_STATE_SHIFT 13
+#define SDCARD_CARDSTATUS_READY       (1 << 17)
+#define SDCARD_CARDSTATUS_APPCMD      (1 << 18)
+#define SDCARD_CARDSTATUS_ECHO_SHIFT  20
+
+#define SDCARD_TRACE_CMD         (1 << 0)
+#define SDCARD_TRACE_RESPONSE    (1 << 1)
+#define SDCARD_TRACE_BLOCKSTART  (1 << 2)
+#define SDCARD_TRACE_BLOCKEND    (1 << 3)
+#define SDCARD_TRACE_CRCVALID    (1 << 4)
+#define SDCARD_TRACE_CRCERROR    (1 << 5)
+#define SDCARD_TRACE_BUSYRELEASE (1 << 6)
+#define SDCARD_TRACE_DONE        (1 << 7)
+
+#define EMMC_RCA 1
+
+#define EMMC_EXT_CSD_BUS_WIDTH   183
+#define EMMC_EXT_CSD_HS_TIMING   185
+#define EMMC_EXT_CSD_DEVICE_TYPE 196
+
+#define EMMC_BUS_WIDTH_1 0
+#define EMMC_BUS_WIDTH_4 1
+#define EMMC_BUS_WIDTH_8 2
+
+/* card status bit of a rejected SWITCH (R1 of the next CMD13) */
+#define EMMC_STATUS_SWITCH_ERROR (1 << 7)
+
+#define EMMC_HS_TIMING_LEGACY 0
+#define EMMC_HS_TIMING_HS     1
+#define EMMC_HS_TIMING_HS200  2
+
+#define EMMC_DEVICE_TYPE_HS_26      (1 << 0)
+#define EMMC_DEVICE_TYPE_HS_52      (1 << 1)
+#define EMMC_DEVICE_TYPE_HS200_1_8V (1 << 4)
+
+#define SDCARD_CTRL_AUTOCMD_NONE  0b00
+#define SDCARD_CTRL_AUTOCMD_CMD23 0b01
+#define SDCARD_CTRL_AUTOCMD_CMD12 0b10
+
 unsigned short rca;
 
 /* clocking */
@@ -52,11 +107,72 @@ void sdclk_set_clk(unsigned int freq);
 int sdcard_wait_cmd_done(void);
 int sdcard_wait_data_done(void);
 int sdcard_wait_response(void);
+unsigned int sdcard_card_status(void);
+unsigned int sdcard_card_rca(void);
+
+/* mailbox */
+
+#ifdef SDMAILBOX_BASE
+unsigned int sdcard_mailbox_read(unsigned int *mailbox);
+#endif
+
+/* stats */
+
+#ifdef CSR_SDCORE_STATS_CLEAR_ADDR
+void sdcard_stats_clear(void);
+void sdcard_stats_print(void);
+#endif
+
+/* interrupts */
+
+#ifdef SDCORE_INTERRUPT
+void sdcard_isr(void);
+void sdcard_irq_init(unsigned int events);
+unsigned int sdcard_wait_event(unsigned int events);
+#endif
+
+/* auto commands */
+
+void sdcard_set_autocmd(int cmd_support_sbc);
+
+/* retries */
+
+void sdcard_set_retry(unsigned int maxretry);
+unsigned int sdcard_retry_count(void);
+
+/* auto polling */
+
+void sdcard_set_autopoll(int enable, unsigned int interval);
+int sdcard_wait_card_ready(void);
+
+/* abort */
+
+void sdcard_abort(void);
+unsigned int sdcard_blocks(void);
+
+/* phy */
+
+void sdcard_set_ddr(int enable);
+
+/* tuner */
+
+#ifdef CSR_SDTUNER_BASE
+int sdcard_tune(void);
+#endif
+
+/* command queue */
+
+void sdcard_queue_command(unsigned int cmd, unsigned int arg, unsigned int response,
+	unsigned int transfer, unsigned int blocksize, unsigned int blockcnt);
+unsigned int sdcard_queue_result(unsigned int *response);
 
 /* commands */
 
 void sdcard_go_idle(void);
 int sdcard_send_ext_csd(void);
+#ifdef CSR_SDPHY_VSWITCH_START_ADDR
+int sdcard_voltage_switch(void);
+#endif
 int sdcard_app_cmd(int rca);
 int sdcard_app_send_op_cond(int hcc, int s18r);
 int sdcard_all_send_cid(void);
@@ -79,16 +195,68 @@ int sdcard_stop_transmission(void);
 int sdcard_send_status(unsigned int rca);
 int sdcard_set_block_count(unsigned int blockcnt);
 
+/* emmc commands */
+
+int sdcard_emmc_send_op_cond(void);
+int sdcard_emmc_set_relative_address(unsigned int rca);
+int sdcard_emmc_switch(unsigned int rca, unsigned int index, unsigned int value);
+int sdcard_emmc_send_ext_csd(void);
+
 /* bist */
 
+#ifdef CSR_BIST_GENERATOR_BASE
 void sdcard_bist_generator_start(unsigned int blockcnt);
 void sdcard_bist_generator_wait(void);
+#endif
+#ifdef CSR_BIST_CHECKER_BASE
 void sdcard_bist_checker_start(unsigned int blockcnt);
 void sdcard_bist_checker_wait(void);
+#endif
+
+/* dma */
+
+#ifdef CSR_SDBLOCK2MEM_BASE
+void sdcard_block2mem_start(unsigned int base, unsigned int length);
+unsigned int sdcard_block2mem_wait(void);
+#endif
+#ifdef CSR_SDMEM2BLOCK_BASE
+void sdcard_mem2block_start(unsigned int base, unsigned int length);
+unsigned int sdcard_mem2block_wait(void);
+#endif
+
+/* speed negotiation */
+
+#ifndef SDCARD_MAX_FREQ
+#define SDCARD_MAX_FREQ 100
+#endif
+
+#ifdef CSR_SDBLOCK2MEM_BASE
+int sdcard_negotiate_speed(unsigned int maxfreq);
+int sdcard_emmc_negotiate_timing(unsigned int maxfreq);
+#endif
+
+/* initializer */
+
+#ifdef CSR_SDINIT_BASE
+int sdcard_hw_init(void);
+#endif
+#ifdef CSR_SDRECORDER_BASE
+void sdcard_recorder_start(unsigned int base, unsigned int size, unsigned int chunk, int erase);
+void sdcard_recorder_stop(void);
+unsigned int sdcard_recorder_wp(void);
+#endif
+#ifdef CSR_SDPLAYER_BASE
+void sdcard_player_start(unsigned int base, unsigned int size, unsigned int chunk, int loop);
+void sdcard_player_stop(void);
+unsigned int sdcard_player_rp(void);
+#endif
 
 /* user */
 
 int sdcard_init(void);
+int sdcard_emmc_init(void);
+#ifdef CSR_BIST_CHECKER_BASE
 int sdcard_test(unsigned int loops);
+#endif
 
 #endif /* __SDCARD_H */
@@ -0,0 +1,255 @@
+"""Card initialization sequencer running the SD identification on SDCore."""
+
+from litex.gen import *
+
+from litex.soc.interconnect.csr import *
+
+from litesdcard.common import *
+
+
+def _command(index, response, transfer=SDCARD_CTRL_DATA_TRANSFER_NONE):
+    return (index << 8) | response | (transfer << 5)
+
+
+class SDInitializer(Module, AutoCSR):
+    """Run the card identification and bring-up sequence on SDCore
+
+    Commands are sent through an SDCore port, locked during the sequence:
+        CMD0, CMD8, (CMD55, ACMD41) until the card is ready, CMD2, CMD3, CMD9,
+        CMD7, CMD55, ACMD6 (buswidth bits bus), CMD55, ACMD51, CMD6 (switch
+        to the access mode in speed, only when the SCR reports SD 1.10 or
+        later), CMD16 (512 bytes blocks)
+
+    buswidth must be the number of data lines of the PHY (1 or 4).
+
+    The sequence is started by start, by insert (card detect) and after reset
+    when autostart is set. delay (sys clock cycles) is waited before CMD0
+    and between ACMD41 polls.
+
+    mode is the access mode the card runs in once done is set: speed when
+    the switch status reports it selected, SD_SPEED_SDR12 otherwise.
+    clk_sel selects the sd clock: 0 (identification, <= 400kHz) until done,
+    then 1 + mode. It is meant to drive the sel of a clocker built with
+    freqs=[ident, sdr12, sdr25, ...] so the clock is raised in hardware.
+
+    The data blocks read by the sequence (SCR and switch status) are taken
+    from the port. On a failure, error is set and step holds the failing
+    step.
+    """
+    def __init__(self, core, buswidth=4, autostart=True, acmd41_tries=1024):
+        assert buswidth in [1, 4]
+        sdcore = core.get_port()
+        data_width = len(sdcore.source.data)
+        self.insert = Signal()
+
+        self.start = CSR()
+        self.delay = CSRStorage(32, reset=2**17)
+        self.speed = CSRStorage(4, reset=SD_SPEED_SDR25)
+        self.done = CSRStatus()
+        self.error = CSRStatus()
+        self.step = CSRStatus(4)
+        self.mode = CSRStatus(4)
+        self.clk_sel = Signal(3)
+
+        self.ocr = CSRStatus(32)
+        self.rca = CSRStatus(16)
+        self.cid = CSRStatus(120)
+        self.csd = CSRStatus(120)
+        self.scr = CSRStatus(64)
+
+        # # #
+
+        start = Signal()
+        started = Signal()
+        busy = Signal()
+        done = Signal()
+        error = Signal()
+        step = Signal(4)
+        delay = Signal(32)
+        tries = Signal(max=acmd41_tries+1)
+        cmdevt = Signal(32)
+        dataevt = Signal(32)
+        response = Signal(120)
+        words = Signal(max=512//data_width + 1)
+        mode = Signal(4)
+        switched = Signal(4)
+
+        ocr = Signal(32)
+        rca = Signal(16)
+        rcaarg = Signal(32)
+        switcharg = Signal(32)
+        cid = Signal(120)
+        csd = Signal(120)
+        scr = Signal(64)
+
+        self.sync += started.eq(1)
+        self.comb += [
+            rcaarg.eq(Cat(Replicate(0, 16), rca)),
+            switcharg.eq(Cat(self.speed.storage, C(0xfffff, 20), C(0, 7), C(1, 1)))
+        ]
+        self.comb += [
+            start.eq(self.start.re | self.insert | (~started & autostart)),
+            self.done.status.eq(done),
+            self.error.status.eq(error),
+            self.step.status.eq(step),
+            self.mode.status.eq(mode),
+            self.clk_sel.eq(Mux(done, mode + 1, 0)),
+            self.ocr.status.eq(ocr),
+            self.rca.status.eq(rca),
+            self.cid.status.eq(cid),
+            self.csd.status.eq(csd),
+            self.scr.status.eq(scr)
+        ]
+
+        self.comb += [
+            sdcore.lock.eq(busy),
+            sdcore.source.ready.eq(1)
+        ]
+
+        # Steps: command, argument, blocksize
+        steps = [
+            (_command( 0, SDCARD_CTRL_RESPONSE_NONE),  0x00000000, 0),
+            (_command( 8, SDCARD_CTRL_RESPONSE_SHORT), 0x000001aa, 0),
+            (_command(55, SDCARD_CTRL_RESPONSE_SHORT), 0x00000000, 0),
+            (_command(41, SDCARD_CTRL_RESPONSE_SHORT), 0x50ff8000, 0),
+            (_command( 2, SDCARD_CTRL_RESPONSE_LONG),  0x00000000, 0),
+            (_command( 3, SDCARD_CTRL_RESPONSE_SHORT), 0x00000000, 0),
+            (_command( 9, SDCARD_CTRL_RESPONSE_LONG),  rcaarg,     0),
+            (_command( 7, SDCARD_CTRL_RESPONSE_SHORT), rcaarg,     0),
+            (_command(55, SDCARD_CTRL_RESPONSE_SHORT), rcaarg,     0),
+            (_command( 6, SDCARD_CTRL_RESPONSE_SHORT), {1: 0, 4: 2}[buswidth], 0),
+            (_command(55, SDCARD_CTRL_RESPONSE_SHORT), rcaarg,     0),
+            (_command(51, SDCARD_CTRL_RESPONSE_SHORT,
+                SDCARD_CTRL_DATA_TRANSFER_READ),        0x00000000, 8),
+            (_command( 6, SDCARD_CTRL_RESPONSE_SHORT,
+                SDCARD_CTRL_DATA_TRANSFER_READ),        switcharg,  64),
+            (_command(16, SDCARD_CTRL_RESPONSE_SHORT), 0x00000200, 0)
+        ]
+        last = len(steps) - 1
+
+        commands = Array(C(c, 32) for c, a, b in steps)
+        arguments = Array(C(a, 32) if isinstance(a, int) else a for c, a, b in steps)
+        blocksizes = Array(C(b, 16) for c, a, b in steps)
+        datawords = Array(C((8*b + data_width - 1)//data_width, len(words)) for c, a, b in steps)
+
+        # Data blocks (first byte in the upper bits of the words): the SCR
+        # (ACMD51) and the access mode group result of the switch status
+        # (CMD6, bits 379:376, low nibble of byte 16)
+        if data_width == 32:
+            scr_next = Cat(sdcore.source.data, scr[0:32])
+        elif data_width == 64:
+            scr_next = sdcore.source.data
+        else:
+            scr_next = sdcore.source.data[64:128]
+        self.sync += \
+            If(sdcore.cmd_sink.valid,
+                words.eq(0)
+            ).Elif(busy & sdcore.source.valid & (words != datawords[step]),
+                words.eq(words + 1),
+                If(step == 11,
+                    scr.eq(scr_next)
+                ),
+                If((step == 12) & (words == (128//data_width)),
+                    switched.eq(sdcore.source.data[data_width-8:data_width-4])
+                )
+            )
+
+        # Error checks: response timeout or CRC (not for ACMD41, R3 has no
+        # CRC), card status errors, CMD8 echo and data errors
+        failed = Signal()
+        self.comb += failed.eq(
+            cmdevt[2] |
+            (cmdevt[3] & (step != 3)) |
+            cmdevt[4] |
+            cmdevt[5] |
+            (dataevt[1:4] != 0))
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        fsm.act("IDLE",
+            If(start,
+                NextValue(done, 0),
+                NextValue(error, 0),
+                NextValue(step, 0),
+                NextValue(mode, SD_SPEED_SDR12),
+                NextValue(tries, 0),
+                NextValue(delay, 0),
+                NextState("DELAY")
+            )
+        )
+        fsm.act("DELAY",
+            busy.eq(1),
+            NextValue(delay, delay + 1),
+            If(delay >= self.delay.storage,
+                NextState("CMD")
+            )
+        )
+        fsm.act("CMD",
+            busy.eq(1),
+            sdcore.cmd_sink.valid.eq(1),
+            sdcore.cmd_sink.command.eq(commands[step]),
+            sdcore.cmd_sink.argument.eq(arguments[step]),
+            sdcore.cmd_sink.blocksize.eq(blocksizes[step]),
+            sdcore.cmd_sink.blockcount.eq(1),
+            If(sdcore.cmd_sink.ready,
+                NextState("WAIT")
+            )
+        )
+        fsm.act("WAIT",
+            busy.eq(1),
+            sdcore.cmd_source.ready.eq(1),
+            If(sdcore.cmd_source.valid,
+                NextValue(cmdevt, sdcore.cmd_source.cmdevt),
+                NextValue(dataevt, sdcore.cmd_source.dataevt),
+                NextValue(response, sdcore.cmd_source.response),
+                NextState("DATA")
+            )
+        )
+        fsm.act("DATA",
+            busy.eq(1),
+            If(failed | (words == datawords[step]),
+                NextState("CHECK")
+            )
+        )
+        fsm.act("CHECK",
+            busy.eq(1),
+            NextValue(step, step + 1),
+            If(failed & (step != 0),
+                NextValue(error, 1),
+                NextValue(step, step),
+                NextState("IDLE")
+            ).Elif(step == 3,
+                # ACMD41: wait for the card to be ready
+                NextValue(ocr, response[0:32]),
+                If(~response[31],
+                    NextValue(tries, tries + 1),
+                    NextValue(step, 2),
+                    NextValue(delay, 0),
+                    If(tries == (acmd41_tries - 1),
+                        NextValue(error, 1),
+                        NextValue(step, step),
+                        NextState("IDLE")
+                    ).Else(
+                        NextState("DELAY")
+                    )
+                ).Else(
+                    NextState("CMD")
+                )
+            ).Elif(step == last,
+                NextValue(done, 1),
+                NextValue(step, step),
+                NextState("IDLE")
+            ).Else(
+                Case(step, {
+                    4: NextValue(cid, response),
+                    5: NextValue(rca, response[16:32]),
+                    6: NextValue(csd, response),
+                    # no CMD6 on SD 1.0 cards (SD_SPEC 0)
+                    11: If(scr[56:60] == 0, NextValue(step, 13)),
+                    12: If(switched == self.speed.storage,
+                            NextValue(mode, self.speed.storage)
+                        ),
+                    "default": []
+                }),
+                NextState("CMD")
+            )
+        )
@@ -6,12 +6,14 @@ from litex.soc.interconnect.csr import *
 from litesdcard.common import *
 
 
-def _sdpads():
+def _sdpads(data_width=4):
     sdpads = Record([
         ("data", [
-            ("i",  4, DIR_S_TO_M),
-            ("o",  4, DIR_M_TO_S),
-            ("oe", 1, DIR_M_TO_S)
+            ("i",   data_width, DIR_S_TO_M),
+            ("i_r", data_width, DIR_S_TO_M), # DDR: sampled on the sd rising edge (first nibble)
+            ("o",   data_width, DIR_M_TO_S),
+            ("o_f", data_width, DIR_M_TO_S), # DDR: driven on the sd falling edge (second nibble)
+            ("oe",  1,          DIR_M_TO_S)
         ]),
         ("cmd", [
             ("i",  1, DIR_S_TO_M),
@@ -22,8 +24,9 @@ def _sdpads():
     ])
     sdpads.cmd.o.reset = 1
     sdpads.cmd.oe.reset = 1
-    sdpads.data.o.reset = 0b1111
-    sdpads.data.oe.reset = 0b1111
+    sdpads.data.o.reset = 2**data_width - 1
+    sdpads.data.o_f.reset = 2**data_width - 1
+    sdpads.data.oe.reset = 1
     return sdpads
 
 
@@ -32,17 +35,19 @@ class SDPHYCFG(Module, AutoCSR):
         self.datatimeout = Signal(32)
         self.cmdtimeout = Signal(32)
         self.blocksize = Signal(16)
+        self.ddr = Signal()
 
 
 @ResetInserter()
 class SDPHYRFB(Module):
-    def __init__(self, idata, skip_start_bit=False):
+    def __init__(self, idata, skip_start_bit=False, idata_r=None):
         self.source = source = stream.Endpoint([("data", 8)])
+        self.ddr = Signal()
 
         # # #
 
         n = 8//len(idata)
-        sel = Signal(max=n)
+        sel = Signal(max=max(n, 2))
         data = Signal(8)
 
         self.submodules.fsm = fsm = ClockDomainsRenamer("sd_fb")(FSM(reset_state="IDLE"))
@@ -59,7 +64,7 @@ class SDPHYRFB(Module):
             )
         )
 
-        fsm.act("READ",
+        read = \
             If(sel == (n-1),
                 source.valid.eq(1),
                 source.data.eq(Cat(idata, data)),
@@ -68,12 +73,20 @@ class SDPHYRFB(Module):
                 NextValue(data, Cat(idata, data)),
                 NextValue(sel, sel + 1)
             )
-        )
+        if idata_r is not None:
+            read = \
+                If(self.ddr,
+                    # Both nibbles of a byte on each clock
+                    source.valid.eq(1),
+                    source.data.eq(Cat(idata, idata_r))
+                ).Else(read)
+
+        fsm.act("READ", read)
 
 
 class SDPHYCMDR(Module):
-    def __init__(self, cfg):
-        self.pads = pads = _sdpads()
+    def __init__(self, cfg, data_width=4):
+        self.pads = pads = _sdpads(data_width)
         self.sink = sink = stream.Endpoint([("data", 8)])
         self.source = source = stream.Endpoint([("data", 8), ("status", 3)])
 
@@ -164,8 +177,8 @@ class SDPHYCMDR(Module):
 
 
 class SDPHYCMDW(Module):
-    def __init__(self):
-        self.pads = pads = _sdpads()
+    def __init__(self, data_width=4):
+        self.pads = pads = _sdpads(data_width)
         self.sink = sink = stream.Endpoint([("data", 8)])
 
         # # #
@@ -202,7 +215,7 @@ class SDPHYCMDW(Module):
             If(cntinit < 80,
                 NextValue(cntinit, cntinit + 1),
                 NextValue(pads.data.oe, 1),
-                NextValue(pads.data.o, 0xf)
+                NextValue(pads.data.o, 2**data_width - 1)
             ).Else(
                 NextValue(cntinit, 0),
                 NextValue(isinit, 1),
@@ -240,8 +253,8 @@ class SDPHYCMDW(Module):
 
 
 class SDPHYDATAR(Module):
-    def __init__(self, cfg):
-        self.pads = pads = _sdpads()
+    def __init__(self, cfg, data_width=4):
+        self.pads = pads = _sdpads(data_width)
         self.sink = sink = stream.Endpoint([("data", 8)])
         self.source = source = stream.Endpoint([("data", 8), ("status", 3)])
 
@@ -249,7 +262,10 @@ class SDPHYDATAR(Module):
 
         datarfb_reset = Signal()
 
-        self.submodules.datarfb = SDPHYRFB(pads.data.i, True)
+        # DDR on 4 lines only (DDR50)
+        self.submodules.datarfb = SDPHYRFB(pads.data.i, True,
+            pads.data.i_r if data_width == 4 else None)
+        self.specials += MultiReg(cfg.ddr, self.datarfb.ddr, "sd_fb")
         self.submodules.cdc = ClockDomainsRenamer({"write": "sd_fb", "read": "sd"})(
             stream.AsyncFIFO(self.datarfb.source.description, 4)
         )
@@ -272,8 +288,9 @@ class SDPHYDATAR(Module):
             If(sink.valid,
                 NextValue(dtimeout, 0),
                 NextValue(read, 0),
-                # Read 1 block + 8*8 == 64 bits CRC
-                NextValue(toread, cfg.blocksize + 8),
+                # Read 1 block + 16 bits CRC per line (twice in DDR)
+                NextValue(toread, cfg.blocksize +
+                    (Mux(cfg.ddr, 16, 8) if data_width == 4 else 2*data_width)),
                 NextState("DATA_READSTART")
             )
         )
@@ -326,7 +343,7 @@ class SDPHYDATAR(Module):
 
         fsm.act("DATA_CLK40",
             pads.data.oe.eq(1),
-            pads.data.o.eq(0xf),
+            pads.data.o.eq(2**data_width - 1),
             If(cnt < 40,
                 NextValue(cnt, cnt + 1),
                 pads.clk.eq(1)
@@ -412,13 +429,14 @@ class SDPHYCRCRFB(Module):
 
 
 class SDPHYDATAW(Module):
-    def __init__(self):
-        self.pads = pads = _sdpads()
+    def __init__(self, cfg, data_width=4):
+        self.pads = pads = _sdpads(data_width)
         self.sink = sink = stream.Endpoint([("data", 8)])
 
         self.crc_clear = Signal()
         self.crc_valids = Signal(32)
         self.crc_errors = Signal(32)
+        self.busy_release = Signal()
 
         # # #
 
@@ -440,46 +458,99 @@ class SDPHYDATAW(Module):
             )
         ]
 
+        # Bytes are sent in nbits clocks, highest bits first, the byte is
+        # acknowledged with its last bits
+        nbits = 8//data_width
+        sel = Signal(max=max(nbits, 2))
+        chunks = Array(sink.data[data_width*(nbits-1-k):data_width*(nbits-k)]
+            for k in range(nbits))
+
+        def write_first():
+            if nbits == 1:
+                return [
+                    If(sink.last,
+                        NextState("DATA_WRITESTOP")
+                    ).Else(
+                        sink.ready.eq(1),
+                        NextState("IDLE")
+                    )
+                ]
+            return [
+                NextValue(sel, 1),
+                NextState("DATA_WRITE")
+            ]
+
         self.submodules.fsm = fsm = ClockDomainsRenamer("sd")(FSM(reset_state="IDLE"))
 
+        write = \
+            If(wrstarted,
+                pads.data.o.eq(chunks[0]),
+                *write_first()
+            ).Else(
+                pads.data.o.eq(0),
+                NextState("DATA_WRITESTART")
+            )
+        if data_width == 4:
+            write = \
+                If(cfg.ddr,
+                    # Start bit on both edges
+                    pads.data.o.eq(0),
+                    pads.data.o_f.eq(0),
+                    NextState("DATA_WRITE_DDR")
+                ).Else(write)
+
         fsm.act("IDLE",
             If(sink.valid,
                 pads.clk.eq(1),
                 pads.data.oe.eq(1),
-                If(wrstarted,
-                    pads.data.o.eq(sink.data[4:8]),
-                    NextState("DATA_WRITE")
-                ).Else(
-                    pads.data.o.eq(0),
-                    NextState("DATA_WRITESTART")
-                )
+                write
             )
         )
 
+        if data_width == 4:
+            fsm.act("DATA_WRITE_DDR",
+                pads.data.oe.eq(1),
+                pads.data.o.eq(sink.data[4:8]),
+                pads.data.o_f.eq(sink.data[0:4]),
+                If(sink.valid,
+                    pads.clk.eq(1),
+                    If(sink.last,
+                        NextState("DATA_WRITESTOP")
+                    ).Else(
+                        sink.ready.eq(1)
+                    )
+                )
+            )
+
         fsm.act("DATA_WRITESTART",
             pads.clk.eq(1),
             pads.data.oe.eq(1),
-            pads.data.o.eq(sink.data[4:8]),
+            pads.data.o.eq(chunks[0]),
             NextValue(wrstarted, 1),
-            NextState("DATA_WRITE")
+            *write_first()
         )
 
-        fsm.act("DATA_WRITE",
-            pads.clk.eq(1),
-            pads.data.oe.eq(1),
-            pads.data.o.eq(sink.data[0:4]),
-            If(sink.last,
-                NextState("DATA_WRITESTOP")
-            ).Else(
-                sink.ready.eq(1),
-                NextState("IDLE")
+        if nbits > 1:
+            fsm.act("DATA_WRITE",
+                pads.clk.eq(1),
+                pads.data.oe.eq(1),
+                pads.data.o.eq(chunks[sel]),
+                NextValue(sel, sel + 1),
+                If(sel == (nbits - 1),
+                    If(sink.last,
+                        NextState("DATA_WRITESTOP")
+                    ).Else(
+                        sink.ready.eq(1),
+                        NextState("IDLE")
+                    )
+                )
             )
-        )
 
         fsm.act("DATA_WRITESTOP",
             pads.clk.eq(1),
             pads.data.oe.eq(1),
-            pads.data.o.eq(0xf),
+            pads.data.o.eq(2**data_width - 1),
+            pads.data.o_f.eq(2**data_width - 1),
             NextValue(wrstarted, 0),
             self.crcfb.start.eq(1),
             NextState("DATA_RESPONSE")
@@ -495,17 +566,131 @@ class SDPHYDATAW(Module):
                 If(pads.data.i[0],
                     NextValue(cnt, 0),
                     sink.ready.eq(1),
+                    self.busy_release.eq(1),
+                    NextState("IDLE")
+                )
+            )
+        )
+
+
+class SDPHYVoltageSwitch(Module, AutoCSR):
+    """UHS-I 1.8V signaling switch sequence
+
+    Armed by start, the sequence runs at the end of the next command
+    response (CMD11, error is set when none is received within 16*delay
+    cycles): the clock is stopped and CMD/DAT released, CMD and
+    DAT[3:0] must be driven low by the card, sel is set and delay sys clock
+    cycles (5ms) are waited, the clock is restarted for delay/4 cycles and
+    DAT[3:0] must then be high. done is set on success, error (and sel
+    cleared) on a failure.
+    """
+    def __init__(self):
+        self.response = Signal() # end of a command response (sd)
+        self.cmd_i = Signal()    # (sd)
+        self.data_i = Signal(4)  # (sd)
+        self.override = Signal() # clock/lines override (sd)
+        self.clk = Signal()      # (sd)
+        self.sel = Signal()
+
+        self.start = CSR()
+        self.delay = CSRStorage(32, reset=500000)
+        self.done = CSRStatus()
+        self.error = CSRStatus()
+
+        # # #
+
+        response = Signal()
+        cmd_i = Signal()
+        data_i = Signal(4)
+        override = Signal()
+        clk = Signal()
+        done = Signal()
+        error = Signal()
+        count = Signal(32)
+
+        self.submodules.pulse_response = PulseSynchronizer("sd", "sys")
+        self.comb += [
+            self.pulse_response.i.eq(self.response),
+            response.eq(self.pulse_response.o)
+        ]
+        self.specials += [
+            MultiReg(self.cmd_i, cmd_i),
+            MultiReg(self.data_i, data_i),
+            MultiReg(override, self.override, "sd"),
+            MultiReg(clk, self.clk, "sd")
+        ]
+        self.comb += [
+            self.done.status.eq(done),
+            self.error.status.eq(error)
+        ]
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        fsm.act("IDLE",
+            If(self.start.re,
+                NextValue(done, 0),
+                NextValue(error, 0),
+                NextValue(count, 0),
+                NextState("ARMED")
+            )
+        )
+        fsm.act("ARMED",
+            NextValue(count, count + 1),
+            If(response,
+                NextValue(count, 0),
+                NextState("STOP")
+            ).Elif(count >= (self.delay.storage << 4),
+                # No response to CMD11
+                NextValue(error, 1),
+                NextState("IDLE")
+            )
+        )
+        fsm.act("STOP",
+            override.eq(1),
+            NextValue(count, count + 1),
+            If(count == 1023,
+                NextValue(count, 0),
+                If(cmd_i | (data_i != 0),
+                    NextValue(error, 1),
                     NextState("IDLE")
+                ).Else(
+                    NextValue(self.sel, 1),
+                    NextState("SWITCH")
                 )
             )
         )
+        fsm.act("SWITCH",
+            override.eq(1),
+            NextValue(count, count + 1),
+            If(count >= self.delay.storage,
+                NextValue(count, 0),
+                NextState("CLOCK")
+            )
+        )
+        fsm.act("CLOCK",
+            override.eq(1),
+            clk.eq(1),
+            NextValue(count, count + 1),
+            If(count >= (self.delay.storage >> 2),
+                If(data_i != 0b1111,
+                    NextValue(error, 1),
+                    NextValue(self.sel, 0)
+                ).Else(
+                    NextValue(done, 1)
+                ),
+                NextState("IDLE")
+            )
+        )
 
 
 class SDPHYIOS6(Module):
-    def __init__(self, sdpads, pads, ddr_alignment="C0"):
+    def __init__(self, sdpads, pads, ddr_alignment="C0", ddr_clk="sd"):
+        data_width = len(sdpads.data.i)
+        self.data_o = Signal(data_width)
+        self.data_o_f = Signal(data_width)
+
         # Data tristate
-        self.data_t = TSTriple(4)
-        self.specials += self.data_t.get_tristate(pads.data)
+        self.data_t = TSTriple(data_width)
+        self.specials += self.data_t.get_tristate(pads.data[:data_width])
 
         # Cmd tristate
         self.cmd_t = TSTriple()
@@ -539,7 +724,7 @@ class SDPHYIOS6(Module):
             self.comb += sdpads.cmd.i.eq(cmd[1])
 
         # Data input DDR
-        for i in range(4):
+        for i in range(data_width):
             data = Signal(2)
             data_r = Signal(2)
             self.specials += Instance("IDDR2",
@@ -549,16 +734,38 @@ class SDPHYIOS6(Module):
                 i_D=self.data_t.i[i], o_Q0=data[0], o_Q1=data[1]
             )
             if hasattr(pads, "clkfb"):
-                self.comb += sdpads.data.i[i].eq(data[0])
+                self.sync.sd_fb += data_r.eq(data)
+                self.comb += [
+                    sdpads.data.i[i].eq(data[0]),
+                    sdpads.data.i_r[i].eq(data_r[1])
+                ]
             else:
-                self.comb += sdpads.data.i[i].eq(data[1])
+                self.comb += [
+                    sdpads.data.i[i].eq(data[1]),
+                    sdpads.data.i_r[i].eq(data[0])
+                ]
+
+        # Data output DDR
+        for i in range(data_width):
+            self.specials += Instance("ODDR2", p_DDR_ALIGNMENT="C0",
+                p_INIT=1, p_SRTYPE="SYNC",
+                i_D0=self.data_o[i], i_D1=self.data_o_f[i], i_S=0, i_R=0, i_CE=1,
+                i_C0=ClockSignal(ddr_clk), i_C1=~ClockSignal(ddr_clk),
+                o_Q=self.data_t.o[i]
+            )
 
 
 class SDPHYIOS7(Module):
-    def __init__(self, sdpads, pads):
+    def __init__(self, sdpads, pads, with_idelay=False, ddr_clk="sd"):
+        data_width = len(sdpads.data.i)
+        self.data_o = Signal(data_width)
+        self.data_o_f = Signal(data_width)
+        self.rxdelay = Signal(5)
+        self.rxdelay_load = Signal()
+
         # Data tristate
-        self.data_t = TSTriple(4)
-        self.specials += self.data_t.get_tristate(pads.data)
+        self.data_t = TSTriple(data_width)
+        self.specials += self.data_t.get_tristate(pads.data[:data_width])
 
         # Cmd tristate
         self.cmd_t = TSTriple()
@@ -575,33 +782,96 @@ class SDPHYIOS7(Module):
             i_D1=0, i_D2=sdpads.clk, o_Q=pads.clk
         )
 
+        # Input delays (sampling point tuning), rxdelay taps loaded on
+        # rxdelay_load (sys domain), an IDELAYCTRL is needed in the design
+        cmd_i = Signal()
+        data_i = Signal(data_width)
+        for d, o in zip([self.cmd_t.i] + [self.data_t.i[i] for i in range(data_width)],
+                        [cmd_i] + [data_i[i] for i in range(data_width)]):
+            if with_idelay:
+                self.specials += Instance("IDELAYE2",
+                    p_DELAY_SRC="IDATAIN", p_SIGNAL_PATTERN="DATA",
+                    p_CINVCTRL_SEL="FALSE", p_HIGH_PERFORMANCE_MODE="TRUE",
+                    p_REFCLK_FREQUENCY=200.0, p_PIPE_SEL="FALSE",
+                    p_IDELAY_TYPE="VAR_LOAD", p_IDELAY_VALUE=0,
+                    i_C=ClockSignal(), i_LD=self.rxdelay_load, i_CE=0, i_INC=0,
+                    i_LDPIPEEN=0, i_CINVCTRL=0, i_REGRST=0, i_DATAIN=0,
+                    i_CNTVALUEIN=self.rxdelay, i_IDATAIN=d, o_DATAOUT=o
+                )
+            else:
+                self.comb += o.eq(d)
+
         # Cmd input DDR
         self.specials += Instance("IDDR",
             p_DDR_CLK_EDGE="SAME_EDGE_PIPELINED",
             i_C=ClockSignal("sd_fb"), i_CE=1, i_S=0, i_R=0,
-            i_D=self.cmd_t.i, o_Q1=Signal(), o_Q2=sdpads.cmd.i
+            i_D=cmd_i, o_Q1=Signal(), o_Q2=sdpads.cmd.i
         )
 
         # Data input DDR
-        for i in range(4):
+        for i in range(data_width):
             self.specials += Instance("IDDR",
                 p_DDR_CLK_EDGE="SAME_EDGE_PIPELINED",
                 i_C=ClockSignal("sd_fb"), i_CE=1, i_S=0, i_R=0,
-                i_D=self.data_t.i[i], o_Q1=Signal(), o_Q2=sdpads.data.i[i],
+                i_D=data_i[i], o_Q1=sdpads.data.i_r[i], o_Q2=sdpads.data.i[i],
+            )
+
+        # Data output DDR
+        for i in range(data_width):
+            self.specials += Instance("ODDR",
+                p_DDR_CLK_EDGE="SAME_EDGE",
+                i_C=ClockSignal(ddr_clk), i_CE=1, i_S=0, i_R=0,
+                i_D1=self.data_o[i], i_D2=self.data_o_f[i], o_Q=self.data_t.o[i]
             )
 
 
 class SDPHY(Module, AutoCSR):
-    def __init__(self, pads, device, **kwargs):
+    """SD/eMMC PHY
+
+    data_width is the number of data lines used (1, 4 or 8, all the data
+    pads by default). The card must be switched to this bus width (ACMD6
+    for SD cards, BUS_WIDTH with CMD6 for eMMC devices) before the first
+    data transfer. DDR data transfers are only supported on 4 lines.
+
+    The data outputs change on the sd clock edges, which are also the edges
+    of the card clock: DDR data would change with the clock. DDR50 is only
+    available (ddr CSR) when ddr_clk names a clock domain running at the sd
+    clock delayed by a quarter period (90 degrees phase shift from the CRG),
+    the data outputs are then clocked by it (the SDR data is then driven a
+    quarter period after the falling edge of the card clock). The emulator
+    samples the data once per clock and has no DDR50.
+    """
+    def __init__(self, pads, device, data_width=None, ddr_clk=None, **kwargs):
         self.sink = sink = stream.Endpoint([("data", 8), ("cmd_data_n", 1), ("rd_wr_n", 1)])
         self.source = source = stream.Endpoint([("data", 8), ("status", 3)])
         if hasattr(pads, "sel"):
             self.voltage_sel = CSRStorage()
-            self.comb += pads.sel.eq(self.voltage_sel.storage)
+            self.submodules.vswitch = SDPHYVoltageSwitch()
+            self.comb += pads.sel.eq(self.voltage_sel.storage | self.vswitch.sel)
+        emulator = hasattr(pads, "cmd_t") and hasattr(pads, "dat_t")
+        # DDR50 data transfers (set after switching the card to DDR50 with CMD6)
+        if ddr_clk is not None and not emulator:
+            self.ddr = CSRStorage()
+        # Number of data lines
+        self.buswidth = CSRStatus(4)
+        # Input delay taps (7-Series with with_idelay=True), set by SDTuner
+        self.rxdelay = Signal(5)
+        self.rxdelay_load = Signal()
 
         # # #
 
-        self.sdpads = sdpads = _sdpads()
+        if data_width is None:
+            data_width = len(pads.dat_t) if emulator else len(pads.data)
+        assert data_width in [1, 4, 8]
+        assert ddr_clk is None or data_width == 4
+        self.data_width = data_width
+        self.comb += self.buswidth.status.eq(data_width)
+
+        self.sdpads = sdpads = _sdpads(data_width)
+
+        self.submodules.cfg = cfg = SDPHYCFG()
+        if hasattr(self, "ddr"):
+            self.specials += MultiReg(self.ddr.storage, cfg.ddr, "sd")
 
         # IOs (device specific)
         if not hasattr(pads, "clkfb"):
@@ -609,7 +879,7 @@ class SDPHY(Module, AutoCSR):
                 ClockSignal("sd_fb").eq(ClockSignal("sd")),
                 ResetSignal("sd_fb").eq(ResetSignal("sd"))
             ]
-        if hasattr(pads, "cmd_t") and hasattr(pads, "dat_t"):
+        if emulator:
             # emulator phy
             self.comb += [
                 If(sdpads.clk, pads.clk.eq(~ClockSignal("sd"))),
@@ -619,36 +889,47 @@ class SDPHY(Module, AutoCSR):
                 sdpads.cmd.i.eq(1),
                 If(~pads.cmd_t, sdpads.cmd.i.eq(pads.cmd_o)),
 
-                pads.dat_i.eq(0b1111),
-                If(sdpads.data.oe, pads.dat_i.eq(sdpads.data.o)),
-                sdpads.data.i.eq(0b1111),
-                If(~pads.dat_t[0], sdpads.data.i[0].eq(pads.dat_o[0])),
-                If(~pads.dat_t[1], sdpads.data.i[1].eq(pads.dat_o[1])),
-                If(~pads.dat_t[2], sdpads.data.i[2].eq(pads.dat_o[2])),
-                If(~pads.dat_t[3], sdpads.data.i[3].eq(pads.dat_o[3]))
+                pads.dat_i.eq(2**len(pads.dat_i) - 1),
+                If(sdpads.data.oe, pads.dat_i[:data_width].eq(sdpads.data.o)),
+                sdpads.data.i.eq(2**data_width - 1),
+                sdpads.data.i_r.eq(sdpads.data.i)
             ]
+            for i in range(data_width):
+                self.comb += If(~pads.dat_t[i], sdpads.data.i[i].eq(pads.dat_o[i]))
         else:
             # real phy
+            if ddr_clk is not None:
+                kwargs["ddr_clk"] = ddr_clk
             if device[:3] == "xc6":
                 self.submodules.io = io = SDPHYIOS6(sdpads, pads, **kwargs)
             elif device[:3] == "xc7":
                 self.submodules.io = io = SDPHYIOS7(sdpads, pads, **kwargs)
+                self.comb += [
+                    io.rxdelay.eq(self.rxdelay),
+                    io.rxdelay_load.eq(self.rxdelay_load)
+                ]
             else:
                 raise NotImplementedError
             self.sync.sd += [
                 io.cmd_t.oe.eq(sdpads.cmd.oe),
                 io.cmd_t.o.eq(sdpads.cmd.o),
 
-                io.data_t.oe.eq(sdpads.data.oe),
-                io.data_t.o.eq(sdpads.data.o)
+                io.data_t.oe.eq(sdpads.data.oe)
+            ]
+            self.comb += [
+                io.data_o.eq(sdpads.data.o),
+                If(cfg.ddr,
+                    io.data_o_f.eq(sdpads.data.o_f)
+                ).Else(
+                    io.data_o_f.eq(sdpads.data.o)
+                )
             ]
 
         # PHY submodules
-        self.submodules.cfg = cfg = SDPHYCFG()
-        self.submodules.cmdw = cmdw = SDPHYCMDW()
-        self.submodules.cmdr = cmdr = SDPHYCMDR(cfg)
-        self.submodules.dataw = dataw = SDPHYDATAW()
-        self.submodules.datar = datar = SDPHYDATAR(cfg)
+        self.submodules.cmdw = cmdw = SDPHYCMDW(data_width)
+        self.submodules.cmdr = cmdr = SDPHYCMDR(cfg, data_width)
+        self.submodules.dataw = dataw = SDPHYDATAW(cfg, data_width)
+        self.submodules.datar = datar = SDPHYDATAR(cfg, data_width)
 
         self.comb += \
             If(sink.valid,
@@ -678,3 +959,17 @@ class SDPHY(Module, AutoCSR):
                     )
                 )
             )
+
+        # 1.8V switch: clock stopped/restarted and lines released
+        if hasattr(pads, "sel"):
+            self.comb += [
+                self.vswitch.response.eq(cmdr.source.valid & cmdr.source.ready & cmdr.source.last),
+                self.vswitch.cmd_i.eq(sdpads.cmd.i),
+                self.vswitch.data_i.eq(sdpads.data.i[0:4] if data_width >= 4 else
+                    Replicate(sdpads.data.i[0], 4)),
+                If(self.vswitch.override,
+                    sdpads.clk.eq(self.vswitch.clk),
+                    sdpads.cmd.oe.eq(0),
+                    sdpads.data.oe.eq(0)
+                )
+            ]
@@ -0,0 +1,149 @@
+"""Continuous playback of a region of the card to a stream."""
+
+from litex.gen import *
+
+from litex.soc.interconnect import stream
+from litex.soc.interconnect.csr import *
+
+from litesdcard.common import *
+
+
+class SDPlayer(Module, AutoCSR):
+    """Play a region of the card on the source stream without software
+
+    When enable is set, the region of size blocks starting at base is read
+    with CMD18 transfers of chunk blocks from the read pointer (rp). Two
+    transfers are kept in flight: the next one waits in the SDCore command
+    queue and is started by SDCore right after the CMD12 of the current
+    one, without a round trip through the sys domain. The source stream
+    still has a gap between transfers (CMD12, CMD18 and the read access
+    time of the card, a few hundred sd clock cycles): a consumer needing a
+    steady stream must be covered by the SDCore downstream FIFO
+    (downstream_fifo_depth, 128 words or more) and larger chunks make the
+    gaps rarer. At the end of the region, the read pointer wraps to base
+    when loop is set (loops counts them), the playback stops and done is
+    set otherwise.
+
+    Transfers are sent on an SDCore port (which keeps the commands grant
+    during the playback), SDCore autocmd must be set. Clearing enable stops
+    the playback at the end of the transfers in flight. On a failure, error
+    is set, the read data left in SDCore is flushed once the transfers in
+    flight are reported and the playback stops until enable is cleared.
+    """
+    def __init__(self, core):
+        sdcore = core.get_port()
+        self.source = source = stream.Endpoint([("data", len(sdcore.source.data))])
+
+        self.enable = CSRStorage()
+        self.loop = CSRStorage()
+        self.base = CSRStorage(32)
+        self.size = CSRStorage(32)
+        self.chunk = CSRStorage(32, reset=1024)
+        self.rp = CSRStatus(32)
+        self.loops = CSRStatus(32)
+        self.done = CSRStatus()
+        self.error = CSRStatus()
+
+        # # #
+
+        rp = Signal(32)
+        loops = Signal(32)
+        done = Signal()
+        error = Signal()
+        end = Signal(32)
+        n = Signal(32)
+        stop = Signal()
+        pending = Signal(2)
+        issue = Signal()
+        report = Signal()
+        failed = Signal()
+
+        self.comb += [
+            self.rp.status.eq(rp),
+            self.loops.status.eq(loops),
+            self.done.status.eq(done),
+            self.error.status.eq(error),
+            end.eq(self.base.storage + self.size.storage),
+            If((end - rp) < self.chunk.storage,
+                n.eq(end - rp)
+            ).Else(
+                n.eq(self.chunk.storage)
+            ),
+            sdcore.cmd_source.ready.eq(1),
+            report.eq(sdcore.cmd_source.valid),
+            failed.eq(
+                (sdcore.cmd_source.cmdevt[2:6] != 0) |
+                (sdcore.cmd_source.dataevt[1:5] != 0))
+        ]
+
+        # Data of all the transfers goes to the source
+        self.comb += sdcore.source.connect(source,
+            omit={name for name, width in sdcore_metadata_layout})
+
+        # Transfers in flight
+        self.sync += pending.eq(pending + issue - report)
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        self.sync += \
+            If(fsm.ongoing("IDLE") & ~self.enable.storage,
+                error.eq(0)
+            ).Elif(report & failed,
+                error.eq(1)
+            )
+        fsm.act("IDLE",
+            If(~self.enable.storage,
+                NextValue(done, 0)
+            ).Elif(~done & ~error & (pending == 0),
+                NextValue(rp, self.base.storage),
+                NextValue(loops, 0),
+                NextValue(stop, 0),
+                NextState("ISSUE")
+            )
+        )
+        fsm.act("ISSUE",
+            If(n > 1,
+                sdcore.cmd_sink.command.eq((18 << 8) | SDCARD_CTRL_RESPONSE_SHORT |
+                    (SDCARD_CTRL_DATA_TRANSFER_READ << 5))
+            ).Else(
+                sdcore.cmd_sink.command.eq((17 << 8) | SDCARD_CTRL_RESPONSE_SHORT |
+                    (SDCARD_CTRL_DATA_TRANSFER_READ << 5))
+            ),
+            sdcore.cmd_sink.argument.eq(rp),
+            sdcore.cmd_sink.blocksize.eq(512),
+            sdcore.cmd_sink.blockcount.eq(n),
+            If(error | ~self.enable.storage,
+                NextState("WAIT")
+            ).Else(
+                sdcore.cmd_sink.valid.eq(1),
+                If(sdcore.cmd_sink.ready,
+                    issue.eq(1),
+                    If(rp + n == end,
+                        NextValue(rp, self.base.storage),
+                        If(self.loop.storage,
+                            NextValue(loops, loops + 1)
+                        ).Else(
+                            NextValue(stop, 1),
+                            NextState("WAIT")
+                        )
+                    ).Else(
+                        NextValue(rp, rp + n)
+                    ),
+                    # Issue the next transfer ahead when this one is alone
+                    If((pending - report) != 0,
+                        NextState("WAIT")
+                    )
+                )
+            )
+        )
+        fsm.act("WAIT",
+            If((pending == 0) | ((pending == 1) & report),
+                If(error | failed,
+                    sdcore.source_flush.eq(1)
+                ).Else(
+                    NextValue(done, stop)
+                ),
+                NextState("IDLE")
+            ).Elif(report & ~failed & ~error & ~stop & self.enable.storage,
+                NextState("ISSUE")
+            )
+        )
@@ -0,0 +1,196 @@
+"""Continuous recording of a stream to a region of the card."""
+
+from litex.gen import *
+
+from litex.soc.interconnect import stream
+from litex.soc.interconnect.csr import *
+
+from litesdcard.common import *
+
+
+def _command(index, response, transfer=SDCARD_CTRL_DATA_TRANSFER_NONE):
+    return (index << 8) | response | (transfer << 5)
+
+
+class SDRecorder(Module, AutoCSR):
+    """Record the sink stream to a region of the card without software
+
+    When enable is set, the region of size blocks starting at base is
+    optionally erased (CMD32/CMD33/CMD38), then the sink stream is written
+    with CMD25 transfers of chunk blocks, re-issued back to back at the
+    write pointer (wp) which wraps to base at the end of the region (wraps
+    counts them). The card status is polled with CMD13 after the erase and
+    after each transfer until the card is ready for data (at most pollmax
+    times).
+
+    Transfers are sent on an SDCore port (locked during the erase
+    sequence), SDCore autocmd must be set. Clearing enable stops the recording at the end of the current
+    transfer. On a failure (or a card still busy after pollmax polls), error
+    is set, the write data left in SDCore is flushed and the recording stops
+    until enable is cleared.
+    """
+    def __init__(self, core):
+        sdcore = core.get_port()
+        data_width = len(sdcore.sink.data)
+        self.sink = sink = stream.Endpoint([("data", data_width)])
+
+        self.enable = CSRStorage()
+        self.erase = CSRStorage()
+        self.base = CSRStorage(32)
+        self.size = CSRStorage(32)
+        self.chunk = CSRStorage(32, reset=1024)
+        self.pollmax = CSRStorage(32, reset=2**16)
+        self.wp = CSRStatus(32)
+        self.wraps = CSRStatus(32)
+        self.error = CSRStatus()
+
+        # # #
+
+        wp = Signal(32)
+        wraps = Signal(32)
+        error = Signal()
+        end = Signal(32)
+        n = Signal(32)
+        nblocks = Signal(32)
+        words = Signal(32)
+        polls = Signal(32)
+        status_done = Signal()
+        cmdevt = Signal(32)
+        dataevt = Signal(32)
+        cardstatus = Signal(32)
+        failed = Signal()
+        ready = Signal()
+
+        OP_ERASE_START, OP_ERASE_END, OP_ERASE, OP_STATUS, OP_WRITE = range(5)
+        op = Signal(3)
+
+        self.comb += [
+            self.wp.status.eq(wp),
+            self.wraps.status.eq(wraps),
+            self.error.status.eq(error),
+            end.eq(self.base.storage + self.size.storage),
+            If((end - wp) < self.chunk.storage,
+                n.eq(end - wp)
+            ).Else(
+                n.eq(self.chunk.storage)
+            ),
+            failed.eq((cmdevt[2:6] != 0) | (dataevt[1:5] != 0)),
+            ready.eq((cardstatus[9:13] == 4) & cardstatus[8]) # tran and READY_FOR_DATA
+        ]
+
+        self.comb += Case(op, {
+            OP_ERASE_START: [
+                sdcore.cmd_sink.command.eq(_command(32, SDCARD_CTRL_RESPONSE_SHORT)),
+                sdcore.cmd_sink.argument.eq(self.base.storage)
+            ],
+            OP_ERASE_END: [
+                sdcore.cmd_sink.command.eq(_command(33, SDCARD_CTRL_RESPONSE_SHORT)),
+                sdcore.cmd_sink.argument.eq(end - 1)
+            ],
+            OP_ERASE: [
+                sdcore.cmd_sink.command.eq(_command(38, SDCARD_CTRL_RESPONSE_SHORT)),
+                sdcore.cmd_sink.argument.eq(0)
+            ],
+            OP_STATUS: [
+                sdcore.cmd_sink.command.eq(_command(13, SDCARD_CTRL_RESPONSE_SHORT)),
+                sdcore.cmd_sink.argument.eq(Cat(Replicate(0, 16), core.rca.status))
+            ],
+            OP_WRITE: [
+                sdcore.cmd_sink.command.eq(_command(25, SDCARD_CTRL_RESPONSE_SHORT,
+                    SDCARD_CTRL_DATA_TRANSFER_WRITE)),
+                sdcore.cmd_sink.argument.eq(wp)
+            ]
+        })
+        self.comb += [
+            sdcore.cmd_sink.blocksize.eq(512),
+            sdcore.cmd_sink.blockcount.eq(nblocks)
+        ]
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        self.comb += sdcore.lock.eq(~fsm.ongoing("IDLE") &
+            ((op == OP_ERASE_START) | (op == OP_ERASE_END)))
+        fsm.act("IDLE",
+            If(~self.enable.storage,
+                NextValue(error, 0)
+            ).Elif(~error,
+                NextValue(wp, self.base.storage),
+                NextValue(wraps, 0),
+                NextValue(nblocks, 0),
+                NextValue(polls, 0),
+                If(self.erase.storage,
+                    NextValue(op, OP_ERASE_START)
+                ).Else(
+                    NextValue(op, OP_STATUS)
+                ),
+                NextState("ISSUE")
+            )
+        )
+        fsm.act("ISSUE",
+            sdcore.cmd_sink.valid.eq(1),
+            If(sdcore.cmd_sink.ready,
+                NextValue(words, nblocks << log2_int(4096//data_width)),
+                NextValue(status_done, 0),
+                NextState("WAIT")
+            )
+        )
+        fsm.act("WAIT",
+            sdcore.cmd_source.ready.eq(1),
+            If(sdcore.cmd_source.valid,
+                NextValue(cmdevt, sdcore.cmd_source.cmdevt),
+                NextValue(dataevt, sdcore.cmd_source.dataevt),
+                NextValue(cardstatus, sdcore.cmd_source.response[0:32]),
+                NextValue(status_done, 1)
+            ),
+            If(op == OP_WRITE,
+                sink.connect(sdcore.sink),
+                If(words == 0,
+                    sdcore.sink.valid.eq(0),
+                    sink.ready.eq(0)
+                ),
+                If(sdcore.sink.valid & sdcore.sink.ready,
+                    NextValue(words, words - 1)
+                )
+            ),
+            If(status_done & ((words == 0) | failed),
+                NextState("NEXT")
+            )
+        )
+        fsm.act("NEXT",
+            NextValue(nblocks, 0),
+            NextState("ISSUE"),
+            If(op != OP_STATUS,
+                NextValue(polls, 0)
+            ),
+            If(failed,
+                If(op == OP_WRITE,
+                    sdcore.flush.eq(1)
+                ),
+                NextValue(error, 1),
+                NextState("IDLE")
+            ).Elif(op == OP_ERASE_START,
+                NextValue(op, OP_ERASE_END)
+            ).Elif(op == OP_ERASE_END,
+                NextValue(op, OP_ERASE)
+            ).Elif(op == OP_WRITE,
+                NextValue(op, OP_STATUS),
+                If(wp + nblocks == end,
+                    NextValue(wp, self.base.storage),
+                    NextValue(wraps, wraps + 1)
+                ).Else(
+                    NextValue(wp, wp + nblocks)
+                )
+            ).Elif((op == OP_STATUS) & ~ready,
+                # Card busy, poll again
+                NextValue(op, OP_STATUS),
+                NextValue(polls, polls + 1),
+                If(polls >= self.pollmax.storage,
+                    NextValue(error, 1),
+                    NextState("IDLE")
+                )
+            ).Elif(~self.enable.storage,
+                NextState("IDLE")
+            ).Else(
+                NextValue(op, OP_WRITE),
+                NextValue(nblocks, n)
+            )
+        )
@@ -0,0 +1,211 @@
+"""Sampling point tuning engine running CMD19 on SDCore."""
+
+from litex.gen import *
+
+from litex.soc.interconnect.csr import *
+
+from litesdcard.common import *
+
+
+class SDTuner(Module, AutoCSR):
+    """Tune the sampling point of the SDPHY inputs for SDR50/SDR104 (HS200)
+
+    On start, each of the ntaps input delay taps of the PHY is loaded and
+    tested with tries CMD19 (SEND_TUNING_BLOCK, CMD21 for eMMC devices when
+    emmc is set), the received block being compared with the tuning pattern
+    (128 bytes pattern on 8 lines). A tap passes when all its tries
+    succeed (passes bitmap). The centre of the longest window of passing
+    taps is then loaded in the PHY (delay) and done is set, error is set
+    when no tap passes.
+
+    Commands are sent through an SDCore port (locked during the tuning,
+    other frontends would see the taps under test), the card must be in
+    the transfer state in SDR50/SDR104 (HS200). The input delays need a 7-Series
+    SDPHY built with with_idelay=True.
+
+    The tuning blocks are taken from the port.
+    """
+    def __init__(self, core, phy, ntaps=32, tries=4, emmc=False):
+        sdcore = core.get_port()
+        data_width = len(sdcore.source.data)
+        # Taps selected by the rxdelay of the PHY
+        assert ntaps <= 2**len(phy.rxdelay)
+
+        self.start = CSR()
+        self.done = CSRStatus()
+        self.error = CSRStatus()
+        self.passes = CSRStatus(ntaps)
+        self.delay = CSRStatus(len(phy.rxdelay))
+
+        # # #
+
+        busy = Signal()
+        done = Signal()
+        error = Signal()
+        passes = Signal(ntaps)
+        tap = Signal(max=ntaps+1)
+        try_ = Signal(max=tries+1)
+        drain = Signal(8)
+        cmdevt = Signal(32)
+        dataevt = Signal(32)
+        status_done = Signal()
+        match = Signal()
+        failed = Signal()
+        ok = Signal()
+        clear = Signal()
+        update = Signal()
+        delay = Signal(len(phy.rxdelay))
+
+        # Longest window of passing taps
+        i = Signal(max=ntaps+1)
+        run = Signal(max=ntaps+1)
+        best_start = Signal(max=ntaps+1)
+        best_len = Signal(max=ntaps+1)
+
+        self.comb += [
+            self.done.status.eq(done),
+            self.error.status.eq(error),
+            self.passes.status.eq(passes),
+            self.delay.status.eq(delay),
+            phy.rxdelay.eq(delay)
+        ]
+
+        # Tuning pattern (first byte in the upper bits of the words)
+        block = SDCARD_TUNING_BLOCK_8BIT if phy.data_width == 8 else SDCARD_TUNING_BLOCK
+        nbits = 32*len(block)
+        nwords = nbits//data_width
+        pattern = 0
+        for w in block:
+            pattern = (pattern << 32) | w
+        patterns = Array(C((pattern >> (nbits - data_width*(n + 1))) & (2**data_width - 1), data_width)
+            for n in range(nwords))
+        words = Signal(max=nwords+1)
+
+        self.comb += [
+            sdcore.lock.eq(busy),
+            sdcore.source.ready.eq(1)
+        ]
+
+        self.comb += [
+            failed.eq((cmdevt[2:6] != 0) | (dataevt[1:5] != 0)),
+            ok.eq(~failed & match & (words == nwords))
+        ]
+        self.sync += \
+            If(clear,
+                passes.eq(0)
+            ).Elif(update,
+                Array(passes[n] for n in range(ntaps))[tap].eq(ok)
+            )
+
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        fsm.act("IDLE",
+            If(self.start.re,
+                clear.eq(1),
+                NextValue(done, 0),
+                NextValue(error, 0),
+                NextValue(tap, 0),
+                NextValue(delay, 0),
+                NextState("LOAD")
+            )
+        )
+        fsm.act("LOAD",
+            busy.eq(1),
+            phy.rxdelay_load.eq(1),
+            NextValue(try_, 0),
+            NextValue(drain, 0),
+            NextState("DRAIN")
+        )
+        # Data of a failed block may still come after its status
+        fsm.act("DRAIN",
+            busy.eq(1),
+            NextValue(drain, drain + 1),
+            If(drain == (2**len(drain) - 1),
+                NextState("CMD")
+            )
+        )
+        fsm.act("CMD",
+            busy.eq(1),
+            sdcore.cmd_sink.valid.eq(1),
+            sdcore.cmd_sink.command.eq(((21 if emmc else 19) << 8) | SDCARD_CTRL_RESPONSE_SHORT |
+                (SDCARD_CTRL_DATA_TRANSFER_READ << 5)),
+            sdcore.cmd_sink.argument.eq(0),
+            sdcore.cmd_sink.blocksize.eq(nbits//8),
+            sdcore.cmd_sink.blockcount.eq(1),
+            If(sdcore.cmd_sink.ready,
+                NextValue(words, 0),
+                NextValue(match, 1),
+                NextValue(status_done, 0),
+                NextState("WAIT")
+            )
+        )
+        fsm.act("WAIT",
+            busy.eq(1),
+            sdcore.cmd_source.ready.eq(1),
+            If(sdcore.cmd_source.valid,
+                NextValue(cmdevt, sdcore.cmd_source.cmdevt),
+                NextValue(dataevt, sdcore.cmd_source.dataevt),
+                NextValue(status_done, 1)
+            ),
+            If(sdcore.source.valid & (words < nwords),
+                NextValue(words, words + 1),
+                If(sdcore.source.data != patterns[words],
+                    NextValue(match, 0)
+                )
+            ),
+            If(status_done & ((words == nwords) | failed),
+                NextState("CHECK")
+            )
+        )
+        fsm.act("CHECK",
+            busy.eq(1),
+            NextValue(try_, try_ + 1),
+            NextValue(drain, 0),
+            If(ok & (try_ != (tries - 1)),
+                NextState("DRAIN")
+            ).Else(
+                update.eq(1),
+                NextValue(tap, tap + 1),
+                If(tap == (ntaps - 1),
+                    NextValue(i, 0),
+                    NextValue(run, 0),
+                    NextValue(best_start, 0),
+                    NextValue(best_len, 0),
+                    NextState("SCAN")
+                ).Else(
+                    NextValue(delay, tap + 1),
+                    NextState("LOAD")
+                )
+            )
+        )
+        fsm.act("SCAN",
+            busy.eq(1),
+            NextValue(i, i + 1),
+            If(Array(passes[n] for n in range(ntaps))[i],
+                NextValue(run, run + 1),
+                If(run + 1 > best_len,
+                    NextValue(best_len, run + 1),
+                    NextValue(best_start, i - run)
+                )
+            ).Else(
+                NextValue(run, 0)
+            ),
+            If(i == (ntaps - 1),
+                NextState("SELECT")
+            )
+        )
+        fsm.act("SELECT",
+            busy.eq(1),
+            If(best_len == 0,
+                NextValue(error, 1),
+                NextState("IDLE")
+            ).Else(
+                NextValue(delay, best_start + (best_len >> 1)),
+                NextState("LOCK")
+            )
+        )
+        fsm.act("LOCK",
+            busy.eq(1),
+            phy.rxdelay_load.eq(1),
+            NextValue(done, 1),
+            NextState("IDLE")
+        )
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import sys
+
+from litex.gen import *
+from litex.gen.sim import *
+
+from litex.soc.interconnect import stream
+from litex.soc.interconnect import wishbone
+
+from litesdcard.dma import SDBlock2MemDMA, SDMem2BlockDMA
+
+
+# DMA throughput: a region is moved between a block stream running at the
+# full rate (one 32 bits word per cycle) and a Wishbone memory acking every
+# cycle, the bus cycles per block are reported.
+
+base   = 0x10000000
+length = 4*1024*1024 # 4 MiB
+
+
+class DMASim(Module):
+    def __init__(self):
+        self.submodules.block2mem = SDBlock2MemDMA()
+        self.submodules.mem2block = SDMem2BlockDMA()
+
+        self.source = stream.Endpoint([("data", 32)])
+        self.sink = stream.Endpoint([("data", 32)])
+        self.comb += [
+            self.source.connect(self.block2mem.sink),
+            self.mem2block.source.connect(self.sink)
+        ]
+
+
+def stream_generator(source, length):
+    for i in range(length//4):
+        yield source.valid.eq(1)
+        yield source.data.eq(i)
+        yield source.last.eq((i % (512//4)) == (512//4 - 1))
+        yield
+        while not (yield source.ready):
+            yield
+    yield source.valid.eq(0)
+
+
+@passive
+def stream_checker(sink, errors):
+    yield sink.ready.eq(1)
+    i = 0
+    while True:
+        if (yield sink.valid):
+            if (yield sink.data) != (i & 0xffffffff):
+                errors.append(i)
+            i += 1
+        yield
+
+
+@passive
+def wishbone_memory(bus, writes):
+    # Registered acks, one word per cycle in the bursts, reads return the
+    # word offset (the data sent by stream_generator)
+    while True:
+        cyc, stb, ack = (yield bus.cyc), (yield bus.stb), (yield bus.ack)
+        adr, cti = (yield bus.adr), (yield bus.cti)
+        if cyc and stb and ack and (yield bus.we):
+            writes[0] += 1
+        if cyc and stb and not (ack and cti == 0b111):
+            yield bus.ack.eq(1)
+            yield bus.dat_r.eq(adr + ack - base//4)
+        else:
+            yield bus.ack.eq(0)
+        yield
+
+
+def dma_run(dma, length):
+    yield dma.base.storage.eq(base)
+    yield dma.length.storage.eq(length)
+    yield dma.start.re.eq(1)
+    yield
+    yield dma.start.re.eq(0)
+    yield
+    while not (yield dma.done.status):
+        yield
+    cycles = (yield dma.cycles.status)
+    print("{:s}: {:d} blocks in {:d} bus cycles ({:3.2f} cycles/block)".format(
+        dma.__class__.__name__, length//512, cycles, cycles/(length//512)))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else length
+    writes = [0]
+    errors = []
+
+    dut = DMASim()
+    generators = [
+        dma_run(dut.block2mem, n),
+        stream_generator(dut.source, n),
+        wishbone_memory(dut.block2mem.bus, writes)
+    ]
+    run_simulation(dut, generators)
+    print("block2mem: {:d} words written".format(writes[0]))
+
+    dut = DMASim()
+    generators = [
+        dma_run(dut.mem2block, n),
+        stream_checker(dut.sink, errors),
+        wishbone_memory(dut.mem2block.bus, writes)
+    ]
+    run_simulation(dut, generators)
+    print("mem2block: {:d} errors".format(len(errors)))
+
+if __name__ == "__main__":
+    main()
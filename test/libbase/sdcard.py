@@ -110,11 +110,12 @@ def sdcard_wait_data_done(wb):
     while True:
         dataevt = wb.regs.sdcore_dataevt.read()
         if dataevt & 0x1:
-            print('dataevt: 0x{:08x}{}{}{}'.format(
+            print('dataevt: 0x{:08x}{}{}{}{}'.format(
                 dataevt,
                 ' (CRC Error)' if dataevt & 0x8 else '',
                 ' (Timeout)' if dataevt & 0x4 else '',
                 ' (Write Error)' if dataevt & 0x2 else '',
+                ' (Aborted)' if dataevt & 0x10 else '',
             ))
             if dataevt & 0x4:
                 return SD_TIMEOUT
@@ -138,6 +139,179 @@ def sdcard_wait_response(wb, length, nocrccheck=False):
     print(s)
     return ba, status
 
+def sdcard_card_status(wb):
+    cardstatus = wb.regs.sdcore_cardstatus.read()
+    print('cardstatus: 0x{:08x} (state {:d}){}{}'.format(
+        cardstatus,
+        (cardstatus >> SDCARD_CARDSTATUS_STATE_SHIFT) & 0xf,
+        ' (Error)' if cardstatus & SDCARD_CARDSTATUS_ERRORS else '',
+        ' (Locked)' if cardstatus & SDCARD_CARDSTATUS_LOCKED else '',
+    ))
+    return cardstatus
+
+def sdcard_card_rca(wb):
+    return wb.regs.sdcore_rca.read()
+
+# mailbox
+
+def sdcard_mailbox_read(wb):
+    # retry until the sequence numbers match (consistent snapshot)
+    while True:
+        mailbox = wb.read(wb.mems.sdmailbox.base, 8)
+        if mailbox[0] == mailbox[7]:
+            break
+    cmdevt = mailbox[1] & 0xffff
+    dataevt = (mailbox[1] >> 16) & 0xffff
+    response = mailbox[2:6]
+    blocks = mailbox[6]
+    return mailbox[0], cmdevt, dataevt, response, blocks
+
+# fifos
+
+def sdcard_fifo_levels_clear(wb):
+    wb.regs.sdcore_fifolevelclear.write(1)
+
+def sdcard_fifo_levels(wb):
+    upstream = wb.regs.sdcore_upstreamlevelmax.read()
+    downstream = wb.regs.sdcore_downstreamlevelmax.read()
+    print("fifo high-water marks: upstream {:d} / downstream {:d}".format(upstream, downstream))
+    return upstream, downstream
+
+# stats
+
+sdcore_stats = ["cmdsnone", "cmdsread", "cmdswrite", "blocksread", "blockswritten",
+                "bytesread", "byteswritten", "crcerrors", "timeouts", "busycycles",
+                "idlecycles", "sinkstalls", "sourcestalls"]
+
+def sdcard_stats_clear(wb):
+    wb.regs.sdcore_stats_clear.write(1)
+    while not (wb.regs.sdcore_stats_done.read() & 0x1):
+        pass
+
+def sdcard_stats(wb):
+    wb.regs.sdcore_stats_snapshot.write(1)
+    while not (wb.regs.sdcore_stats_done.read() & 0x1):
+        pass
+    stats = {}
+    for name in sdcore_stats:
+        stats[name] = getattr(wb.regs, "sdcore_stats_" + name).read()
+        print("{:16s}: {:d}".format(name, stats[name]))
+    return stats
+
+# trace
+
+def sdcard_trace_enable(wb, enable=True):
+    wb.regs.sdcore_trace_enable.write(int(enable))
+
+def sdcard_trace_read(wb):
+    records = []
+    while wb.regs.sdcore_trace_valid.read() & 0x1:
+        record = wb.regs.sdcore_trace_record.read()
+        wb.regs.sdcore_trace_next.write(1)
+        records.append({
+            "timestamp": record & 0xffffffff,
+            "events":    (record >> 32) & 0xff,
+            "cmdindex":  (record >> 40) & 0x3f,
+            "dataxfer":  (record >> 46) & 0x3,
+            "block":     (record >> 48) & 0xffff
+        })
+    dropped = wb.regs.sdcore_trace_dropped.read()
+    if dropped:
+        print("trace: {:d} records dropped".format(dropped))
+    return records
+
+# events
+
+def sdcard_clear_events(wb):
+    wb.regs.sdcore_ev_pending.write(wb.regs.sdcore_ev_pending.read())
+
+def sdcard_wait_event(wb, events):
+    while True:
+        pending = wb.regs.sdcore_ev_pending.read()
+        if pending & events:
+            wb.regs.sdcore_ev_pending.write(pending)
+            return pending
+
+# auto commands
+
+def sdcard_set_autocmd(wb, cmd_support_sbc):
+    # prefer SET_BLOCK_COUNT when supported by the card (SCR.CMD_SUPPORT)
+    if cmd_support_sbc:
+        wb.regs.sdcore_autocmd.write(SDCARD_CTRL_AUTOCMD_CMD23)
+    else:
+        wb.regs.sdcore_autocmd.write(SDCARD_CTRL_AUTOCMD_CMD12)
+
+# retries
+
+def sdcard_set_retry(wb, maxretry):
+    wb.regs.sdcore_maxretry.write(maxretry)
+
+def sdcard_retry_count(wb):
+    return wb.regs.sdcore_retrycount.read()
+
+# auto polling
+
+def sdcard_set_autopoll(wb, enable, interval=2**12):
+    wb.regs.sdcore_pollinterval.write(interval)
+    wb.regs.sdcore_autopoll.write(int(enable))
+
+def sdcard_wait_card_ready(wb):
+    while True:
+        events = wb.regs.sdcore_ev_pending.read()
+        if events & (SDCARD_EV_CARDREADY | SDCARD_EV_TIMEOUT):
+            break
+    wb.regs.sdcore_ev_pending.write(SDCARD_EV_CARDREADY | SDCARD_EV_TIMEOUT)
+    # card still busy after the maximum number of polls
+    if not (events & SDCARD_EV_CARDREADY):
+        return SD_TIMEOUT
+    return SD_OK
+
+# abort
+
+def sdcard_abort(wb):
+    wb.regs.sdcore_abort.write(1)
+
+def sdcard_blocks(wb):
+    return wb.regs.sdcore_blocks.read()
+
+# phy
+
+def sdcard_set_ddr(wb, enable):
+    wb.regs.sdphy_ddr.write(int(enable))
+
+# tuner
+
+def sdcard_tune(wb):
+    wb.regs.sdtuner_start.write(1)
+    while not (wb.regs.sdtuner_done.read() & 0x1):
+        if wb.regs.sdtuner_error.read() & 0x1:
+            print("sdtuner: no passing tap")
+            return SD_CRCERROR
+    print("sdtuner: passes {:08x}, delay {:d}".format(
+        wb.regs.sdtuner_passes.read(), wb.regs.sdtuner_delay.read()))
+    return SD_OK
+
+# command queue
+
+def sdcard_queue_command(wb, cmd, arg, response, transfer=SDCARD_CTRL_DATA_TRANSFER_NONE,
+                         blocksize=512, blkcnt=1):
+    while((wb.regs.sdcore_cmdqready.read() & 0x1) == 0):
+        pass
+    wb.regs.sdcore_argument.write(arg)
+    wb.regs.sdcore_blocksize.write(blocksize)
+    wb.regs.sdcore_blockcount.write(blkcnt)
+    wb.regs.sdcore_qcommand.write((cmd << 8) | response | (transfer << 5))
+
+def sdcard_queue_result(wb):
+    while((wb.regs.sdcore_resultvalid.read() & 0x1) == 0):
+        pass
+    evt = wb.regs.sdcore_resultevt.read()
+    response = wb.regs.sdcore_resultresponse.read()
+    wb.regs.sdcore_resultnext.write(1)
+    cmdevt = evt & 0xffff
+    dataevt = (evt >> 16) & 0xffff
+    return cmdevt, dataevt, response
+
 # commands
 
 def sdcard_go_idle_state(wb):
@@ -198,9 +372,19 @@ def sdcard_send_cid(wb, rca):
 
 def sdcard_voltage_switch(wb):
     print("CMD11: VOLTAGE_SWITCH")
+    # the switch sequence runs at the end of the CMD11 response
+    if hasattr(wb.regs, "sdphy_vswitch_start"):
+        wb.regs.sdphy_vswitch_start.write(1)
     wb.regs.sdcore_argument.write(0x00000000)
     wb.regs.sdcore_command.write((11 << 8) | SDCARD_CTRL_RESPONSE_SHORT)
-    return sdcard_wait_response(wb, SDCARD_CTRL_RESPONSE_SHORT)
+    r, status = sdcard_wait_response(wb, SDCARD_CTRL_RESPONSE_SHORT)
+    # no sequence without a response
+    if hasattr(wb.regs, "sdphy_vswitch_start") and status == SD_OK:
+        while not (wb.regs.sdphy_vswitch_done.read() & 0x1):
+            if wb.regs.sdphy_vswitch_error.read() & 0x1:
+                print("1.8V switch failed")
+                return r, SD_TIMEOUT
+    return r, status
 
 def sdcard_stop_transmission(wb):
     print("CMD12: STOP_TRANSMISSION")
@@ -291,7 +475,13 @@ def sdcard_app_cmd(wb, rca=0):
 
 def sdcard_app_set_bus_width(wb):
     print("CMD6: APP_SET_BUS_WIDTH")
-    wb.regs.sdcore_argument.write(0x00000002)
+    # SD cards have 4 data lines: 4-bit bus, 1-bit on a single data line
+    # phy, the lines 4-7 of an 8 data lines phy (eMMC) would not be driven
+    buswidth = wb.regs.sdphy_buswidth.read()
+    if buswidth > 4:
+        print("no SD card on a {:d} data lines phy".format(buswidth))
+        return None, SD_BUSWIDTHERROR
+    wb.regs.sdcore_argument.write(0x00000000 if buswidth == 1 else 0x00000002)
     wb.regs.sdcore_command.write((6 << 8) | SDCARD_CTRL_RESPONSE_SHORT)
     return sdcard_wait_response(wb, SDCARD_CTRL_RESPONSE_SHORT)
 
@@ -339,6 +529,57 @@ def sdcard_app_send_num_wr_blocks(wb):
     sdcard_wait_data_done(wb)
     return r
 
+# emmc commands
+
+def sdcard_emmc_send_op_cond(wb):
+    print("CMD1: SEND_OP_COND")
+    # sector mode, 1.70-1.95V and 2.7-3.6V
+    wb.regs.sdcore_argument.write(0x40ff8080)
+    wb.regs.sdcore_command.write((1 << 8) | SDCARD_CTRL_RESPONSE_SHORT)
+    return sdcard_wait_response(wb, SDCARD_CTRL_RESPONSE_SHORT, nocrccheck=True)
+
+def sdcard_emmc_set_relative_address(wb, rca):
+    print("CMD3: SET_RELATIVE_ADDR")
+    wb.regs.sdcore_argument.write(rca << 16)
+    wb.regs.sdcore_command.write((3 << 8) | SDCARD_CTRL_RESPONSE_SHORT)
+    return sdcard_wait_response(wb, SDCARD_CTRL_RESPONSE_SHORT)
+
+def sdcard_emmc_switch(wb, rca, index, value):
+    print("CMD6: SWITCH")
+    # write byte index of the EXT_CSD
+    wb.regs.sdcore_argument.write((3 << 24) | (index << 16) | (value << 8))
+    wb.regs.sdcore_command.write((6 << 8) | SDCARD_CTRL_RESPONSE_SHORT)
+    r = sdcard_wait_response(wb, SDCARD_CTRL_RESPONSE_SHORT)
+    # wait end of busy
+    while True:
+        r1, status = sdcard_send_status(wb, rca)
+        if sdcard_card_status(wb) & SDCARD_CARDSTATUS_READY:
+            break
+    # switch result
+    if int.from_bytes(r1, "little") & EMMC_STATUS_SWITCH_ERROR:
+        print("switch error")
+        return r[0], SD_SWITCHERROR
+    return r
+
+def sdcard_emmc_send_ext_csd(wb):
+    print("CMD8: SEND_EXT_CSD")
+    wb.regs.sdcore_argument.write(0x00000000)
+    wb.regs.sdcore_blocksize.write(512)
+    wb.regs.sdcore_blockcount.write(1)
+    wb.regs.sdcore_command.write((8 << 8) | SDCARD_CTRL_RESPONSE_SHORT |
+                                 (SDCARD_CTRL_DATA_TRANSFER_READ << 5))
+    r = sdcard_wait_response(wb, SDCARD_CTRL_RESPONSE_SHORT)
+    sdcard_wait_data_done(wb)
+    return r
+
+def sdcard_emmc_set_bus_width(wb, rca):
+    value = {
+        1: EMMC_BUS_WIDTH_1,
+        4: EMMC_BUS_WIDTH_4,
+        8: EMMC_BUS_WIDTH_8,
+    }[wb.regs.sdphy_buswidth.read()]
+    return sdcard_emmc_switch(wb, rca, EMMC_EXT_CSD_BUS_WIDTH, value)
+
 # bist
 
 def sdcard_bist_generator_start(wb, blkcnt):
@@ -359,6 +600,123 @@ def sdcard_bist_checker_wait(wb):
     while((wb.regs.bist_checker_done.read() & 0x1) == 0):
         pass
 
+# dma
+
+def sdcard_block2mem_start(wb, base, length):
+    wb.regs.sdblock2mem_base.write(base)
+    wb.regs.sdblock2mem_length.write(length)
+    wb.regs.sdblock2mem_start.write(1)
+
+def sdcard_block2mem_wait(wb):
+    while((wb.regs.sdblock2mem_done.read() & 0x1) == 0):
+        pass
+    return wb.regs.sdblock2mem_cycles.read()
+
+def sdcard_mem2block_start(wb, base, length):
+    wb.regs.sdmem2block_base.write(base)
+    wb.regs.sdmem2block_length.write(length)
+    wb.regs.sdmem2block_start.write(1)
+
+def sdcard_mem2block_wait(wb):
+    while((wb.regs.sdmem2block_done.read() & 0x1) == 0):
+        pass
+    return wb.regs.sdmem2block_cycles.read()
+
+# descriptors
+
+def sdcard_descriptors_init(wb, base, cpl_base, size):
+    wb.regs.sddescriptors_enable.write(0)
+    wb.regs.sddescriptors_base.write(base)
+    wb.regs.sddescriptors_cpl_base.write(cpl_base)
+    wb.regs.sddescriptors_size.write(size)
+    wb.regs.sddescriptors_head.write(wb.regs.sddescriptors_tail.read())
+    wb.regs.sddescriptors_enable.write(1)
+
+def sdcard_descriptors_push(wb, command, argument, blkcnt, buf):
+    base = wb.regs.sddescriptors_base.read()
+    size = wb.regs.sddescriptors_size.read()
+    head = wb.regs.sddescriptors_head.read()
+    addr = base + 16*head
+    for i, word in enumerate([command, argument, blkcnt, buf]):
+        wb.write(addr + 4*i, word)
+    head = (head + 1) % size
+    wb.regs.sddescriptors_head.write(head)
+    return head
+
+def sdcard_descriptors_wait(wb):
+    while wb.regs.sddescriptors_tail.read() != wb.regs.sddescriptors_head.read():
+        pass
+
+def sdcard_descriptors_completion(wb, index):
+    addr = wb.regs.sddescriptors_cpl_base.read() + 8*index
+    status, response = wb.read(addr, 2)
+    cmdevt = status & 0xff
+    dataevt = (status >> 8) & 0xff
+    return cmdevt, dataevt, response
+
+# arbiter
+
+def sdcard_arbiter_config(wb, port, prio, weight, mergemax=None):
+    getattr(wb.regs, "sdarbiter_prio{:d}".format(port)).write(prio)
+    getattr(wb.regs, "sdarbiter_weight{:d}".format(port)).write(weight)
+    if mergemax is not None:
+        wb.regs.sdarbiter_mergemax.write(mergemax)
+
+# initializer
+
+def sdcard_hw_init(wb):
+    wb.regs.sdinit_start.write(1)
+    while not (wb.regs.sdinit_done.read() & 0x1):
+        if wb.regs.sdinit_error.read() & 0x1:
+            print("sdinit: error at step {:d}".format(wb.regs.sdinit_step.read()))
+            return SD_TIMEOUT
+    print("RCA: {:04x}".format(wb.regs.sdinit_rca.read()))
+    print("access mode: {:d}".format(wb.regs.sdinit_mode.read()))
+    return SD_OK
+
+# recorder
+
+def sdcard_recorder_start(wb, base, size, chunk=1024, erase=False):
+    wb.regs.sdrecorder_enable.write(0)
+    wb.regs.sdrecorder_base.write(base)
+    wb.regs.sdrecorder_size.write(size)
+    wb.regs.sdrecorder_chunk.write(chunk)
+    wb.regs.sdrecorder_erase.write(int(erase))
+    wb.regs.sdrecorder_enable.write(1)
+
+def sdcard_recorder_stop(wb):
+    wb.regs.sdrecorder_enable.write(0)
+
+def sdcard_recorder_status(wb):
+    wp = wb.regs.sdrecorder_wp.read()
+    wraps = wb.regs.sdrecorder_wraps.read()
+    error = wb.regs.sdrecorder_error.read()
+    print("wp: {:d} wraps: {:d}{}".format(wp, wraps, " (Error)" if error else ""))
+    return wp, wraps, error
+
+# player
+
+def sdcard_player_start(wb, base, size, chunk=1024, loop=True):
+    wb.regs.sdplayer_enable.write(0)
+    wb.regs.sdplayer_base.write(base)
+    wb.regs.sdplayer_size.write(size)
+    wb.regs.sdplayer_chunk.write(chunk)
+    wb.regs.sdplayer_loop.write(int(loop))
+    wb.regs.sdplayer_enable.write(1)
+
+def sdcard_player_stop(wb):
+    wb.regs.sdplayer_enable.write(0)
+
+def sdcard_player_status(wb):
+    rp = wb.regs.sdplayer_rp.read()
+    loops = wb.regs.sdplayer_loops.read()
+    done = wb.regs.sdplayer_done.read()
+    error = wb.regs.sdplayer_error.read()
+    print("rp: {:d} loops: {:d}{}{}".format(rp, loops,
+        " (Done)" if done else "",
+        " (Error)" if error else ""))
+    return rp, loops, done, error
+
 # user
 
 def settimeout(wb, clkfreq, timeout):
@@ -366,6 +724,135 @@ def settimeout(wb, clkfreq, timeout):
     wb.regs.sdcore_cmdtimeout.write(clktimeout)
     wb.regs.sdcore_datatimeout.write(clktimeout)
 
+# speed negotiation
+
+# card clock of the access modes, a mode is only used above the clock of the
+# slower one
+sd_speed_freqs = {
+    SD_SPEED_SDR12:  (25e6,  0),
+    SD_SPEED_SDR25:  (50e6,  25e6),
+    SD_SPEED_SDR50:  (100e6, 50e6),
+    SD_SPEED_SDR104: (208e6, 100e6),
+    SD_SPEED_DDR50:  (50e6,  25e6),
+}
+
+def sdcard_set_speed_clock(wb, freq, ddr):
+    sdclk_set_config(wb, freq)
+    settimeout(wb, freq, 0.1)
+    if hasattr(wb.regs, "sdphy_ddr"):
+        sdcard_set_ddr(wb, ddr)
+
+def sdcard_negotiate_speed(wb, rca, addr, uhs=False, maxfreq=100e6):
+    # scr: CMD6 is supported from version 1.10 of the specification
+    sdcard_app_cmd(wb, rca)
+    sdcard_block2mem_start(wb, addr, 8)
+    sdcard_app_send_scr(wb)
+    if sdcard_wait_data_done(wb) != SD_OK:
+        return None
+    sdcard_block2mem_wait(wb)
+    scr = decode_scr(wb, addr)
+    support = 1 << SD_SPEED_SDR12
+    if scr.sd_spec != 0:
+        sdcard_block2mem_start(wb, addr, 64)
+        sdcard_switch_func(wb, SD_SWITCH_CHECK, SD_GROUP_ACCESSMODE, 0xf)
+        if sdcard_wait_data_done(wb) != SD_OK:
+            return None
+        sdcard_block2mem_wait(wb)
+        support |= decode_switch_status(wb, addr).support[SD_GROUP_ACCESSMODE]
+
+    # UHS-I modes need 1.8v signaling
+    if not uhs:
+        support &= (1 << SD_SPEED_SDR12) | (1 << SD_SPEED_SDR25)
+    # DDR50 needs the phase shifted data clock of the phy
+    if not hasattr(wb.regs, "sdphy_ddr"):
+        support &= ~(1 << SD_SPEED_DDR50)
+
+    # fastest mode first, fall back to the next one when the switch or the
+    # test read fails
+    mode = SD_SPEED_SDR12
+    for speed in [SD_SPEED_SDR104, SD_SPEED_SDR50, SD_SPEED_DDR50,
+                  SD_SPEED_SDR25, SD_SPEED_SDR12]:
+        freq, minfreq = sd_speed_freqs[speed]
+        if not (support & (1 << speed)) or maxfreq <= minfreq:
+            continue
+
+        # switch at a clock supported by all the modes
+        sdcard_set_speed_clock(wb, sd_speed_freqs[SD_SPEED_SDR12][0],
+            mode == SD_SPEED_DDR50)
+        sdcard_block2mem_start(wb, addr, 64)
+        sdcard_switch_func(wb, SD_SWITCH_SWITCH, SD_GROUP_ACCESSMODE, speed)
+        if sdcard_wait_data_done(wb) != SD_OK:
+            continue
+        sdcard_block2mem_wait(wb)
+        if decode_switch_status(wb, addr).function[SD_GROUP_ACCESSMODE] != speed:
+            continue
+        mode = speed
+
+        freq = min(freq, maxfreq)
+        sdcard_set_speed_clock(wb, freq, speed == SD_SPEED_DDR50)
+        if speed in [SD_SPEED_SDR50, SD_SPEED_SDR104] and hasattr(wb.regs, "sdtuner_start"):
+            if sdcard_tune(wb) != SD_OK:
+                continue
+
+        # test read
+        sdcard_block2mem_start(wb, addr, 512)
+        sdcard_read_single_block(wb, 0)
+        if sdcard_wait_data_done(wb) == SD_OK:
+            sdcard_block2mem_wait(wb)
+            print("Access mode: {:s} at {:3.2f}MHz".format(
+                sd_speed_names[speed], freq/1e6))
+            return speed
+    return None
+
+# emmc timings: card clock and EXT_CSD device type needed
+emmc_timing_freqs = {
+    EMMC_HS_TIMING_LEGACY: (26e6,  0),
+    EMMC_HS_TIMING_HS:     (52e6,  EMMC_DEVICE_TYPE_HS_52),
+    EMMC_HS_TIMING_HS200:  (200e6, EMMC_DEVICE_TYPE_HS200_1_8V),
+}
+
+def sdcard_emmc_negotiate_timing(wb, rca, addr, maxfreq=200e6):
+    sdcard_block2mem_start(wb, addr, 512)
+    sdcard_emmc_send_ext_csd(wb)
+    if sdcard_wait_data_done(wb) != SD_OK:
+        return None
+    sdcard_block2mem_wait(wb)
+    device_type = decode_ext_csd(wb, addr).device_type
+
+    # fastest timing first (HS200 needs 1.8V I/Os and 4/8 data lines), fall
+    # back to the next one when the switch or the test read fails
+    for timing in [EMMC_HS_TIMING_HS200, EMMC_HS_TIMING_HS, EMMC_HS_TIMING_LEGACY]:
+        freq, device_types = emmc_timing_freqs[timing]
+        if (device_type & device_types) != device_types:
+            continue
+        if timing == EMMC_HS_TIMING_HS200:
+            if maxfreq <= emmc_timing_freqs[EMMC_HS_TIMING_HS][0]:
+                continue
+            if wb.regs.sdphy_buswidth.read() == 1:
+                continue
+
+        # switch at a clock supported by all the timings
+        sdcard_set_speed_clock(wb, emmc_timing_freqs[EMMC_HS_TIMING_LEGACY][0], False)
+        r, status = sdcard_emmc_switch(wb, rca, EMMC_EXT_CSD_HS_TIMING, timing)
+        if status != SD_OK:
+            continue
+
+        freq = min(freq, maxfreq)
+        sdcard_set_speed_clock(wb, freq, False)
+        if timing == EMMC_HS_TIMING_HS200 and hasattr(wb.regs, "sdtuner_start"):
+            if sdcard_tune(wb) != SD_OK:
+                continue
+
+        # test read
+        sdcard_block2mem_start(wb, addr, 512)
+        sdcard_read_single_block(wb, 0)
+        if sdcard_wait_data_done(wb) == SD_OK:
+            sdcard_block2mem_wait(wb)
+            print("Timing: {:s} at {:3.2f}MHz".format(
+                emmc_timing_names[timing], freq/1e6))
+            return timing
+    return None
+
 
 # register decoding
 
@@ -547,9 +1034,114 @@ def decode_scr(comm, addr):
     data = []
     for i in range(8//4):
         data.append(comm.read(addr + 4*i))
+    # first byte of the block in the upper bits of the words
     ba = bytearray()
     for d in data:
-        ba += bytearray(d.to_bytes(4, 'little'))
+        ba += bytearray(d.to_bytes(4, 'big'))
     scr = SCR(int(ba.hex(), 16))
     print(scr)
     return scr
+
+
+sd_speed_names = {
+    SD_SPEED_SDR12:  "SDR12",
+    SD_SPEED_SDR25:  "SDR25",
+    SD_SPEED_SDR50:  "SDR50",
+    SD_SPEED_SDR104: "SDR104",
+    SD_SPEED_DDR50:  "DDR50",
+}
+
+class SwitchStatus:
+    def __init__(self, status):
+        self.status = status
+
+        self.max_current = extract(status, 496, 16)
+        # support bits and selected function of the function groups 1 to 6
+        self.support = [extract(status, 400 + 16*i, 16) for i in range(6)]
+        self.function = [extract(status, 376 + 4*i, 4) for i in range(6)]
+        self.data_structure = extract(status, 368, 8)
+
+    def __str__(self):
+        access_modes = ""
+        for speed, name in sorted(sd_speed_names.items()):
+            if self.support[SD_GROUP_ACCESSMODE] & (1 << speed):
+                access_modes += "\n        " + name
+
+        r = """
+    Switch Status: {:0128x}
+    Maximum current: {} mA
+    Access modes supported: {}
+    Access mode selected: {}
+    Driver strength selected: {}
+""".format(
+    self.status,
+    self.max_current,
+    access_modes,
+    sd_speed_names.get(self.function[SD_GROUP_ACCESSMODE], "none"),
+    "BACD"[self.function[SD_GROUP_DRIVERSTRENGTH]] if self.function[SD_GROUP_DRIVERSTRENGTH] < 4 else "none",
+)
+        return r
+
+def decode_switch_status(comm, addr):
+    data = []
+    for i in range(64//4):
+        data.append(comm.read(addr + 4*i))
+    # first byte of the block in the upper bits of the words
+    ba = bytearray()
+    for d in data:
+        ba += bytearray(d.to_bytes(4, 'big'))
+    status = SwitchStatus(int(ba.hex(), 16))
+    print(status)
+    return status
+
+
+emmc_timing_names = {
+    EMMC_HS_TIMING_LEGACY: "legacy",
+    EMMC_HS_TIMING_HS:     "HS",
+    EMMC_HS_TIMING_HS200:  "HS200",
+}
+
+class ExtCSD:
+    def __init__(self, ext_csd):
+        self.ext_csd = ext_csd
+
+        self.sec_count = int.from_bytes(ext_csd[212:216], "little")
+        self.device_type = ext_csd[EMMC_EXT_CSD_DEVICE_TYPE]
+        self.hs_timing = ext_csd[EMMC_EXT_CSD_HS_TIMING]
+        self.bus_width = ext_csd[EMMC_EXT_CSD_BUS_WIDTH]
+        self.ext_csd_rev = ext_csd[192]
+
+    def __str__(self):
+        device_types = ""
+        for bit, name in [(EMMC_DEVICE_TYPE_HS_26, "HS 26MHz"),
+                          (EMMC_DEVICE_TYPE_HS_52, "HS 52MHz"),
+                          (EMMC_DEVICE_TYPE_HS200_1_8V, "HS200 1.8V")]:
+            if self.device_type & bit:
+                device_types += "\n        " + name
+
+        r = """
+    EXT_CSD revision: {}
+    Device size: {} sectors
+    Device types supported: {}
+    Timing selected: {}
+    Bus width: {}
+""".format(
+    self.ext_csd_rev,
+    self.sec_count,
+    device_types,
+    emmc_timing_names.get(self.hs_timing & 0xf, "reserved"),
+    {0: 1, 1: 4, 2: 8}.get(self.bus_width & 0xf, "reserved"),
+)
+        return r
+
+def decode_ext_csd(comm, addr):
+    data = []
+    for i in range(512//4):
+        data.append(comm.read(addr + 4*i))
+    # first byte of the block in the upper bits of the words
+    ba = bytearray()
+    for d in data:
+        ba += bytearray(d.to_bytes(4, 'big'))
+    ext_csd = ExtCSD(ba)
+    print(ext_csd)
+    return ext_csd
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+
+from litex.soc.tools.remote import RemoteClient
+
+from libbase.sdcard import *
+
+# needs the example design built with dma (DMAs next to the BIST)
+
+
+def main(wb):
+    # set low speed clock
+    clkfreq = 10e6
+    sdclk_set_config(wb, clkfreq)
+    settimeout(wb, clkfreq, 0.1)
+
+    # R1 response to CMD3, CMD1 not decoded
+    wb.regs.sdcore_emmc.write(1)
+
+    # reset device
+    sdcard_go_idle_state(wb)
+
+    # wait for device ready
+    while True:
+        r3, status = sdcard_emmc_send_op_cond(wb)
+        if r3[3] & 0x80:
+            print("eMMC ready")
+            break
+
+    # send identification
+    sdcard_all_send_cid(wb)
+
+    # set relative device address
+    rca = 1
+    sdcard_emmc_set_relative_address(wb, rca)
+
+    # send csd
+    sdcard_send_csd(wb, rca)
+    decode_csd(wb)
+
+    # select device
+    sdcard_select_card(wb, rca)
+
+    # set bus width (data lines of the phy)
+    sdcard_emmc_set_bus_width(wb, rca)
+
+    # set blocklen
+    sdcard_set_blocklen(wb, 512)
+
+    # switch to the fastest timing (EXT_CSD read to sram)
+    sdcard_emmc_negotiate_timing(wb, rca, wb.mems.sram.base)
+
+    # single block test
+    for i in range(2):
+        # write
+        sdcard_bist_generator_start(wb, 1)
+        sdcard_write_single_block(wb, i)
+        sdcard_bist_generator_wait(wb)
+
+        # read
+        sdcard_bist_checker_start(wb, 1)
+        sdcard_read_single_block(wb, i)
+        sdcard_bist_checker_wait(wb)
+
+        print("bist errors: {:d}".format(wb.regs.bist_checker_errors.read()))
+
+if __name__ == '__main__':
+    wb = RemoteClient(port=1234, debug=False)
+    wb.open()
+    main(wb)
+    wb.close()
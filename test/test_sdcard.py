@@ -7,6 +7,8 @@ from litex.soc.tools.remote import RemoteClient
 
 from libbase.sdcard import *
 
+# needs the example design built with dma (DMAs next to the BIST)
+
 
 def main(wb):
     # set low speed clock
@@ -58,7 +60,10 @@ def main(wb):
 
     # send scr
     sdcard_app_cmd(wb, rca)
+    sdcard_block2mem_start(wb, wb.mems.sram.base, 8)
     sdcard_app_send_scr(wb)
+    sdcard_block2mem_wait(wb)
+    scr = decode_scr(wb, wb.mems.sram.base)
 
     clkfreq = 100e6
     sdclk_set_config(wb, clkfreq)
@@ -67,12 +72,17 @@ def main(wb):
     # set blocklen
     sdcard_set_blocklen(wb, 512)
 
+    # poll the card status after writes
+    sdcard_set_autopoll(wb, 1)
+    sdcard_clear_events(wb)
+
     # single block test
     for i in range(2):
         # write
         sdcard_bist_generator_start(wb, 1)
         sdcard_write_single_block(wb, i)
         sdcard_bist_generator_wait(wb)
+        sdcard_wait_card_ready(wb)
 
         # read
         sdcard_bist_checker_start(wb, 1)
@@ -81,19 +91,18 @@ def main(wb):
 
         print("bist errors: {:d}".format(wb.regs.bist_checker_errors.read()))
 
-    #  multiple blocks test
+    #  multiple blocks test (SET_BLOCK_COUNT sent by the core when supported)
+    sdcard_set_autocmd(wb, scr.cmd_support_sbc)
     length = 16*1024*1024
     blocks = length//512
 
     # write
-    sdcard_set_block_count(wb, blocks)
     sdcard_bist_generator_start(wb, blocks)
     sdcard_write_multiple_block(wb, 0, blocks)
     sdcard_bist_generator_wait(wb)
-    sdcard_stop_transmission(wb)
+    sdcard_wait_card_ready(wb)
 
     # read
-    sdcard_set_block_count(wb, blocks)
     sdcard_bist_checker_start(wb, blocks)
     sdcard_read_multiple_block(wb, 0, blocks)
     sdcard_bist_checker_wait(wb)